@@ -0,0 +1,292 @@
+"""
+Benchmarks of the build pipeline on generated source trees.
+"""
+
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+from contextlib import closing, contextmanager
+
+import Image
+
+from django.db import connection, transaction
+from django.test.testcases import (disable_transaction_methods,
+                                   restore_transaction_methods)
+from django.test.utils import override_settings
+
+from css_builder.core_utils import (find_package_files,
+                                    get_package_dependencies,
+                                    sort_package_files, concatenate_files,
+                                    DependencyCache, SOURCE_INDEX)
+from css_builder.models import Sprite
+from css_builder.utils import (css_sprites, embedding_images,
+                               build_css_sprite, build_all_packages,
+                               FRAGMENT_CACHE, IMAGE_METADATA,
+                               SPRITE_STORES)
+
+
+DEFAULT_CONFIG = {
+    "files": 200,           # number of css files
+    "depth": 4,             # length of the longest require chain
+    "fan_out": 3,           # number of require declarations per file
+    "nesting": 3,           # depth of the directory tree
+    "packages": 10,
+    "sprite_density": 0.5,  # /* 2sprite */ rules per file
+    "b64_density": 0.2,     # /* 2b64 */ rules per file
+    "icons": 50,
+    "seed": 0,
+}
+
+STAGES = ["find", "get_package_dependencies", "topological_sorting",
+          "build_css_sprite", "add_css_sprites", "add_embedding_images",
+          "build_all_packages"]
+
+SPRITE_RULE = "div.s%d { background: #808080 url(%s) no-repeat top left; \
+/* 2sprite */ }\n"
+B64_RULE = "div.b%d { background-image: url(%s); /* 2b64 */ }\n"
+
+
+def write(path, content):
+    with closing(open(path, "w")) as f:
+        f.write(content)
+
+
+def generate_tree(root, config, media_url="/site_media/"):
+    """
+    Generate source and destination directories with css files and icons.
+
+    Files are split into config["depth"] layers, every file requires
+    config["fan_out"] files from the layer below. Every package contains
+    files from the top layer.
+
+    Parameters:
+        root <str> - empty directory
+        config <dict> - see DEFAULT_CONFIG
+        media_url <str>
+    Return:
+        <dict> - settings for the tree
+    """
+    rnd = random.Random(config["seed"])
+    source = os.path.join(root, "source")
+    dest = os.path.join(root, "dest")
+    os.makedirs(os.path.join(source, "icons"))
+    os.makedirs(os.path.join(dest, "images"))
+
+    icons = []
+    for i in range(config["icons"]):
+        name = "icons/i%d.png" % i
+        size = (rnd.randint(8, 48), rnd.randint(8, 48))
+        color = (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255),
+                 255)
+        Image.new("RGBA", size, color).save(os.path.join(source, name))
+        icons.append(name)
+    images = []
+    for i in range(max(1, config["icons"] / 10)):
+        name = "images/b%d.png" % i
+        Image.new("RGBA", (16, 16), (0, 0, 0, 255)).save(
+                                                    os.path.join(dest, name))
+        images.append(name)
+
+    # binary directory tree config["nesting"] levels deep
+    dirs = [""]
+    level = [""]
+    for i in range(config["nesting"]):
+        level = [os.path.join(d, "d%d" % j) for d in level for j in range(2)]
+        dirs += level
+    for d in dirs[1:]:
+        os.mkdir(os.path.join(source, d))
+
+    depth = max(config["depth"], 1)
+    layers = [[] for i in range(depth)]
+    for i in range(config["files"]):
+        layer = i * depth / max(config["files"], 1)
+        prefix = "top" if layer == depth - 1 else "l%d" % layer
+        name = os.path.join(rnd.choice(dirs), "%s_%d.css" % (prefix, i))
+        layers[layer].append(name)
+
+    def rules(count, template, urls):
+        n = int(count) + (1 if rnd.random() < count - int(count) else 0)
+        return "".join(template % (j, media_url + rnd.choice(urls))
+                       for j in range(n) if urls)
+
+    for layer, names in enumerate(layers):
+        for name in names:
+            content = ""
+            if layer > 0 and layers[layer - 1]:
+                for required in rnd.sample(layers[layer - 1], min(
+                                config["fan_out"], len(layers[layer - 1]))):
+                    content += "// require %s\n" % required
+            content += "div.f { color: #aabbcc; margin: 0px; }\n"
+            content += rules(config["sprite_density"], SPRITE_RULE, icons)
+            content += rules(config["b64_density"], B64_RULE, images)
+            write(os.path.join(source, name), content)
+
+    # real source trees aren't modified right before the build
+    past = time.time() - 3600
+    for d in dirs + ["icons"]:
+        os.utime(os.path.join(source, d), (past, past))
+
+    packages = {}
+    for i in range(config["packages"]):
+        top = [name for j, name in enumerate(layers[-1]) if
+               j % config["packages"] == i]
+        packages["bench%d" % i] = top
+    return {"CSS_BUILDER_SOURCE": source, "MEDIA_ROOT": dest,
+            "MEDIA_URL": media_url,
+            "CSS_BUILDER_CACHE_DIR": os.path.join(root, "cache"),
+            "CSS_BUILDER_PACKAGES": packages,
+            "CSS_BUILDER_SPRITES": {"bench_icons": {
+                    "files": [r"icons/.*\.png"], "orientation": "vertically"}}}
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def run_stages(cfg, cache):
+    """
+    Run every stage once
+
+    Return:
+        <dict> - stage name -> seconds
+    """
+    timings = {}
+    root = cfg["CSS_BUILDER_SOURCE"]
+    packages = cfg["CSS_BUILDER_PACKAGES"]
+
+    timings["find"], files = timed(lambda: dict(
+                (name, find_package_files(patterns, root)) for
+                name, patterns in packages.items()))
+    timings["get_package_dependencies"], dependencies = timed(lambda: dict(
+                (name, get_package_dependencies([os.path.join(root, f) for f
+                 in files[name]], root, cache)) for name in packages))
+    timings["topological_sorting"], sorted_files = timed(lambda: dict(
+                (name, sort_package_files(dependencies[name])) for name in
+                packages))
+    timings["build_css_sprite"], result = timed(lambda: [
+                build_css_sprite(name) for name in cfg["CSS_BUILDER_SPRITES"]])
+
+    contents = [concatenate_files(sorted_files[name]) for name in packages]
+    timings["add_css_sprites"], contents = timed(lambda: [
+                css_sprites(content) for content in contents])
+    timings["add_embedding_images"], contents = timed(lambda: [
+                embedding_images(content) for content in contents])
+    return timings
+
+
+def clean_outputs(cfg):
+    """
+    Remove outputs, caches and sprite records so the next build is cold
+    """
+    dest = cfg["MEDIA_ROOT"]
+    for name in os.listdir(dest):
+        path = os.path.join(dest, name)
+        if os.path.isfile(path):
+            os.remove(path)
+    if os.path.isdir(cfg["CSS_BUILDER_CACHE_DIR"]):
+        shutil.rmtree(cfg["CSS_BUILDER_CACHE_DIR"])
+    FRAGMENT_CACHE.entries.clear()
+    SOURCE_INDEX.clear()
+    IMAGE_METADATA.clear()
+    for store in SPRITE_STORES.values():
+        store.clear()
+    Sprite.objects.filter(name__in=cfg["CSS_BUILDER_SPRITES"]).delete()
+
+
+@contextmanager
+def throwaway_transaction():
+    """
+    Run the block in a transaction which is rolled back, like django
+    TestCase does, so sprite records of the benchmark never get to the
+    project database. Transaction which is already open (e.g. in tests) is
+    rolled back by its owner.
+    """
+    if getattr(connection, "in_atomic_block", False) or \
+        transaction.is_managed():
+        yield
+        return
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    disable_transaction_methods()
+    try:
+        yield
+    finally:
+        restore_transaction_methods()
+        transaction.rollback()
+        transaction.leave_transaction_management()
+
+
+def run_benchmark(config=None, repeat=3):
+    """
+    Generate source tree and time every stage and the whole build, cold
+    (empty caches, no outputs) and warm (best of repeat runs, packages are
+    rebuilt with the fragment cache filled by the cold build). Database
+    changes are rolled back.
+
+    Parameters:
+        config <dict> - overrides of DEFAULT_CONFIG
+        repeat <int>
+    Return:
+        <dict> - {"config": ..., "results": {stage: {"cold": s, "warm": s}}}
+    """
+    cfg = dict(DEFAULT_CONFIG)
+    cfg.update(config or {})
+    root = tempfile.mkdtemp(prefix="css_builder_benchmark")
+    try:
+        tree = generate_tree(root, cfg)
+        # sqlite would commit the transaction before checking the table
+        SPRITE_STORES["models"].has_sizes()
+        with throwaway_transaction(), override_settings(**tree):
+            results = dict((stage, {}) for stage in STAGES)
+            clean_outputs(tree)
+            cache = DependencyCache()
+            for stage, seconds in run_stages(tree, cache).items():
+                results[stage]["cold"] = seconds
+            warm = {}
+            for i in range(max(repeat, 1)):
+                for stage, seconds in run_stages(tree, cache).items():
+                    warm[stage] = min(warm.get(stage, seconds), seconds)
+            for stage, seconds in warm.items():
+                results[stage]["warm"] = seconds
+
+            clean_outputs(tree)
+            results["build_all_packages"]["cold"] = timed(
+                                            build_all_packages)[0]
+            results["build_all_packages"]["warm"] = min(
+                timed(build_all_packages, force=True)[0] for i in
+                range(max(repeat, 1)))
+            clean_outputs(tree)
+    finally:
+        shutil.rmtree(root)
+    return {"config": cfg, "python": platform.python_version(),
+            "results": results}
+
+
+def compare_results(results, baseline, threshold=0.1, min_seconds=0.001):
+    """
+    Compare results with the baseline
+
+    Parameters:
+        results <dict> - result of run_benchmark
+        baseline <dict> - result of run_benchmark
+        threshold <float> - allowed relative slowdown
+        min_seconds <float> - smaller differences are ignored
+    Return:
+        <list> - (stage, mode, baseline seconds, seconds, is regression)
+    """
+    rows = []
+    for stage in STAGES:
+        for mode in ["cold", "warm"]:
+            old = baseline["results"].get(stage, {}).get(mode)
+            new = results["results"].get(stage, {}).get(mode)
+            if old == None or new == None:
+                continue
+            regression = new > old * (1 + threshold) and \
+                new - old > min_seconds
+            rows.append((stage, mode, old, new, regression))
+    return rows
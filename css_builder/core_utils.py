@@ -1,9 +1,31 @@
 
+import cPickle
+import hashlib
+import heapq
 import os
 import re
+import tempfile
+import time
+from collections import deque
+from contextlib import closing, contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 from django.conf import settings
 
+from css_builder import stats
+
 def is_special_regexp(s):
     """
     Check is string is special regular expression
@@ -44,17 +66,25 @@ class GraphNode(object):
     """
     Class represents node in graph
     """
-    def __init__(self, name, out_edges=[], in_edges=[]):
+    def __init__(self, name, out_edges=None, in_edges=None):
         self.name = name
-        self.in_edges = in_edges
-        self.out_edges = out_edges
+        self.in_edges = []
+        self.out_edges = []
+        self._in_set = set()
+        self._out_set = set()
+        for edge in in_edges or []:
+            self.add_in_edge(edge)
+        for edge in out_edges or []:
+            self.add_out_edge(edge)
 
     def add_in_edge(self, name):
-        if not name in self.in_edges:
+        if not name in self._in_set:
+            self._in_set.add(name)
             self.in_edges.append(name)
 
     def add_out_edge(self, name):
-        if not name in self.out_edges:
+        if not name in self._out_set:
+            self._out_set.add(name)
             self.out_edges.append(name)
 
     def get_name(self):
@@ -67,9 +97,11 @@ class GraphNode(object):
         return self.in_edges
 
     def remove_out_edge(self, node):
+        self._out_set.remove(node)
         self.out_edges.remove(node)
 
     def remove_in_edge(self, node):
+        self._in_set.remove(node)
         self.in_edges.remove(node)
 
     def has_edge(self):
@@ -85,24 +117,39 @@ class GraphNode(object):
 class DependencyGraph(object):
     """
     Class for represeting dependency graph
+
+    Nodes are kept in insertion order (isolated nodes first, then nodes in
+    the order they appear in edges) and indexed by name, so building the
+    graph is linear in the number of nodes and edges.
     """
-    def __init__(self, edges, isolated_nodes=[]):
-        self.nodes = isolated_nodes
+    def __init__(self, edges, isolated_nodes=None):
+        self.nodes = []
+        self.index = {}
 
-        for edge in edges:
-            if not edge.start in map(lambda n: n.get_name(), self.nodes):
-                self.nodes.append(GraphNode(edge.start, [edge.end], []))
-            else:
-                for node in self.nodes:
-                    if node.get_name() == edge.start:
-                        node.add_out_edge(edge.end)
+        for node in isolated_nodes or []:
+            self.add_node(node)
 
-            if not edge.end in map(lambda n: n.get_name(), self.nodes):
-                self.nodes.append(GraphNode(edge.end, [], [edge.start]))
-            else:
-                for node in self.nodes:
-                    if node.get_name() == edge.end:
-                        node.add_in_edge(edge.start)
+        for edge in edges:
+            self.get_or_create_node(edge.start).add_out_edge(edge.end)
+            self.get_or_create_node(edge.end).add_in_edge(edge.start)
+
+    def add_node(self, node):
+        if node.get_name() in self.index:
+            existing = self.index[node.get_name()]
+            for name in node.get_incoming_edges():
+                existing.add_in_edge(name)
+            for name in node.get_outgoing_edges():
+                existing.add_out_edge(name)
+            return existing
+        self.index[node.get_name()] = node
+        self.nodes.append(node)
+        return node
+
+    def get_or_create_node(self, name):
+        node = self.index.get(name)
+        if node == None:
+            node = self.add_node(GraphNode(name))
+        return node
 
     def has_edge(self):
         for node in self.nodes:
@@ -111,77 +158,257 @@ class DependencyGraph(object):
         return False
 
     def get_node(self, name):
-        for node in self.nodes:
-            if node.get_name() == name:
-                return node
-        return None
-
-    def remove_edge(self, start_node, end_node):
-        if type(start_node) == type(""):
-            start_node = self.get_node(start_node)
-        if type(end_node) == type(""):
-            end_node = self.get_node(end_node)
-        end_node.remove_in_edge(start_node.get_name())
-        start_node.remove_out_edge(end_node.get_name())
-        return self.remove_isolated_nodes()
-
-    def remove_isolated_nodes(self):
-        removed_nodes = []
-        for node in reversed(self.nodes):
-            if not node.has_incoming_edge() and not node.has_outgoing_edge():
-                self.nodes.remove(node)
-                removed_nodes.append(node)
-        return removed_nodes
-
-    def has_nodes_with_no_incoming_edge(self):
+        return self.index.get(name)
+
+    def find_cycle(self, names):
+        """
+        Return list of node names which form a cycle. Every node from names
+        has to have at least one incoming edge from other node in names.
+
+        Parameters:
+            names <set>
+        Return:
+            list
+        """
+        current = iter(names).next()
+        path = []
+        position = {}
+        while not current in position:
+            position[current] = len(path)
+            path.append(current)
+            for name in self.index[current].get_incoming_edges():
+                if name in names:
+                    current = name
+                    break
+        cycle = path[position[current]:]
+        # incoming edges were followed so reverse to get "requires" order
+        cycle.reverse()
+        return cycle + [cycle[0]]
+
+
+def topological_sorting(graph):
+    """
+    Sort nodes so every node comes after all nodes it has edges to. Ties are
+    broken by the order in which nodes were added to the graph.
+
+    The graph isn't modified.
+
+    Parameters:
+        graph <DependencyGraph>
+
+    Return:
+        list
+    """
+    position = {}
+    in_degree = {}
+    out_degree = {}
+    for i, node in enumerate(graph.nodes):
+        position[node.get_name()] = i
+        in_degree[node.get_name()] = len(node.get_incoming_edges())
+        out_degree[node.get_name()] = len(node.get_outgoing_edges())
+
+    # isolated nodes are taken first, starting from the last added one
+    sorted_nodes = [node.get_name() for node in reversed(graph.nodes)
+                    if not node.has_edge()]
+
+    ready = [position[node.get_name()] for node in graph.nodes
+             if not node.has_incoming_edge() and node.has_outgoing_edge()]
+    heapq.heapify(ready)
+
+    while ready:
+        a = graph.nodes[heapq.heappop(ready)]
+        sorted_nodes.append(a.get_name())
+
+        for name in reversed(a.get_outgoing_edges()):
+            in_degree[name] -= 1
+            if in_degree[name] == 0:
+                if out_degree[name] == 0:
+                    sorted_nodes.append(name)
+                else:
+                    heapq.heappush(ready, position[name])
+
+    if len(sorted_nodes) != len(graph.nodes):
+        left = set(position) - set(sorted_nodes)
+        raise Exception("topological_sorting",
+                        "Dependency graph has a cycle: %s" %
+                        " -> ".join(graph.find_cycle(left)))
+    sorted_nodes.reverse()
+    return sorted_nodes
+
+class PatternSegment(object):
+    """
+    One segment of the path pattern (part between slashes) with the
+    regular expression compiled once.
+
+    "**" matches any directory, "***" matches any directory or nothing,
+    regular expression is matched at the beginning of the name and other
+    strings have to be equal to the name.
+    """
+    def __init__(self, segment):
+        self.segment = segment
+        self.special = is_special_regexp(segment)
+        self.optional = segment == "***"
+        self.regexp = None
+        if is_regexp(segment) and not self.special:
+            self.regexp = re.compile(segment).match
+
+    def matches(self, name, is_dir):
         """
-        Check if there are some nods without incoming nodes
+        Parameters:
+            name <str> - file/dir name
+            is_dir <bool>
         Return:
-            bool
+            <bool>
         """
-        return len(self.nodes_with_no_incoming_edge()) > 0
+        if self.special:
+            return is_dir
+        if self.regexp != None:
+            return self.regexp(name) != None
+        return self.segment == name
+
+
+class PathPattern(object):
+    """
+    Compiled pattern used by find, e.g. **/d/[a-z]\.js
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.segments = [PatternSegment(s) for s in pattern.split("/")]
 
-    def nodes_with_no_incoming_edge(self):
+    def find(self, root):
         """
-        Return list of nodes without any incoming edges
+        Return absolute paths of files under root which match the pattern
 
+        Parameters:
+            root <str> - absolute path to the directory
         Return:
-            list
+            <list>
         """
         results = []
-        for node in self.nodes:
-            if not node.has_incoming_edge():
-                results.append(node)
+        self._find(0, root, False, results)
         return results
 
-def topological_sorting(graph):
+    def _find(self, index, root, downgraded, results):
+        # downgraded "***" behaves like "**" in subdirectories
+        segment = self.segments[index]
+        last = index == len(self.segments) - 1
+        if segment.optional and not downgraded and not last:
+            self._find(index + 1, root, False, results)
+
+        dirs = []
+        for name, is_dir in list_dir(root):
+            if is_dir:
+                if segment.matches(name, True):
+                    dirs.append(name)
+            elif last and segment.matches(name, False):
+                results.append(os.path.join(root, name))
+
+        if not last:
+            for name in dirs:
+                path = os.path.join(root, name)
+                if segment.special:
+                    self._find(index, path, True, results)
+                self._find(index + 1, path, False, results)
+
+
+_compiled_patterns = {}
+
+def compile_pattern(pattern):
     """
+    Return compiled pattern. Patterns are compiled once per process.
+
     Parameters:
-        graph <DependencyGraph>
+        pattern <str>
+    Return:
+        <PathPattern>
+    """
+    if not pattern in _compiled_patterns:
+        _compiled_patterns[pattern] = PathPattern(pattern)
+    return _compiled_patterns[pattern]
 
+
+def read_dir(dir):
+    """
+    Return list of (name, is directory) of the directory entries. Entry
+    types from scandir are used when available so no stat per entry is
+    needed.
+
+    Parameters:
+        dir <str> - absolute path to the directory
     Return:
-        list
+        <list>
     """
-    sorted_nodes = map(lambda n: n.get_name(), graph.remove_isolated_nodes())
+    stats.count("directories_listed")
+    if scandir != None:
+        return [(entry.name, entry.is_dir()) for entry in scandir(dir)]
+    return [(name, os.path.isdir(os.path.join(dir, name))) for name in
+            os.listdir(dir)]
 
-    while graph.has_nodes_with_no_incoming_edge():
-        a = graph.nodes_with_no_incoming_edge()[0]
-        sorted_nodes.append(a.get_name())
 
-        for node in reversed(a.get_outgoing_edges()):
-            removed_nodes = map(lambda n: n.get_name(),
-                                graph.remove_edge(a, node))
+class SourceIndex(object):
+    """
+    In-memory index of directory listings. Listing is valid as long as the
+    directory has the same mtime (and inode), so only one stat per
+    directory is needed to reuse it.
+
+    Only names and types of the entries are kept - content changes don't
+    change mtime of the directory, so file sizes and mtimes are always
+    read from the file system.
+
+    Listing taken less than RACY_SECONDS after the directory was modified
+    isn't reused, because the directory could be changed again within the
+    mtime resolution.
+    """
+    RACY_SECONDS = 1.0
+
+    def __init__(self):
+        self.entries = {}
 
-            if a.get_name() in removed_nodes:
-                removed_nodes.remove(a.get_name())
-            sorted_nodes.extend(removed_nodes)
+    def list(self, dir, stat=None):
+        """
+        Parameters:
+            dir <str> - absolute path to the directory
+            stat - result of os.stat(dir) if already known
+        Return:
+            <list> - (name, is directory) tuples
+        """
+        if stat == None:
+            stat = os.stat(dir)
+        signature = (stat.st_mtime, stat.st_ino)
+        entry = self.entries.get(dir)
+        if entry != None and entry[0] == signature:
+            stats.count("source_index_hits")
+            return entry[1]
+        stats.count("source_index_misses")
+        listed_at = time.time()
+        entries = read_dir(dir)
+        if listed_at - stat.st_mtime > self.RACY_SECONDS:
+            self.entries[dir] = (signature, entries)
+        else:
+            self.entries.pop(dir, None)
+        return entries
+
+    def clear(self):
+        self.entries.clear()
+
+
+SOURCE_INDEX = SourceIndex()
+
+def list_dir(dir, stat=None):
+    """
+    Return list of (name, is directory) of the directory entries. Listings
+    are taken from SOURCE_INDEX unless CSS_BUILDER_SOURCE_INDEX is False.
+
+    Parameters:
+        dir <str> - absolute path to the directory
+        stat - result of os.stat(dir) if already known
+    Return:
+        <list>
+    """
+    if getattr(settings, "CSS_BUILDER_SOURCE_INDEX", True):
+        return SOURCE_INDEX.list(dir, stat)
+    return read_dir(dir)
 
-    if graph.has_edge():
-        raise Exception(
-            "topological_sorting", "Dependency graph has at least one cycle")
-    else:
-        sorted_nodes.reverse()
-        return sorted_nodes
 
 def match(pattern, name, root):
     """
@@ -194,16 +421,9 @@ def match(pattern, name, root):
     Return:
         bool
     """
-    if is_regexp(pattern):
-        if is_special_regexp(pattern):
-            if os.path.isdir(os.path.join(root, name)):
-                return True
-            else:
-                return False
-        else:
-            return re.match(pattern, name) != None
-    else:
-        return pattern == name
+    segment = PatternSegment(pattern)
+    return segment.matches(name, segment.special and
+                           os.path.isdir(os.path.join(root, name)))
 
 def find_in_dir(pattern, dir, only_dirs = False, only_files = False):
     """
@@ -217,17 +437,17 @@ def find_in_dir(pattern, dir, only_dirs = False, only_files = False):
     Return:
         tuple - ([files], [directories])
     """
-    files = map(lambda x: (x, os.path.join(dir, x)), os.listdir(dir))
+    segment = compile_pattern(pattern).segments[0]
     results = ([], [])
 
-    for name, path in files:
-        if os.path.isdir(path) and not only_files:
-            if match(pattern, name, dir):
+    for name, is_dir in list_dir(dir):
+        if is_dir and not only_files:
+            if segment.matches(name, True):
                 results[1].append(name)
         else:
             if only_dirs:
                 continue
-            if match(pattern, name, dir):
+            if segment.matches(name, is_dir):
                 results[0].append(name)
 
     return results
@@ -244,29 +464,91 @@ def find(pattern, root):
     Return:
         list - absolute paths
     """
-    sections = pattern.split("/")
-    results = []
-
-    if len(sections) > 1:
-        only_dirs = True
-    else:
-        only_dirs = False
+    return compile_pattern(pattern).find(root)
 
-    if sections[0] == "***":
-        results += find("/".join(sections[1:]), root)
-        sections[0] = "**"
-
-    files, dirs = find_in_dir(sections[0], root, only_dirs = only_dirs)
-    results += map(lambda file: os.path.join(root, file), files)
+def discover(groups, root):
+    """
+    Find files matching patterns of all groups (e.g. packages and sprites)
+    in one walk of the directory tree.
 
-    if len(sections) > 1:
-        for dir in dirs:
-            if is_special_regexp(sections[0]):
-                results += find("/".join(sections), os.path.join(root, dir))
-            results += find("/".join(sections[1:]), os.path.join(root, dir))
+    Every visited directory is listed once and all patterns are evaluated
+    against its entries together. Directory is entered with the set of
+    (pattern, segment index, downgraded ***) states which matched the path
+    to it. Directories which are already on the walked path (symlink loops)
+    are skipped.
 
+    Parameters:
+        groups <dict> - key -> list of patterns
+        root <str> - absolute path to the directory
+    Return:
+        <dict> - key -> list of absolute paths without duplicates; files of
+                 the first pattern come first, files matching one pattern
+                 are sorted
+    """
+    patterns = []
+    for key in groups:
+        for pattern in groups[key]:
+            patterns.append(compile_pattern(pattern))
+    matches = [set() for pattern in patterns]
+    states = set((i, 0, False) for i in range(len(patterns)))
+    stat = os.stat(root)
+    _discover(patterns, matches, root, stat, states,
+              set([(stat.st_dev, stat.st_ino)]))
+
+    results = {}
+    i = 0
+    for key in groups:
+        files = []
+        seen = set()
+        for pattern in groups[key]:
+            for path in sorted(matches[i]):
+                if not path in seen:
+                    seen.add(path)
+                    files.append(path)
+            i += 1
+        results[key] = files
     return results
 
+def _discover(patterns, matches, dir, dir_stat, states, ancestors):
+    # "***" matches nothing too, so the rest of the pattern is tried in
+    # the same directory
+    states = set(states)
+    pending = list(states)
+    while pending:
+        i, index, downgraded = pending.pop()
+        segments = patterns[i].segments
+        if segments[index].optional and not downgraded and \
+                index < len(segments) - 1 and \
+                not (i, index + 1, False) in states:
+            states.add((i, index + 1, False))
+            pending.append((i, index + 1, False))
+
+    children = {}
+    for name, is_dir in list_dir(dir, dir_stat):
+        for i, index, downgraded in states:
+            segments = patterns[i].segments
+            segment = segments[index]
+            last = index == len(segments) - 1
+            if is_dir:
+                if not last and segment.matches(name, True):
+                    child = children.setdefault(name, set())
+                    if segment.special:
+                        child.add((i, index, True))
+                    child.add((i, index + 1, False))
+            elif last and segment.matches(name, False):
+                matches[i].add(os.path.join(dir, name))
+
+    for name in sorted(children):
+        path = os.path.join(dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if (stat.st_dev, stat.st_ino) in ancestors:
+            continue
+        _discover(patterns, matches, path, stat, children[name],
+                  ancestors | set([(stat.st_dev, stat.st_ino)]))
+
 def find_package_files(list, root):
     """
     Find all files required by package definitions.
@@ -276,78 +558,303 @@ def find_package_files(list, root):
     Params:
         list <list> - list of regular expressions or names
     Return:
-        list - absolute paths to the files
+        list - absolute paths to the files, without duplicates
     """
-    files = []
-    for item in list:
-        files += find(item, root)
-    return files
-
-def get_package_files(cfg, root):
-    files = find_package_files(cfg, settings.CSS_BUILDER_SOURCE)
-    dependencies = get_package_dependencies(map(lambda f: os.path.join(
-                                        root, f), files), root)
+    return discover({None: list}, root)[None]
+
+def get_package_files(cfg, root, cache=None):
+    with stats.stage("discovery"):
+        files = find_package_files(cfg, settings.CSS_BUILDER_SOURCE)
+    with stats.stage("dependencies"):
+        dependencies = get_package_dependencies(map(lambda f: os.path.join(
+                                            root, f), files), root, cache)
     return (get_unique_files(dependencies), dependencies,)
 
-def get_package_dependencies(files, root):
+def get_package_dependencies(files, root, cache=None):
     """
     Return all files needed to build the package
 
     Parameters:
         files <list> - list of absolute path to the files
+        cache <DependencyCache> - optional cache of parsed dependencies
     Return
-        list
+        dict
     """
     dependencies = {}
-    
+    required_by = {}
+    files = deque(files)
+    queued = set(files)
+
     while len(files) > 0:
-        fs = get_file_dependencies(files[0], root)
-        dependencies[files[0]] = fs
-        files.remove(files[0])
+        path = files.popleft()
+        try:
+            fs = get_file_dependencies(path, root, cache)
+        except OSError:
+            if not path in required_by:
+                raise
+            msg = "File %s which is required by %s cannot be found" %\
+                (path, required_by[path])
+            raise Exception("get_file_dependencies", msg)
+        dependencies[path] = fs
         for f in fs:
-            if not f in files and not dependencies.has_key(f):
+            if not f in queued:
+                queued.add(f)
+                required_by[f] = path
                 files.append(f)
     return dependencies
 
-def concatenate_package_files(output, dependencies):
+class PackageGraph(object):
     """
-    Concatenate files in the right order according to require declarations
+    Dependency graph of all packages. Patterns of all packages are resolved
+    in one walk and every file is parsed once, even if it is required by
+    many packages.
+    """
+    def __init__(self, packages, root, cache=None):
+        """
+        Parameters:
+            packages <dict> - package name -> list of patterns
+            root <str> - absolute path to the directory with source files
+            cache <DependencyCache> - optional cache of parsed dependencies
+        """
+        self.root = root
+        self.packages = packages
+        self.package_names = sorted(packages)
+        self.entries = discover(packages, root)
+        self.dependencies = {}
+        self.required_by = {}
+        self._common_files = {}
+        # files which can't be read or require missing files
+        self.errors = {}
+        # (mtime, size) of the files taken before they were parsed
+        self.states = {}
+
+        files = deque()
+        queued = set()
+        for package_name in self.package_names:
+            for path in self.entries[package_name]:
+                if not path in queued:
+                    queued.add(path)
+                    files.append(path)
+        while len(files) > 0:
+            path = files.popleft()
+            try:
+                stat = os.stat(path)
+                self.states[path] = (stat.st_mtime, stat.st_size)
+                fs = get_file_dependencies(path, root, cache)
+            except Exception, e:
+                self.errors[path] = e
+                continue
+            self.dependencies[path] = fs
+            for f in fs:
+                self.required_by.setdefault(f, set()).add(path)
+                if not f in queued:
+                    queued.add(f)
+                    files.append(f)
+
+    def is_current(self):
+        """
+        Check if packages still match the same files and no file was
+        modified since the graph was built. Graph with errors is never
+        current, e.g. the missing file may have been added.
+
+        Return:
+            <bool>
+        """
+        if len(self.errors) > 0:
+            return False
+        if discover(self.packages, self.root) != self.entries:
+            return False
+        for path, state in self.states.iteritems():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            if (stat.st_mtime, stat.st_size) != state:
+                return False
+        return True
+
+    def get_package_dependencies(self, package_name):
+        """
+        Return all files needed to build the package, see
+        get_package_dependencies
+
+        Parameters:
+            package_name <str>
+        Return:
+            <dict>
+        """
+        dependencies = {}
+        required_by = {}
+        files = deque(self.entries[package_name])
+        queued = set(files)
+
+        while len(files) > 0:
+            path = files.popleft()
+            if path in self.errors:
+                error = self.errors[path]
+                if isinstance(error, EnvironmentError) and \
+                    path in required_by:
+                    msg = "File %s which is required by %s cannot be found" %\
+                        (path, required_by[path])
+                    raise Exception("get_file_dependencies", msg)
+                raise error
+            fs = self.dependencies[path]
+            dependencies[path] = fs
+            for f in fs:
+                if not f in queued:
+                    queued.add(f)
+                    required_by[f] = path
+                    files.append(f)
+        return dependencies
+
+    def get_package_files(self, package_name, exclude=()):
+        """
+        Return files of the package and their dependencies, see
+        get_package_files
+
+        Parameters:
+            package_name <str>
+            exclude <set> - files left out of the package (e.g. files of
+                            the common package)
+        """
+        dependencies = self.get_package_dependencies(package_name)
+        if exclude:
+            dependencies = dict((path, [f for f in fs if not f in exclude])
+                                for path, fs in dependencies.iteritems() if
+                                not path in exclude)
+        return (get_unique_files(dependencies), dependencies,)
+
+    def common_files(self, min_packages):
+        """
+        Return files used by at least min_packages packages. File is common
+        only if all its dependencies are common too, so the common package
+        can be loaded before the other packages.
+
+        Parameters:
+            min_packages <int>
+        Return:
+            <set>
+        """
+        if not min_packages in self._common_files:
+            counts = {}
+            for package_name in self.package_names:
+                try:
+                    files = self.get_package_files(package_name)[0]
+                except Exception:
+                    continue
+                for path in files:
+                    counts[path] = counts.get(path, 0) + 1
+            common = set(path for path, count in counts.iteritems() if
+                         count >= min_packages)
+            changed = True
+            while changed:
+                changed = False
+                for path in list(common):
+                    for f in self.dependencies.get(path, ()):
+                        if not f in common:
+                            common.discard(path)
+                            changed = True
+                            break
+            self._common_files[min_packages] = common
+        return self._common_files[min_packages]
+
+    def get_common_package_files(self, min_packages):
+        """
+        Return files and dependencies of the common package, see
+        common_files
+        """
+        dependencies = dict((path, self.dependencies[path]) for path in
+                            self.common_files(min_packages))
+        return (get_unique_files(dependencies), dependencies,)
+
+    def affected_packages(self, path):
+        """
+        Return packages which use the file directly or through require
+        declarations
+
+        Parameters:
+            path <str> - absolute path to the source file
+        Return:
+            <list> - package names
+        """
+        affected = set([path])
+        pending = [path]
+        while pending:
+            for f in self.required_by.get(pending.pop(), ()):
+                if not f in affected:
+                    affected.add(f)
+                    pending.append(f)
+        return [package_name for package_name in self.package_names if
+                affected.intersection(self.entries[package_name])]
+
+def sort_package_files(dependencies):
+    """
+    Return files in the right order according to require declarations
 
     Parameters:
-        output <str>- absolute path to the output file
         dependencies <dict> - dependency dictionary
+    Return:
+        list
     """
     edges = []
     isolated_nodes = []
 
     for k in dependencies:
         if len(dependencies[k]) == 0:
-            isolated_nodes.append(GraphNode(k, [], []))
+            isolated_nodes.append(GraphNode(k))
         else:
             for node in dependencies[k]:
                 edges.append(GraphEdge(k, node))
 
     graph = DependencyGraph(edges, isolated_nodes)
-    sorted_files = topological_sorting(graph)
+    return topological_sorting(graph)
 
-    package_file = open(output, "w")
+def concatenate_files(files):
+    """
+    Return content of the files joined with new lines
 
-    for i in range(len(sorted_files)):
-        f = open(sorted_files[i], "r")
-        package_file.write(f.read())
-        if i != len(sorted_files) -1:
-            package_file.write("\n")
-        f.close()
-    package_file.close()
+    Parameters:
+        files <list> - absolute paths to the files
+    Return:
+        str
+    """
+    contents = []
+    for path in files:
+        with closing(open(path, "r")) as f:
+            contents.append(f.read())
+    return "\n".join(contents)
+
+def concatenate_package_files(output, dependencies):
+    """
+    Concatenate files in the right order according to require declarations
+
+    Parameters:
+        output <str>- absolute path to the output file
+        dependencies <dict> - dependency dictionary
+    """
+    content = concatenate_files(sort_package_files(dependencies))
+    with closing(open(output, "w")) as package_file:
+        package_file.write(content)
 
-def get_file_dependencies(path, root):
+def get_file_dependencies(path, root, cache=None):
     """
     Return file dependencies
 
     Parameters:
         path <string> -  absolute path to the file
         root <string> - absolute path to the directory with media files
+        cache <DependencyCache> - if given dependencies are taken from the
+                                  cache as long as the file wasn't modified
     """
+    if cache != None:
+        stat = os.stat(path)
+        results = cache.get(path, root, stat)
+        if results != None:
+            stats.count("dependency_cache_hits")
+            return results
+        stats.count("dependency_cache_misses")
+
+    stats.count("files_read")
     results = []
     f = open(path, "r")
     while True:
@@ -364,8 +871,29 @@ def get_file_dependencies(path, root):
             else:
                 results.append(absolute_path)
     f.close()
+
+    if cache != None:
+        cache.set(path, root, stat, results)
     return results
 
+def file_hash(path):
+    """
+    Return sha1 hex digest of the file content
+
+    Parameters:
+        path <str> - absolute path to the file
+    Return:
+        <str>
+    """
+    sha1 = hashlib.sha1()
+    with closing(open(path, "rb")) as f:
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
 def get_unique_files(dependencies):
     """
     Get unique files names from dependency dictionary
@@ -384,3 +912,171 @@ def get_unique_files(dependencies):
             if not item in files:
                 files.append(item)
     return files
+
+
+class DependencyCache(object):
+    """
+    Persistent cache of files dependencies ("// require" declarations).
+
+    Entries are keyed by the file path and are valid as long as mtime and
+    size of the file are the same as when the file was parsed and the file
+    is resolved against the same root path (the root directory itself isn't
+    checked), so checking an entry costs one stat and no reads.
+    """
+    VERSION = 1
+
+    def __init__(self, path=None):
+        """
+        Parameters:
+            path <str> - absolute path to the cache file or None for
+                         in-memory only cache
+        """
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if self.path == None or not os.path.exists(self.path):
+            return
+        try:
+            with closing(open(self.path, "rb")) as f:
+                data = cPickle.load(f)
+        except Exception:
+            # broken cache file will be overwritten during next save
+            return
+        if data.get("version") == self.VERSION:
+            self.entries = data.get("files", {})
+
+    def save(self):
+        if self.path == None or not self.dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with closing(os.fdopen(fd, "wb")) as f:
+            cPickle.dump({"version": self.VERSION, "files": self.entries}, f,
+                         cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+    def get(self, path, root, stat):
+        """
+        Return cached dependencies of the file or None
+
+        Parameters:
+            path <str> - absolute path to the file
+            root <str>
+            stat - result of os.stat(path)
+        """
+        entry = self.entries.get(path)
+        if entry == None:
+            return None
+        if entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size \
+            or entry["root"] != root:
+            return None
+        return entry["dependencies"]
+
+    def set(self, path, root, stat, dependencies):
+        self.entries[path] = {"mtime": stat.st_mtime, "size": stat.st_size,
+                              "root": root, "dependencies": dependencies}
+        self.dirty = True
+
+
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+UMASK = get_umask()
+
+
+@contextmanager
+def atomic_output(path):
+    """
+    Context manager returning path to the temporary file which is moved to
+    path (atomic rename) if the block succeeds and removed otherwise. Readers
+    of path see either the old or the complete new file.
+
+    Parameters:
+        path <str> - absolute path to the output file
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".%s." % name,
+                                    suffix=os.path.splitext(name)[1])
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.chmod(tmp_path, 0666 & ~UMASK)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_file_atomic(path, content):
+    """
+    Parameters:
+        path <str> - absolute path to the file
+        content <str>
+    """
+    with atomic_output(path) as tmp_path:
+        with closing(open(tmp_path, "wb")) as f:
+            f.write(content)
+
+
+class FileLock(object):
+    """
+    Inter-process lock based on flock. Lock does nothing on systems
+    without fcntl.
+    """
+    def __init__(self, path):
+        """
+        Parameters:
+            path <str> - absolute path to the lock file
+        """
+        self.path = path
+        self.file = None
+
+    def acquire(self, blocking=True):
+        """
+        Parameters:
+            blocking <bool> - wait for the lock if it is held by other process
+        Return:
+            <bool> - False if lock wasn't acquired
+        """
+        if fcntl == None:
+            return True
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by other process in the meantime
+                pass
+        self.file = open(self.path, "a")
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.file.fileno(), flags)
+        except IOError:
+            self.file.close()
+            self.file = None
+            return False
+        return True
+
+    def release(self):
+        if self.file != None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,95 @@
+import json
+from contextlib import closing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from css_builder.benchmark import (DEFAULT_CONFIG, STAGES, run_benchmark,
+                                   compare_results)
+
+
+class Command(BaseCommand):
+    """
+    Time the build pipeline on a generated source tree
+    """
+    help = "Generate a source tree, time every build stage cold and warm \
+and optionally compare results with a baseline."
+    option_list = BaseCommand.option_list + (
+        make_option("--files", dest="files", type="int",
+                    default=DEFAULT_CONFIG["files"],
+                    help="Number of css files"),
+        make_option("--depth", dest="depth", type="int",
+                    default=DEFAULT_CONFIG["depth"],
+                    help="Length of the longest require chain"),
+        make_option("--fan-out", dest="fan_out", type="int",
+                    default=DEFAULT_CONFIG["fan_out"],
+                    help="Number of require declarations per file"),
+        make_option("--nesting", dest="nesting", type="int",
+                    default=DEFAULT_CONFIG["nesting"],
+                    help="Depth of the directory tree"),
+        make_option("--packages", dest="packages", type="int",
+                    default=DEFAULT_CONFIG["packages"],
+                    help="Number of packages"),
+        make_option("--sprite-density", dest="sprite_density", type="float",
+                    default=DEFAULT_CONFIG["sprite_density"],
+                    help="Number of 2sprite rules per file"),
+        make_option("--b64-density", dest="b64_density", type="float",
+                    default=DEFAULT_CONFIG["b64_density"],
+                    help="Number of 2b64 rules per file"),
+        make_option("--icons", dest="icons", type="int",
+                    default=DEFAULT_CONFIG["icons"],
+                    help="Number of images in the sprite"),
+        make_option("--seed", dest="seed", type="int",
+                    default=DEFAULT_CONFIG["seed"],
+                    help="Seed of the tree generator"),
+        make_option("--repeat", dest="repeat", type="int", default=3,
+                    help="Number of warm runs, the best one is reported"),
+        make_option("--output", dest="output", default=None,
+                    help="Write results as JSON to this file"),
+        make_option("--compare", dest="compare", default=None,
+                    help="JSON file with baseline results"),
+        make_option("--threshold", dest="threshold", type="float",
+                    default=0.1,
+                    help="Allowed relative slowdown against the baseline"),
+    )
+
+    def handle(self, *args, **options):
+        config = dict((key, options[key]) for key in DEFAULT_CONFIG)
+        baseline = None
+        if options["compare"]:
+            try:
+                with closing(open(options["compare"])) as f:
+                    baseline = json.load(f)
+            except (IOError, ValueError), e:
+                raise CommandError("Cannot read baseline %s: %s" % (
+                        options["compare"], e))
+
+        results = run_benchmark(config, options["repeat"])
+        if options["output"]:
+            with closing(open(options["output"], "w")) as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        if baseline == None:
+            self.stdout.write("%-28s %10s %10s\n" % ("stage", "cold", "warm"))
+            for stage in STAGES:
+                timings = results["results"][stage]
+                self.stdout.write("%-28s %9.4fs %9.4fs\n" % (
+                        stage, timings["cold"], timings["warm"]))
+            return
+
+        regressions = 0
+        self.stdout.write("%-28s %-5s %10s %10s %8s\n" % (
+                "stage", "mode", "baseline", "current", "change"))
+        for stage, mode, old, new, regression in compare_results(
+                                    results, baseline, options["threshold"]):
+            change = (new - old) / old * 100 if old else 0.0
+            self.stdout.write("%-28s %-5s %9.4fs %9.4fs %+7.1f%%%s\n" % (
+                    stage, mode, old, new, change,
+                    " REGRESSION" if regression else ""))
+            regressions += regression
+        if baseline.get("config") != results["config"]:
+            self.stdout.write("Warning: baseline was run with a different \
+configuration\n")
+        if regressions:
+            raise CommandError("%d timings are more than %d%% slower than the \
+baseline" % (regressions, options["threshold"] * 100))
@@ -0,0 +1,73 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from css_builder import stats
+from css_builder.utils import (build_all_packages, build_package,
+                               check_basic_config)
+
+
+class Command(BaseCommand):
+    """
+    Build all packages from CSS_BUILDER_PACKAGES
+    """
+    args = "[package_name]"
+    help = "Build sprites and all packages from CSS_BUILDER_PACKAGES and \
+print time of every package build. With --profile only the given package is \
+built and its cProfile stats are written to the file."
+    option_list = BaseCommand.option_list + (
+        make_option("--jobs", "-j", dest="jobs", type="int", default=1,
+                    help="Number of processes building packages"),
+        make_option("--compress", dest="compress", action="store_true",
+                    default=False, help="Build compressed packages too"),
+        make_option("--force", dest="force", action="store_true",
+                    default=False, help="Build packages which are up to date"),
+        make_option("--stats", dest="stats", action="store_true",
+                    default=False,
+                    help="Print stages and counters of every build"),
+        make_option("--profile", dest="profile", default=None,
+                    help="Dump cProfile stats of the package build to file"),
+    )
+
+    def handle(self, *args, **options):
+        if not check_basic_config():
+            raise CommandError("css_builder configuration is not correct")
+        if options["jobs"] < 1:
+            raise CommandError("--jobs has to be a positive number")
+        last_id = stats.get_last_build_id()
+        start = time.time()
+        if options["profile"]:
+            if len(args) != 1 or not args[0] in settings.CSS_BUILDER_PACKAGES:
+                raise CommandError("--profile requires name of one package")
+            build_package(args[0], False, compress=options["compress"],
+                          force=True, profile=options["profile"])
+            timings = [(args[0], time.time() - start)]
+        elif args:
+            raise CommandError("Package name can be given only with --profile")
+        else:
+            timings = build_all_packages(jobs=options["jobs"],
+                                         compress=options["compress"],
+                                         force=options["force"])
+        total = time.time() - start
+
+        if options["stats"]:
+            for build in stats.get_build_stats():
+                if build["id"] > last_id:
+                    self.write_stats(build)
+        for package_name, seconds in sorted(timings, key=lambda t: -t[1]):
+            self.stdout.write("%-40s %8.3fs\n" % (package_name, seconds))
+        self.stdout.write("%-40s %8.3fs\n" % ("total (%d packages, %d jobs)"
+                                % (len(timings), options["jobs"]), total))
+        if options["profile"]:
+            self.stdout.write("Profile written to %s\n" % options["profile"])
+
+    def write_stats(self, build):
+        self.stdout.write("%s %s %.3fs\n" % (build["kind"], build["name"],
+                                            build["seconds"]))
+        for stage, seconds in sorted(build["stages"].items(),
+                                     key=lambda s: -s[1]):
+            self.stdout.write("    %-36s %8.3fs\n" % (stage, seconds))
+        for key, value in sorted(build["counters"].items()):
+            self.stdout.write("    %-36s %9d\n" % (key, value))
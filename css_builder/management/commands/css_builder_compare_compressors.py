@@ -0,0 +1,60 @@
+import os
+import time
+from contextlib import closing
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from css_builder.utils import (COMPRESSORS, build_package, check_basic_config,
+                               get_dest_dir)
+
+
+class Command(BaseCommand):
+    """
+    Compare compressors on built packages
+    """
+    help = "Compare size and time of css compressors on packages from \
+CSS_BUILDER_PACKAGES."
+    args = "[package_name ...]"
+    option_list = BaseCommand.option_list + (
+        make_option("--repeat", dest="repeat", type="int", default=3,
+                    help="Number of runs of every compressor per package"),
+        make_option("--compressor", dest="compressors", action="append",
+                    help="Compressor to compare (default: all)"),
+    )
+
+    def handle(self, *package_names, **options):
+        if not check_basic_config():
+            raise CommandError("css_builder configuration is not correct")
+        package_names = package_names or sorted(settings.CSS_BUILDER_PACKAGES)
+        compressors = options["compressors"] or sorted(COMPRESSORS)
+        for name in compressors:
+            if not name in COMPRESSORS:
+                raise CommandError("Unknown compressor: %s" % name)
+        repeat = max(options["repeat"], 1)
+
+        totals = dict((name, [0, 0.0]) for name in compressors)
+        self.stdout.write("%-30s %10s" % ("package", "input") + "".join(
+                    " %14s %9s" % (name + " size", "time") for name in
+                    compressors) + "\n")
+        for package_name in package_names:
+            build_package(package_name, False)
+            path = os.path.join(get_dest_dir(), package_name + ".css")
+            if not os.path.exists(path):
+                raise CommandError("Package %s wasn't built" % package_name)
+            with closing(open(path, "r")) as f:
+                content = f.read()
+            line = "%-30s %10d" % (package_name, len(content))
+            for name in compressors:
+                start = time.time()
+                for i in range(repeat):
+                    output = COMPRESSORS[name](content)
+                seconds = (time.time() - start) / repeat
+                totals[name][0] += len(output)
+                totals[name][1] += seconds
+                line += " %14d %8.3fs" % (len(output), seconds)
+            self.stdout.write(line + "\n")
+        self.stdout.write("%-30s %10s" % ("total", "") + "".join(
+                " %14d %8.3fs" % tuple(totals[name]) for name in compressors)
+                + "\n")
@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from css_builder.utils import get_upgrade_sql, SPRITE_STORES
+
+
+class Command(BaseCommand):
+    """
+    Add columns missing in tables created by older versions
+    """
+    help = "Add columns which were added to css_builder models after their \
+tables were created by syncdb. With --sql statements are only printed."
+    option_list = BaseCommand.option_list + (
+        make_option("--sql", dest="sql", action="store_true", default=False,
+                    help="Print statements instead of running them"),
+    )
+
+    def handle(self, *args, **options):
+        statements = get_upgrade_sql()
+        if options["sql"]:
+            for statement in statements:
+                self.stdout.write("%s\n" % statement)
+            return
+        if len(statements) == 0:
+            self.stdout.write("Database is up to date\n")
+            return
+        with transaction.commit_on_success():
+            cursor = connection.cursor()
+            for statement in statements:
+                cursor.execute(statement)
+                self.stdout.write("%s\n" % statement)
+            transaction.set_dirty()
+        SPRITE_STORES["models"].check_table()
@@ -0,0 +1,57 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from css_builder.utils import check_basic_config
+from css_builder.watcher import get_watcher, Rebuilder
+
+
+class Command(BaseCommand):
+    """
+    Watch CSS_BUILDER_SOURCE and embedded images and rebuild affected
+    packages and sprites
+    """
+    help = "Build all packages and rebuild packages and sprites affected by \
+changes in CSS_BUILDER_SOURCE or in the embedded images. Use with \
+CSS_BUILDER_BUILD_ON_RENDER = False."
+    option_list = BaseCommand.option_list + (
+        make_option("--compress", dest="compress", action="store_true",
+                    default=False, help="Build compressed packages too"),
+        make_option("--polling", dest="polling", action="store_true",
+                    default=False,
+                    help="Check mtimes instead of using inotify"),
+        make_option("--interval", dest="interval", type="float",
+                    default=None, help="Polling interval in seconds"),
+    )
+
+    def handle(self, *args, **options):
+        if not check_basic_config():
+            raise CommandError("css_builder configuration is not correct")
+        rebuilder = Rebuilder(compress=options["compress"])
+        watcher = get_watcher(settings.CSS_BUILDER_SOURCE,
+                              options["polling"], options["interval"])
+        packages = rebuilder.build_all()
+        self.stdout.write("Built %d packages, watching %s (%s)\n" % (
+                len(packages), settings.CSS_BUILDER_SOURCE,
+                watcher.__class__.__name__))
+        self.watch_images(rebuilder, watcher)
+        try:
+            for paths in watcher.changes():
+                sprites, packages = rebuilder.rebuild(paths)
+                for sprite_name in sprites:
+                    self.stdout.write("Rebuilt sprite %s\n" % sprite_name)
+                for package_name in packages:
+                    self.stdout.write("Rebuilt package %s\n" % package_name)
+                self.watch_images(rebuilder, watcher)
+        except KeyboardInterrupt:
+            pass
+
+    def watch_images(self, rebuilder, watcher):
+        """
+        Watch directories of images used by the packages (MEDIA_ROOT)
+        """
+        for path in rebuilder.image_directories():
+            if not path in watcher.directories:
+                watcher.watch_directory(path)
+                self.stdout.write("Watching images in %s\n" % path)
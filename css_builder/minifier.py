@@ -0,0 +1,126 @@
+"""
+Pure Python CSS minifier working on a stream of tokens.
+"""
+
+import re
+
+
+TOKENS = re.compile(r"""
+    (?P<comment>/\*.*?\*/)
+    |(?P<string>"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')
+    |(?P<url>url\(\s*(?:"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|[^)]*?)\s*\))
+    |(?P<space>\s+)
+    |(?P<hash>\#[\w-]+)
+    |(?P<number>[+-]?(?:\d+\.?\d*|\.\d+)(?:%|[a-zA-Z]+)?)
+    |(?P<ident>-?[_a-zA-Z][\w-]*|@-?[_a-zA-Z][\w-]*)
+    |(?P<char>.)
+""", re.S | re.X | re.I)
+
+# at-rules which blocks contain rules instead of declarations
+GROUP_AT_RULES = ["@media", "@supports", "@document", "@-moz-document",
+                  "@keyframes", "@-webkit-keyframes", "@-moz-keyframes",
+                  "@-o-keyframes", "@-ms-keyframes"]
+
+ZERO_UNITS = re.compile(r"^[+-]?(?:0+\.?0*|\.0+)(?:px|em|ex|ch|rem|vw|vh|vmin|"
+                        r"vmax|cm|mm|in|pt|pc)$", re.I)
+LONG_COLOR = re.compile(r"^#([0-9a-f])\1([0-9a-f])\2([0-9a-f])\3$", re.I)
+
+# properties which values can't be touched (IE filters use 8-digit colors)
+RAW_PROPERTIES = ["filter", "-ms-filter"]
+# properties where zero without unit means something else (flex: 1 1 0 is
+# parsed as flex-grow and flex-shrink by some browsers), zero lengths inside
+# functions keep their units too because calc() requires them
+UNIT_PROPERTIES = ["flex", "-webkit-flex", "-ms-flex", "flex-basis",
+                   "-webkit-flex-basis"]
+
+RULES = "rules"
+DECLARATIONS = "declarations"
+
+NO_SPACE_AFTER = {RULES: "{};,:>~+(", DECLARATIONS: "{};,:("}
+NO_SPACE_BEFORE = {RULES: "{};,>~+)", DECLARATIONS: "{};,:)!"}
+
+
+def tokenize(css):
+    """
+    Split css into tokens
+
+    Parameters:
+        css <str>
+    Return:
+        generator of (<str>, <str>) - (token type, token value)
+    """
+    for matchobj in TOKENS.finditer(css):
+        yield matchobj.lastgroup, matchobj.group()
+
+
+def minify(css):
+    """
+    Remove whitespace and comments, shorten colors and zero lengths and
+    merge adjacent semicolons. Comments starting with /*! are kept.
+
+    Parameters:
+        css <str>
+    Return:
+        <str>
+    """
+    output = []
+    last = ""           # last emitted token
+    space = False       # whitespace or comment was skipped after last token
+    blocks = [RULES]
+    prelude = []        # tokens since last {, } or ;
+    property = None     # property of the current declaration
+    in_value = False
+    depth = 0           # open parentheses in the current value
+
+    for kind, value in tokenize(css):
+        if kind == "space" or (kind == "comment" and
+                               not value.startswith("/*!")):
+            space = True
+            continue
+
+        context = blocks[-1]
+        if kind == "char":
+            if value == "{":
+                if context == RULES and prelude and \
+                    prelude[0].lower() in GROUP_AT_RULES:
+                    blocks.append(RULES)
+                else:
+                    blocks.append(DECLARATIONS)
+            elif value == "}":
+                if len(blocks) > 1:
+                    blocks.pop()
+            elif value == ";" and last == ";":
+                space = False
+                continue
+            elif value == ":" and context == DECLARATIONS:
+                in_value = True
+            elif value == "(" and in_value:
+                depth += 1
+            elif value == ")" and depth > 0:
+                depth -= 1
+        elif context == DECLARATIONS and in_value and \
+            not property in RAW_PROPERTIES:
+            if kind == "hash":
+                value = LONG_COLOR.sub(r"#\1\2\3", value)
+            elif kind == "number" and ZERO_UNITS.match(value) and \
+                depth == 0 and not property in UNIT_PROPERTIES:
+                value = "0"
+
+        if space and last and not last[-1] in NO_SPACE_AFTER[context] and \
+            not value[0] in NO_SPACE_BEFORE[context]:
+            output.append(" ")
+        space = False
+        output.append(value)
+        last = value
+
+        if kind == "char" and value in "{};":
+            prelude = []
+            property = None
+            in_value = False
+            depth = 0
+        else:
+            if not prelude and kind == "ident":
+                property = value.lower()
+            prelude.append(value)
+
+    return "".join(output)
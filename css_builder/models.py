@@ -19,6 +19,10 @@ class SpriteImage(models.Model):
     path = models.CharField(max_length=200, primary_key=True)
     x = models.IntegerField()
     y = models.IntegerField()
+    # size of the image when the sprite was built, NULL in sprites built
+    # before sizes were stored
+    width = models.IntegerField(null=True)
+    height = models.IntegerField(null=True)
 
     def __unicode__(self):
         return "%s %d %d" % (self.path, self.x, self.y,)
@@ -0,0 +1,126 @@
+"""
+Packing of sprite images into one sheet.
+
+Rectangles are placed by the skyline bottom-left algorithm: the sheet is
+described by its skyline (top edges of the placed rectangles) and every
+rectangle, from the tallest one, is put where its top edge ends lowest.
+If the sheet width isn't given, a few widths around the square root of the
+total area are tried and the smallest sheet is used.
+
+Result depends only on the sizes and their order, so the same images give
+the same layout.
+"""
+
+import math
+
+
+def skyline_pack(sizes, width):
+    """
+    Pack rectangles into a sheet of the given width
+
+    Parameters:
+        sizes <list> - (width, height) tuples, no width can exceed the
+                       sheet width
+        width <int> - sheet width
+    Return:
+        (<list>, <int>, <int>) - (x, y) positions in order of sizes, used
+                                 width and height
+    """
+    # segments [x, y, width] covering the whole sheet width
+    skyline = [[0, 0, width]]
+    positions = [None] * len(sizes)
+    order = sorted(range(len(sizes)),
+                   key=lambda i: (-sizes[i][1], -sizes[i][0], i))
+    used_width = 0
+    used_height = 0
+
+    for i in order:
+        w, h = sizes[i]
+        best = None
+        for start in range(len(skyline)):
+            x = skyline[start][0]
+            if x + w > width:
+                break
+            y = 0
+            end = start
+            covered = 0
+            while covered < w:
+                y = max(y, skyline[end][1])
+                covered += skyline[end][2]
+                end += 1
+            if best == None or (y + h, x) < best[0]:
+                best = ((y + h, x), start, end, x, y)
+        key, start, end, x, y = best
+        positions[i] = (x, y)
+        used_width = max(used_width, x + w)
+        used_height = max(used_height, y + h)
+
+        # replace covered segments, the last one can be covered partially
+        last = skyline[end - 1]
+        last_end = last[0] + last[2]
+        segments = [[x, y + h, w]]
+        if last_end > x + w:
+            segments.append([x + w, last[1], last_end - x - w])
+        skyline[start:end] = segments
+        # merge neighbours with the same height
+        merged = [skyline[0]]
+        for segment in skyline[1:]:
+            if segment[1] == merged[-1][1]:
+                merged[-1][2] += segment[2]
+            else:
+                merged.append(segment)
+        skyline = merged
+    return positions, used_width, used_height
+
+
+def pack_rectangles(sizes, padding=0, max_width=None):
+    """
+    Pack rectangles into the smallest sheet found
+
+    Parameters:
+        sizes <list> - (width, height) tuples
+        padding <int> - space between rectangles
+        max_width <int> - maximal sheet width (widest rectangle is used if
+                          it is wider)
+    Return:
+        (<list>, <int>, <int>) - (x, y) positions in order of sizes, sheet
+                                 width and height
+    """
+    if len(sizes) == 0:
+        return [], 0, 0
+    # padding is added to the right and bottom of every rectangle and
+    # removed from the sheet edges
+    padded = [(w + padding, h + padding) for w, h in sizes]
+    widest = max(w for w, h in padded)
+    if max_width != None:
+        widths = [max(widest, max_width + padding)]
+    else:
+        side = math.sqrt(sum(w * h for w, h in padded))
+        widths = sorted(set([widest] + [max(widest, int(math.ceil(side * f)))
+                        for f in (0.75, 1.0, 1.25, 1.5, 2.0)]))
+    best = None
+    for width in widths:
+        positions, used_width, used_height = skyline_pack(padded, width)
+        # the squarer sheet of the same area is preferred
+        key = (used_width * used_height, max(used_width, used_height),
+               used_width)
+        if best == None or key < best[0]:
+            best = (key, positions, used_width, used_height)
+    key, positions, used_width, used_height = best
+    return positions, used_width - padding, used_height - padding
+
+
+def packing_efficiency(sizes, width, height):
+    """
+    Return area of the rectangles divided by the sheet area
+
+    Parameters:
+        sizes <list> - (width, height) tuples
+        width <int>
+        height <int>
+    Return:
+        <float>
+    """
+    if width * height == 0:
+        return 0.0
+    return float(sum(w * h for w, h in sizes)) / (width * height)
@@ -0,0 +1,208 @@
+"""
+Instrumentation of package and sprite builds.
+
+Every build_package and build_css_sprite call is collected as BuildStats -
+wall time per stage, counters like bytes_read, bytes_written, files_read,
+files_written and <cache>_hits/<cache>_misses. Finished builds are kept in
+memory (CSS_BUILDER_STATS_HISTORY, default 100) and sent with the
+build_finished signal:
+
+    def on_build(sender, kind, name, stats, **kwargs):
+        print kind, name, stats["seconds"], stats["stages"]
+    build_finished.connect(on_build)
+
+Stages may be nested (e.g. base64 inside embedding_images) so their times
+don't have to add up to the total.
+"""
+
+import cProfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.dispatch import Signal
+
+
+build_started = Signal(providing_args=["kind", "name"])
+build_finished = Signal(providing_args=["kind", "name", "stats"])
+
+
+class BuildStats(object):
+    """
+    Stage timings and counters of one build
+    """
+    def __init__(self, kind, name):
+        """
+        Parameters:
+            kind <str> - "package" or "sprite"
+            name <str>
+        """
+        self.kind = kind
+        self.name = name
+        self.stages = {}
+        self.counters = {}
+        self.seconds = 0.0
+
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def count(self, key, n=1):
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def as_dict(self):
+        return {"kind": self.kind, "name": self.name, "seconds": self.seconds,
+                "stages": dict(self.stages), "counters": dict(self.counters)}
+
+
+_local = threading.local()
+_history = deque()
+_last_id = [0]
+COUNTERS = {}
+
+
+def _active():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def record_build_stats(stats):
+    """
+    Add finished build to the history
+
+    Parameters:
+        stats <dict> - result of BuildStats.as_dict
+    Return:
+        <dict> - stats with unique id
+    """
+    _last_id[0] += 1
+    stats = dict(stats, id=_last_id[0])
+    _history.append(stats)
+    while len(_history) > getattr(settings, "CSS_BUILDER_STATS_HISTORY", 100):
+        _history.popleft()
+    return stats
+
+
+@contextmanager
+def collect(kind, name):
+    """
+    Collect stats of the build. Collections may be nested, e.g. sprite
+    built during a package build; counters and stage times are added to
+    all active collections.
+
+    Parameters:
+        kind <str> - "package" or "sprite"
+        name <str>
+    """
+    stats = BuildStats(kind, name)
+    build_started.send(sender=BuildStats, kind=kind, name=name)
+    stack = _active()
+    stack.append(stats)
+    start = time.time()
+    try:
+        yield stats
+    finally:
+        stats.seconds = time.time() - start
+        stack.remove(stats)
+        result = record_build_stats(stats.as_dict())
+        build_finished.send(sender=BuildStats, kind=kind, name=name,
+                            stats=result)
+
+
+def add_time(stage, seconds):
+    """
+    Add time spent in the stage to active builds
+    """
+    for stats in _active():
+        stats.add_time(stage, seconds)
+
+
+@contextmanager
+def stage(name):
+    """
+    Measure time spent in the block as the stage of active builds
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_time(name, time.time() - start)
+
+
+def count(key, n=1):
+    """
+    Increment counter of active builds and the process-wide counter
+    """
+    COUNTERS[key] = COUNTERS.get(key, 0) + n
+    for stats in _active():
+        stats.count(key, n)
+
+
+def get_build_stats(kind=None, name=None):
+    """
+    Return stats of the recent builds, oldest first
+
+    Parameters:
+        kind <str> - "package" or "sprite", all builds if not given
+        name <str>
+    Return:
+        <list> - dictionaries with kind, name, seconds, stages and counters
+    """
+    return [stats for stats in _history if
+            (kind == None or stats["kind"] == kind) and
+            (name == None or stats["name"] == name)]
+
+
+def get_last_build_id():
+    return _last_id[0]
+
+
+def get_counters():
+    """
+    Return process-wide counters (not limited by the history size)
+    """
+    return dict(COUNTERS)
+
+
+def get_hit_rate(cache_name):
+    """
+    Return hit rate of the cache from process-wide counters
+
+    Parameters:
+        cache_name <str> - e.g. "fragment_cache" or "dependency_cache"
+    Return:
+        <float> or None if the cache wasn't used
+    """
+    hits = COUNTERS.get(cache_name + "_hits", 0)
+    misses = COUNTERS.get(cache_name + "_misses", 0)
+    if hits + misses == 0:
+        return None
+    return float(hits) / (hits + misses)
+
+
+def reset_stats():
+    _history.clear()
+    COUNTERS.clear()
+
+
+@contextmanager
+def profile(path):
+    """
+    Run the block under cProfile and dump the profile to the file, which
+    can be read with pstats or e.g. snakeviz.
+
+    Parameters:
+        path <str> - if None the block isn't profiled
+    """
+    if path == None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -6,7 +6,9 @@ from django import template
 from django.conf import settings
 
 from css_builder.utils import (build_css_sprite, add_embedding_images,
-                               cut_path, build_package, log, add_css_sprites)
+                               cut_path, build_package, log, add_css_sprites,
+                               build_on_render, package_url,
+                               get_common_package, get_package_graph)
 
 
 register = template.Library()
@@ -32,36 +34,75 @@ def css_file(parser, token):
     return CssFileNode(package_name[1:-1])
 
 
+def get_page_state(context):
+    """
+    Return dictionary shared by all css_package tags of the page. Values in
+    render_context are visible only in the current template, not in the
+    included ones, so the first (never popped) dictionary is used.
+    """
+    return context.render_context.dicts[0].setdefault("css_builder", {})
+
+
 class CssPackageNode(template.Node):
 
     def __init__(self, package_name):
         self.package_name = str(package_name)
 
     def render(self, context):
+        package_names = [self.package_name]
+        # the common package is linked once per page, before the packages
+        common = get_common_package()
+        state = get_page_state(context)
+        if common != None and not state.get("common_package_linked"):
+            state["common_package_linked"] = True
+            package_names.insert(0, common[0])
+        return "\n".join([self.render_package(package_name, context) for
+                          package_name in package_names])
+
+    def build_package(self, package_name, context, **options):
+        """
+        Build package, packages of one page share the dependency graph
+        when the common package is used
+        """
+        if get_common_package() != None:
+            state = get_page_state(context)
+            if not "graph" in state:
+                state["graph"] = get_package_graph()
+            options["graph"] = state["graph"]
+        build_package(package_name, freshness="stat", **options)
+
+    def render_package(self, package_name, context):
         compressed_package = '<link rel="stylesheet" type="text/css" \
-href="%s-min.css" />' % (settings.MEDIA_URL + self.package_name)
+href="%s-min.css" />' % (settings.MEDIA_URL + package_name)
 
-        # If settings.DEBUG is False then build_package won't be run
+        # If settings.DEBUG is False then build_package won't be run and
+        # fingerprinted package from the static manifest is used
         if settings.DEBUG == False:
-            return compressed_package
+            return '<link rel="stylesheet" type="text/css" href="%s" />' % \
+                package_url(package_name)
+        build = build_on_render()
 
         uncompressed_package = '<link rel="stylesheet" type="text/css" \
-href="%s.css" />' % (settings.MEDIA_URL + self.package_name)
+href="%s.css" />' % (settings.MEDIA_URL + package_name)
 
         if "request" in context:
             compress = context["request"].GET.get("css_compress", "0")
             if compress == "1":
-                build_package(self.package_name, compress=True)
+                if build:
+                    self.build_package(package_name, context, compress=True)
                 return compressed_package
             elif compress == "0":
-                build_package(self.package_name)
+                if build:
+                    self.build_package(package_name, context)
                 return uncompressed_package
 
         if hasattr(settings, "CSS_BUILDER_COMPRESS"):
             if getattr(settings, "CSS_BUILDER_COMPRESS"):
-                build_package(self.package_name, compress=True)
+                if build:
+                    self.build_package(package_name, context, compress=True)
                 return compressed_package
-        build_package(self.package_name)
+        if build:
+            self.build_package(package_name, context)
         return uncompressed_package
 
 
@@ -79,12 +120,12 @@ class CssFileNode(template.Node):
             msg = '%s (%s) does not exists.' % (self.path, input_abspath)
             log('css_file', msg)
             return '<!--\n%s\n-->' % msg
-        if self.dir_path != '':
-            os.makedirs(os.path.join(settings.MEDIA_ROOT, self.dir_path))
-
         output_abspath = os.path.join(settings.MEDIA_ROOT, self.path)
 
-        if settings.DEBUG == True:
+        if settings.DEBUG == True and build_on_render():
+            output_dir = os.path.join(settings.MEDIA_ROOT, self.dir_path)
+            if not os.path.isdir(output_dir):
+                os.makedirs(output_dir)
             add_embedding_images(input_abspath, output_abspath)
             add_css_sprites(output_abspath)
         url = os.path.join(settings.MEDIA_URL, self.path)
@@ -5,14 +5,22 @@
 # TODO: during tests change log file
 #
 
+import gzip
+import hashlib
+import json
 import os
+import random
 import shutil
 import re
 import time
+from cStringIO import StringIO
 
+import Image
 from django.test import TestCase
 from django.conf import settings
 from django import template
+from django.core.management import call_command
+from django.db import connection
 from django.http import HttpRequest
 
 from css_builder.utils import (add_embedding_images, add_css_sprites, here,
@@ -22,8 +30,30 @@ from css_builder.utils import (add_embedding_images, add_css_sprites, here,
                                build_css_sprite, ImageFile, SpriteImageFile,
                                css_sprite_is_up_to_date, text_2_b64,
                                found_css_sprite, create_css_sprite_file,
-                               get_sprite_format, IMAGE_FORMATS)
+                               get_sprite_format, IMAGE_FORMATS,
+                               BuildPipeline, package_needs_rebuilding,
+                               read_build_manifest,
+                               FragmentBuilder, FragmentCache, get_lock,
+                               reset_static_manifest, write_output,
+                               invalidate_sprite_index, get_sprite_index,
+                               get_affected_packages, build_all_packages,
+                               read_image_header, IMAGE_METADATA,
+                               css_sprites, SPRITE_STORES,
+                               invalidate_package_graph, USER_STAGES,
+                               read_sprite_layout, get_upgrade_sql)
 from css_builder.tests_utils import SettingsTestCase, check_last_log
+from css_builder.core_utils import (GraphEdge, GraphNode, DependencyGraph,
+                                    topological_sorting, DependencyCache,
+                                    get_package_dependencies, find, match,
+                                    compile_pattern, discover,
+                                    find_package_files, SourceIndex,
+                                    PackageGraph, get_package_files)
+from css_builder.minifier import minify
+from css_builder.packing import pack_rectangles, packing_efficiency
+from css_builder.stats import (build_finished, get_build_stats, get_hit_rate,
+                               get_counters)
+from css_builder.watcher import Rebuilder, PollingWatcher
+from css_builder.benchmark import STAGES
 from css_builder.models import SpriteImage, Sprite
 
 class UtilsTest(SettingsTestCase):
@@ -41,6 +71,11 @@ class UtilsTest(SettingsTestCase):
     def tearDown(self):
         super(UtilsTest, self).tearDown()
         shutil.rmtree(self.rootTestsDir)
+        reset_static_manifest()
+        invalidate_sprite_index()
+        IMAGE_METADATA.clear()
+        invalidate_package_graph()
+        SPRITE_STORES["files"].clear()
         for sprite in Sprite.objects.all():
             sprite.delete()
         for image in SpriteImage.objects.all():
@@ -326,13 +361,14 @@ definition. Available formats: %s' % ('wrong', 's1', IMAGE_FORMATS)))
         self.settings_manager.set(
                 MEDIA_ROOT=os.path.join(self.rootTestsDir, "dest"),
                 CSS_BUILDER_SOURCE=os.path.join(self.rootTestsDir, "source"),
-                CSS_BUILDER_SPRITES={"p1": {"files": [r".*\.jpg"]}})
+                CSS_BUILDER_SPRITES={"p1": {"files": [r".*\.jpg"],
+                                            "format": "jpg"}})
         os.mkdir(os.path.join(self.rootTestsDir, "source"))
         os.mkdir(os.path.join(self.rootTestsDir, "dest"))
         # sprite file does not exist
         self.failIf(css_sprite_is_up_to_date("p1"))
 
-        f = open(os.path.join(self.rootTestsDir, "dest", "p1"), "w")
+        f = open(os.path.join(self.rootTestsDir, "dest", "p1.JPG"), "w")
         f.close()
         # record in Sprite does not exist
         self.failIf(css_sprite_is_up_to_date("p1"))
@@ -350,7 +386,7 @@ definition. Available formats: %s' % ('wrong', 's1', IMAGE_FORMATS)))
         f.close()
         self.failIf(css_sprite_is_up_to_date("p1"))
         # update outuput sprite file
-        f = open(os.path.join(self.rootTestsDir, "dest", "p1"), "w")
+        f = open(os.path.join(self.rootTestsDir, "dest", "p1.JPG"), "w")
         f.close()
         # new file has been added
         f = open(os.path.join(self.rootTestsDir, "source", "b.jpg"), "w")
@@ -521,3 +557,923 @@ require b.css\n// require c.css")
         image_1 = SpriteImage.objects.get(path=self.image_a, sprite=sprite_2)
         self.failUnlessEqual(image_1.x, 60)
         self.failUnlessEqual(image_1.y, 80)
+
+    def test_topological_sorting(self):
+        graph = DependencyGraph([GraphEdge("a", "b"), GraphEdge("a", "c"),
+                                 GraphEdge("c", "b")], [GraphNode("d")])
+        self.failUnlessEqual(topological_sorting(graph), ["b", "c", "a", "d"])
+        # graph isn't modified by sorting
+        self.failUnlessEqual(topological_sorting(graph), ["b", "c", "a", "d"])
+
+        graph = DependencyGraph([GraphEdge("a", "b"), GraphEdge("b", "c"),
+                                 GraphEdge("c", "b")])
+        try:
+            topological_sorting(graph)
+        except Exception, e:
+            self.failUnlessEqual(e.args, ("topological_sorting",
+                            "Dependency graph has a cycle: b -> c -> b"))
+        else:
+            self.fail("Cycle wasn't detected")
+
+    def test_dependency_cache(self):
+        a_path = os.path.join(self.rootTestsDir, "a.css")
+        b_path = os.path.join(self.rootTestsDir, "b.css")
+        cache_path = os.path.join(self.rootTestsDir, "cache", "deps.pickle")
+        f = open(a_path, "w")
+        f.write("// require b.css\n")
+        f.close()
+        f = open(b_path, "w")
+        f.write("div#b {}")
+        f.close()
+        os.utime(a_path, (1000000000, 1000000000))
+        cache = DependencyCache(cache_path)
+        dependencies = {a_path: [b_path], b_path: []}
+        self.failUnlessEqual(get_package_dependencies([a_path],
+                                self.rootTestsDir, cache), dependencies)
+        cache.save()
+
+        # content changed but mtime and size are the same so a new process
+        # takes dependencies from the cache
+        stat = os.stat(a_path)
+        f = open(a_path, "w")
+        f.write("// require c.css\n")
+        f.close()
+        os.utime(a_path, (stat.st_atime, stat.st_mtime))
+        self.failUnlessEqual(get_package_dependencies([a_path],
+                self.rootTestsDir, DependencyCache(cache_path)), dependencies)
+
+        os.utime(a_path, (stat.st_atime, stat.st_mtime + 10))
+        self.failUnlessRaises(Exception, get_package_dependencies, [a_path],
+                              self.rootTestsDir, DependencyCache(cache_path))
+
+    def test_build_pipeline(self):
+        pipeline = BuildPipeline([("upper", lambda c: c.upper())])
+        pipeline.add_stage("strip", lambda c: c.strip())
+        self.failUnlessEqual(pipeline.run(" div#a {} "), "DIV#A {}")
+        self.failUnlessEqual([name for name, t in pipeline.timings],
+                             ["upper", "strip"])
+
+    def test_minify(self):
+        self.failUnlessEqual(minify("div#a { position: absolute; }"),
+                             "div#a{position:absolute;}")
+        self.failUnlessEqual(minify("/* c */ a , b > c :hover {\n\
+color : #AABBCC ;; margin: 0px 0.0em -0px 10px }"),
+            "a,b>c :hover{color:#ABC;margin:0 0 0 10px}")
+        self.failUnlessEqual(minify("@media screen and (max-width: 0px) { \
+#aabbcc { width: calc(1px + 2px) } }"),
+            "@media screen and (max-width:0px){#aabbcc{width:calc(1px + 2px)}}")
+        self.failUnlessEqual(minify("/*! keep */ a { content: \"/* x */\" }"),
+                             '/*! keep */ a{content:"/* x */"}')
+        # units of zero flex basis and zeros in calc() are required
+        self.failUnlessEqual(minify("a { flex: 1 1 0px; flex-basis: 0%; \
+width: calc(0px + 50%); margin: 0px }"),
+            "a{flex:1 1 0px;flex-basis:0%;width:calc(0px + 50%);margin:0}")
+
+    def test_package_needs_rebuilding(self):
+        source = os.path.join(self.rootTestsDir, "source")
+        os.mkdir(source)
+        os.mkdir(os.path.join(self.rootTestsDir, "dest"))
+        self.settings_manager.set(
+                CSS_BUILDER_PACKAGES={"p1": [r".*\.css"]},
+                MEDIA_ROOT=os.path.join(self.rootTestsDir, "dest"),
+                CSS_BUILDER_SOURCE=source)
+        a_path = os.path.join(source, "a.css")
+        f = open(a_path, "w")
+        f.write("div#a {}")
+        f.close()
+        os.utime(a_path, (1000000000, 1000000000))
+        self.failUnless(package_needs_rebuilding([a_path], "p1"))
+        build_package("p1")
+        self.failIf(package_needs_rebuilding([a_path], "p1"))
+
+        # file added since last building
+        b_path = os.path.join(source, "b.css")
+        f = open(b_path, "w")
+        f.close()
+        self.failUnless(package_needs_rebuilding([a_path, b_path], "p1"))
+        os.remove(b_path)
+
+        # content changed but size and mtime are the same
+        f = open(a_path, "w")
+        f.write("div#b {}")
+        f.close()
+        os.utime(a_path, (1000000000, 1000000000))
+        self.failIf(package_needs_rebuilding([a_path], "p1", "stat"))
+        self.failUnless(package_needs_rebuilding([a_path], "p1"))
+        build_package("p1")
+        self.failIf(package_needs_rebuilding([a_path], "p1"))
+
+        # file modified during the build, output has the old content
+        def modify(content):
+            f = open(a_path, "w")
+            f.write("div#c {}")
+            f.close()
+            return content
+        USER_STAGES.append(("modify", modify))
+        try:
+            build_package("p1", force=True)
+        finally:
+            USER_STAGES.remove(("modify", modify))
+        self.failUnless(package_needs_rebuilding([a_path], "p1", "stat"))
+        self.failUnless(package_needs_rebuilding([a_path], "p1"))
+        build_package("p1")
+        self.failIf(package_needs_rebuilding([a_path], "p1"))
+
+        # package definition changed
+        self.settings_manager.set(CSS_BUILDER_PACKAGES={"p1": ["a.css"]})
+        self.failUnless(package_needs_rebuilding([a_path], "p1"))
+
+    def test_fragment_builder(self):
+        self.settings_manager.set(
+                CSS_BUILDER_SOURCE=os.path.join(self.rootTestsDir, 'source'),
+                MEDIA_URL='/site_media/',
+                MEDIA_ROOT=os.path.join(self.rootTestsDir, 'dest'))
+        os.mkdir(settings.MEDIA_ROOT)
+        os.mkdir(settings.CSS_BUILDER_SOURCE)
+        image_path = os.path.join(settings.MEDIA_ROOT, 'a.png')
+        f = open(image_path, 'w')
+        f.write('abcdef')
+        f.close()
+        a_path = os.path.join(settings.CSS_BUILDER_SOURCE, 'a.css')
+        b_path = os.path.join(settings.CSS_BUILDER_SOURCE, 'b.css')
+        f = open(a_path, 'w')
+        f.write('background-image: url(/site_media/a.png); /* 2b64 */')
+        f.close()
+        f = open(b_path, 'w')
+        f.write('div#b {}')
+        f.close()
+
+        cache = FragmentCache()
+        builder = FragmentBuilder(cache)
+        content = builder.build([a_path, b_path])
+        self.failUnlessEqual(content, 'background-image: url("data:image/png;\
+base64,%s");\ndiv#b {}' % text_2_b64('abcdef'))
+        self.failUnlessEqual((builder.hits, builder.misses), (0, 2))
+
+        builder = FragmentBuilder(cache)
+        self.failUnlessEqual(builder.build([a_path, b_path]), content)
+        self.failUnlessEqual((builder.hits, builder.misses), (2, 0))
+
+        # only changed file is transformed again
+        f = open(b_path, 'w')
+        f.write('div#c {}')
+        f.close()
+        builder = FragmentBuilder(cache)
+        builder.build([a_path, b_path])
+        self.failUnlessEqual((builder.hits, builder.misses), (1, 1))
+
+        # embedded image has changed
+        f = open(image_path, 'w')
+        f.write('abcdefgh')
+        f.close()
+        builder = FragmentBuilder(cache)
+        self.failUnless(text_2_b64('abcdefgh') in
+                        builder.build([a_path, b_path]))
+        self.failUnlessEqual((builder.hits, builder.misses), (1, 1))
+
+    def test_rebuilder(self):
+        source = os.path.join(self.rootTestsDir, "source")
+        dest = os.path.join(self.rootTestsDir, "dest")
+        os.mkdir(source)
+        os.mkdir(dest)
+        self.settings_manager.set(
+                CSS_BUILDER_PACKAGES={"p1": [r"a.*\.css"], "p2": ["c.css"]},
+                CSS_BUILDER_SPRITES={},
+                MEDIA_ROOT=dest,
+                CSS_BUILDER_SOURCE=source)
+        for name in ["a1.css", "c.css"]:
+            f = open(os.path.join(source, name), "w")
+            f.write("div#%s {}" % name[0])
+            f.close()
+        rebuilder = Rebuilder()
+        self.failUnlessEqual(rebuilder.build_all(), ["p1", "p2"])
+
+        a2_path = os.path.join(source, "a2.css")
+        f = open(a2_path, "w")
+        f.write("div#a2 {}")
+        f.close()
+        self.failUnlessEqual(rebuilder.rebuild(set([a2_path])), ([], ["p1"]))
+        f = open(os.path.join(dest, "p1.css"), "r")
+        self.failUnless("div#a2 {}" in f.read())
+        f.close()
+
+        # removed file
+        os.remove(a2_path)
+        self.failUnlessEqual(rebuilder.rebuild(set([a2_path])), ([], ["p1"]))
+        self.failUnlessEqual(rebuilder.rebuild(
+                    set([os.path.join(source, "d.css")])), ([], []))
+
+        # embedded images are outside CSS_BUILDER_SOURCE
+        self.settings_manager.set(MEDIA_URL="/site_media/")
+        images = os.path.join(dest, "images")
+        os.mkdir(images)
+        image_path = os.path.join(images, "x.png")
+        shutil.copyfile(here(["tests_files", "a.png"]), image_path)
+        c_path = os.path.join(source, "c.css")
+        f = open(c_path, "w")
+        f.write("div#c { background-image: url(/site_media/images/x.png); \
+/* 2b64 */ }")
+        f.close()
+        rebuilder = Rebuilder()
+        rebuilder.build_all()
+        self.failUnlessEqual(rebuilder.image_directories(), [images])
+        watcher = PollingWatcher(source, 0)
+        watcher.watch_directory(images)
+        shutil.copyfile(here(["tests_files", "b.jpg"]), image_path)
+        self.failUnlessEqual(watcher.changes().next(), set([image_path]))
+        self.failUnlessEqual(rebuilder.rebuild(set([image_path])),
+                             ([], ["p2"]))
+        # outputs written to MEDIA_ROOT are ignored
+        self.failUnlessEqual(rebuilder.rebuild(
+                    set([os.path.join(dest, "p2.css")])), ([], []))
+
+    def test_css_package_without_building(self):
+        source_path = os.path.join(self.rootTestsDir, 'source')
+        dest_path = os.path.join(self.rootTestsDir, 'dest')
+        os.mkdir(source_path)
+        os.mkdir(dest_path)
+        self.settings_manager.set(
+                CSS_BUILDER_PACKAGES={'p1': ['.*\.css']},
+                CSS_BUILDER_SOURCE=source_path,
+                MEDIA_ROOT=dest_path,
+                MEDIA_URL='/site_media/',
+                DEBUG=True,
+                CSS_BUILDER_BUILD_ON_RENDER=False)
+        f = open(os.path.join(source_path, 'a.css'), 'w')
+        f.write('div#a { position: absolute; }')
+        f.close()
+        t = template.Template('{% load css_tags %}{% css_package "p1" %}')
+        self.failUnlessEqual(t.render(template.Context({})), '<link \
+rel="stylesheet" type="text/css" href="/site_media/p1.css" />')
+        self.failUnlessEqual(os.listdir(dest_path), [])
+
+    def test_build_package_lock(self):
+        source = os.path.join(self.rootTestsDir, "source")
+        dest = os.path.join(self.rootTestsDir, "dest")
+        os.mkdir(source)
+        os.mkdir(dest)
+        self.settings_manager.set(
+                CSS_BUILDER_PACKAGES={"p1": ["a.css"]},
+                CSS_BUILDER_CACHE_DIR=os.path.join(self.rootTestsDir, "cache"),
+                CSS_BUILDER_PRECOMPRESS=False,
+                MEDIA_ROOT=dest,
+                CSS_BUILDER_SOURCE=source)
+        f = open(os.path.join(source, "a.css"), "w")
+        f.write("div#a {}")
+        f.close()
+        build_package("p1")
+        self.failUnlessEqual(sorted(os.listdir(dest)),
+                             ["p1.css", "p1.manifest.json"])
+
+        f = open(os.path.join(source, "a.css"), "w")
+        f.write("div#b {}")
+        f.close()
+        # other process builds the package so the previous output is served
+        lock = get_lock("package-p1")
+        self.failUnless(lock.acquire())
+        build_package("p1")
+        lock.release()
+        f = open(os.path.join(dest, "p1.css"), "r")
+        self.failUnlessEqual(f.read(), "div#a {}")
+        f.close()
+
+        build_package("p1")
+        f = open(os.path.join(dest, "p1.css"), "r")
+        self.failUnlessEqual(f.read(), "div#b {}")
+        f.close()
+
+    def test_fingerprinted_package(self):
+        source_path = os.path.join(self.rootTestsDir, 'source')
+        dest_path = os.path.join(self.rootTestsDir, 'dest')
+        os.mkdir(source_path)
+        os.mkdir(dest_path)
+        self.settings_manager.set(
+                CSS_BUILDER_PACKAGES={'p1': ['a.css']},
+                CSS_BUILDER_SOURCE=source_path,
+                MEDIA_ROOT=dest_path,
+                MEDIA_URL='/site_media/',
+                DEBUG=False)
+        f = open(os.path.join(source_path, 'a.css'), 'w')
+        f.write('div#a { position: absolute; }')
+        f.close()
+        build_package('p1', compress=True)
+        name = 'p1.%s-min.css' % \
+            hashlib.md5('div#a{position:absolute;}').hexdigest()[:12]
+        f = open(os.path.join(dest_path, name), 'r')
+        self.failUnlessEqual(f.read(), 'div#a{position:absolute;}')
+        f.close()
+        f = open(os.path.join(dest_path, 'css_builder_manifest.json'), 'r')
+        self.failUnlessEqual(json.load(f), {'packages': {'p1': name}})
+        f.close()
+
+        t = template.Template('{% load css_tags %}{% css_package "p1" %}')
+        link = '<link rel="stylesheet" type="text/css" href="/site_media/%s" \
+/>' % name
+        self.failUnlessEqual(t.render(template.Context({})), link)
+        # manifest is kept in memory
+        os.remove(os.path.join(dest_path, 'css_builder_manifest.json'))
+        self.failUnlessEqual(t.render(template.Context({})), link)
+
+    def test_write_output(self):
+        path = os.path.join(self.rootTestsDir, "p1.css")
+        self.failUnless(write_output(path, "div#a {}"))
+        f = gzip.open(path + ".gz", "rb")
+        self.failUnlessEqual(f.read(), "div#a {}")
+        f.close()
+
+        # the same content - files aren't touched
+        os.utime(path, (1000000000, 1000000000))
+        os.utime(path + ".gz", (1000000000, 1000000000))
+        self.failIf(write_output(path, "div#a {}"))
+        self.failUnlessEqual(os.path.getmtime(path), 1000000000)
+        self.failUnlessEqual(os.path.getmtime(path + ".gz"), 1000000000)
+
+        self.failUnless(write_output(path, "div#b {}"))
+        f = gzip.open(path + ".gz", "rb")
+        self.failUnlessEqual(f.read(), "div#b {}")
+        f.close()
+
+    def test_build_stats(self):
+        source = os.path.join(self.rootTestsDir, "source")
+        dest = os.path.join(self.rootTestsDir, "dest")
+        os.mkdir(source)
+        os.mkdir(dest)
+        self.settings_manager.set(
+                CSS_BUILDER_PACKAGES={"p1": ["a.css"]},
+                CSS_BUILDER_CACHE_DIR=os.path.join(self.rootTestsDir, "cache"),
+                CSS_BUILDER_PRECOMPRESS=False,
+                MEDIA_ROOT=dest,
+                CSS_BUILDER_SOURCE=source)
+        f = open(os.path.join(source, "a.css"), "w")
+        f.write("div#a {}")
+        f.close()
+        finished = []
+        def on_build(sender, kind, name, stats, **kwargs):
+            finished.append((kind, name))
+        build_finished.connect(on_build)
+        try:
+            build_package("p1", profile=os.path.join(self.rootTestsDir,
+                                                     "p1.prof"))
+        finally:
+            build_finished.disconnect(on_build)
+        self.failUnlessEqual(finished, [("package", "p1")])
+        self.failUnless(os.path.exists(os.path.join(self.rootTestsDir,
+                                                    "p1.prof")))
+        build = get_build_stats("package", "p1")[-1]
+        for stage in ["discovery", "dependencies", "freshness", "sorting",
+                      "sprites", "embedding_images"]:
+            self.failUnless(stage in build["stages"])
+        self.failUnlessEqual(build["counters"]["bytes_read"], 8)
+        # package and its build manifest
+        self.failUnlessEqual(build["counters"]["files_written"], 2)
+        self.failUnlessEqual(build["counters"]["fragment_cache_misses"], 1)
+        self.failUnless(get_hit_rate("fragment_cache") != None)
+
+    def test_find(self):
+        for d in ["a", "a/b", "a/b/c"]:
+            os.mkdir(os.path.join(self.rootTestsDir, d))
+        for path in ["x.css", "a/x.css", "a/b/x.css", "a/b/c/y.css",
+                     "a/b/z.png"]:
+            open(os.path.join(self.rootTestsDir, path), "w").close()
+        root = self.rootTestsDir
+        rel = lambda paths: sorted(os.path.relpath(p, root) for p in paths)
+        self.failUnlessEqual(rel(find("x.css", root)), ["x.css"])
+        self.failUnlessEqual(rel(find(r"a/.*\.css", root)), ["a/x.css"])
+        self.failUnlessEqual(rel(find(r"**/x\.css", root)),
+                             ["a/b/x.css", "a/x.css"])
+        self.failUnlessEqual(rel(find(r"***/x\.css", root)),
+                             ["a/b/x.css", "a/x.css", "x.css"])
+        self.failUnlessEqual(rel(find(r"a/**/.*", root)),
+                             ["a/b/c/y.css", "a/b/x.css", "a/b/z.png"])
+        self.failUnlessEqual(find("**", root), [])
+        self.failUnless(compile_pattern("a/**") is compile_pattern("a/**"))
+        self.failUnless(match("**", "a", root))
+        self.failIf(match("**", "x.css", root))
+        self.failUnless(match(r"x\.", "x.css", root))
+        self.failIf(match("x.", "x.css", root))
+
+    def test_discover(self):
+        root = self.rootTestsDir
+        for d in ["a", "a/b"]:
+            os.mkdir(os.path.join(root, d))
+        for path in ["x.css", "a/x.css", "a/y.css", "a/b/x.css", "a/b/i.png"]:
+            open(os.path.join(root, path), "w").close()
+        # symlink loop is walked only once
+        os.symlink(root, os.path.join(root, "a", "b", "loop"))
+        abspaths = lambda paths: [os.path.join(root, p) for p in paths]
+        results = discover({"p1": [r"a/y\.css", r"***/x\.css", r"a/.*"],
+                            "s1": [r"**/.*\.png"], "empty": []}, root)
+        self.failUnlessEqual(results["p1"], abspaths(["a/y.css", "a/b/x.css",
+                                                      "a/x.css", "x.css"]))
+        self.failUnlessEqual(results["s1"], abspaths(["a/b/i.png"]))
+        self.failUnlessEqual(results["empty"], [])
+        self.failUnlessEqual(find_package_files([r"**/x\.css", r"a/x\.css"],
+                             root), abspaths(["a/b/x.css", "a/x.css"]))
+
+    def test_source_index(self):
+        root = self.rootTestsDir
+        open(os.path.join(root, "a.css"), "w").close()
+        os.utime(root, (1000000000, 1000000000))
+        index = SourceIndex()
+        counters = get_counters()
+        self.failUnlessEqual(index.list(root), [("a.css", False)])
+        self.failUnlessEqual(index.list(root), [("a.css", False)])
+        self.failUnlessEqual(get_counters()["source_index_hits"] -
+                             counters.get("source_index_hits", 0), 1)
+        self.failUnless(get_hit_rate("source_index") > 0)
+
+        # new entry changes mtime of the directory
+        os.mkdir(os.path.join(root, "b"))
+        os.utime(root, (1000000001, 1000000001))
+        self.failUnlessEqual(sorted(index.list(root)),
+                             [("a.css", False), ("b", True)])
+        # recently modified directory isn't cached
+        os.utime(root, None)
+        index.list(root)
+        self.failIf(root in index.entries)
+
+    def test_sprite_index(self):
+        source = os.path.join(self.rootTestsDir, "source")
+        os.mkdir(source)
+        for name in ["a.png", "b.png", "c.gif"]:
+            open(os.path.join(source, name), "w").close()
+        self.settings_manager.set(
+                CSS_BUILDER_SOURCE=source,
+                CSS_BUILDER_SPRITES={
+                    "s2": {"files": [r".*\.png"]},
+                    "s1": {"files": [r"b\.png", r"c\.gif"]}})
+        self.failUnlessEqual(get_sprite_index(), {
+                os.path.join(source, "a.png"): "s2",
+                os.path.join(source, "b.png"): "s1",
+                os.path.join(source, "c.gif"): "s1"})
+        self.failUnless(check_last_log("Image %s is claimed by sprites s1 and \
+s2, s1 is used" % os.path.join(source, "b.png")))
+
+        # index is kept until it is invalidated
+        open(os.path.join(source, "d.png"), "w").close()
+        self.failUnlessEqual(found_css_sprite(os.path.join(source, "d.png")),
+                             None)
+        invalidate_sprite_index()
+        self.failUnlessEqual(found_css_sprite(os.path.join(source, "d.png")),
+                             "s2")
+
+        # sprite build keeps the index if the sprite files are the same
+        dest = os.path.join(self.rootTestsDir, "dest")
+        icons = os.path.join(source, "icons")
+        os.mkdir(dest)
+        os.mkdir(icons)
+        for name in ["a.png", "b.png"]:
+            shutil.copyfile(here(["tests_files", "a.png"]),
+                            os.path.join(icons, name))
+        self.settings_manager.set(MEDIA_ROOT=dest, CSS_BUILDER_SPRITES={
+                "i1": {"files": [r"icons/a\.png"]},
+                "i2": {"files": [r"icons/[bc]\.png"]}})
+        get_sprite_index()
+        c_path = os.path.join(icons, "c.png")
+        shutil.copyfile(here(["tests_files", "a.png"]), c_path)
+        self.failUnless(build_css_sprite("i1"))
+        self.failUnlessEqual(found_css_sprite(c_path), None)
+        self.failUnless(build_css_sprite("i2"))
+        self.failUnlessEqual(found_css_sprite(c_path), "i2")
+
+    def test_inline_imports(self):
+        source = os.path.join(self.rootTestsDir, "source")
+        dest = os.path.join(self.rootTestsDir, "dest")
+        os.mkdir(source)
+        os.mkdir(dest)
+        os.mkdir(os.path.join(source, "sub"))
+        self.settings_manager.set(
+                CSS_BUILDER_PACKAGES={"p1": ["a.css"]},
+                CSS_BUILDER_CACHE_DIR=os.path.join(self.rootTestsDir, "cache"),
+                CSS_BUILDER_PRECOMPRESS=False,
+                MEDIA_URL="/site_media/",
+                MEDIA_ROOT=dest,
+                CSS_BUILDER_SOURCE=source)
+        files = {"a.css": "@charset \"utf-8\";\n@import \"sub/b.css\";\n\
+@import url('sub/b.css');\n@import url(c.css) print;\n\
+@import url(http://example.com/x.css);\ndiv#a {}",
+                 "sub/b.css": "@charset \"utf-8\";\n@import \"d.css\";\n\
+div#b { background: url(img/x.png); }",
+                 "sub/d.css": "div#d { background: url(\"../i.png?v=1\"); }",
+                 "c.css": "@import url(http://example.com/y.css);\ndiv#c {}"}
+        for name, content in files.items():
+            f = open(os.path.join(source, name), "w")
+            f.write(content)
+            f.close()
+        build_package("p1")
+        # remote import can't be moved out of @media
+        self.failUnless(check_last_log("@import \
+url(http://example.com/y.css); in %s is imported with media" %
+                                       os.path.join(source, "c.css")))
+        # remote imports are moved to the top, after @charset
+        f = open(os.path.join(dest, "p1.css"), "r")
+        self.failUnlessEqual(f.read(), "@charset \"utf-8\";\n\
+@import url(http://example.com/x.css);\n\
+div#d { background: url(\"i.png?v=1\"); }\n\
+div#b { background: url(sub/img/x.png); }\n\n\
+@media print {\n@import url(http://example.com/y.css);\ndiv#c {}\n}\n\n\
+div#a {}")
+        f.close()
+        manifest = read_build_manifest("p1")
+        self.failUnlessEqual(sorted(manifest["imports"]), [
+                os.path.join(source, "c.css"), os.path.join(source, "sub/b.css"),
+                os.path.join(source, "sub/d.css")])
+        self.failIf(package_needs_rebuilding([os.path.join(source, "a.css")],
+                                             "p1"))
+
+        # imported file has changed
+        f = open(os.path.join(source, "sub/d.css"), "w")
+        f.write("div#e {}")
+        f.close()
+        self.failUnless(package_needs_rebuilding(
+                [os.path.join(source, "a.css")], "p1"))
+        build_package("p1")
+        f = open(os.path.join(dest, "p1.css"), "r")
+        self.failUnless("x.css);\ndiv#e {}\ndiv#b" in f.read())
+        f.close()
+        # fragment from the cache
+        build_package("p1", force=True)
+        f = open(os.path.join(dest, "p1.css"), "r")
+        self.failUnless(f.read().startswith("@charset \"utf-8\";\n\
+@import url(http://example.com/x.css);\ndiv#e {}"))
+        f.close()
+
+    def test_package_graph(self):
+        source = self.rootTestsDir
+        self.settings_manager.set(CSS_BUILDER_SOURCE=source)
+        files = {"base.css": "div#base {}",
+                 "a.css": "// require base.css\ndiv#a {}",
+                 "b.css": "// require a.css\n// require base.css\ndiv#b {}",
+                 "c.css": "// require missing.css\ndiv#c {}"}
+        for name, content in files.items():
+            f = open(os.path.join(source, name), "w")
+            f.write(content)
+            f.close()
+        packages = {"p1": ["a.css"], "p2": ["b.css"], "p3": ["c.css"]}
+        files_read = get_counters().get("files_read", 0)
+        graph = PackageGraph(packages, source)
+        # every file is parsed once
+        self.failUnlessEqual(get_counters()["files_read"] - files_read, 4)
+        for package_name in ["p1", "p2"]:
+            self.failUnlessEqual(graph.get_package_files(package_name),
+                    get_package_files(packages[package_name], source))
+        self.failUnlessRaises(Exception, graph.get_package_files, "p3")
+        path = lambda name: os.path.join(source, name)
+        self.failUnlessEqual(graph.affected_packages(path("base.css")),
+                             ["p1", "p2"])
+        self.failUnlessEqual(graph.affected_packages(path("b.css")), ["p2"])
+        self.failUnlessEqual(graph.affected_packages(path("d.css")), [])
+        self.failUnlessEqual(get_affected_packages([path("a.css"),
+                             path("c.css")], graph), ["p1", "p2", "p3"])
+
+    def test_common_package(self):
+        source = os.path.join(self.rootTestsDir, "source")
+        dest = os.path.join(self.rootTestsDir, "dest")
+        os.mkdir(source)
+        os.mkdir(dest)
+        self.settings_manager.set(
+                CSS_BUILDER_PACKAGES={"p1": ["a.css"], "p2": ["b.css"],
+                                      "p3": ["c.css"]},
+                CSS_BUILDER_COMMON_PACKAGE={"min_packages": 2},
+                CSS_BUILDER_CACHE_DIR=os.path.join(self.rootTestsDir, "cache"),
+                CSS_BUILDER_PRECOMPRESS=False,
+                CSS_BUILDER_SPRITES={},
+                MEDIA_URL="/site_media/",
+                MEDIA_ROOT=dest,
+                CSS_BUILDER_SOURCE=source)
+        files = {"reset.css": "div#reset {}",
+                 "grid.css": "// require reset.css\ndiv#grid {}",
+                 "a.css": "// require grid.css\ndiv#a {}",
+                 "b.css": "// require grid.css\n// require reset.css\n\
+div#b {}",
+                 "c.css": "// require reset.css\ndiv#c {}"}
+        for name, content in files.items():
+            f = open(os.path.join(source, name), "w")
+            f.write(content)
+            f.close()
+        self.failUnlessEqual([name for name, seconds in build_all_packages()],
+                             ["common", "p1", "p2", "p3"])
+        outputs = {}
+        for name in ["common", "p1", "p2", "p3"]:
+            f = open(os.path.join(dest, name + ".css"), "r")
+            outputs[name] = f.read()
+            f.close()
+        self.failUnlessEqual(outputs, {"common": "div#reset {}\n\
+// require reset.css\ndiv#grid {}", "p1": "// require grid.css\ndiv#a {}",
+                "p2": "// require grid.css\n// require reset.css\ndiv#b {}",
+                "p3": "// require reset.css\ndiv#c {}"})
+
+        self.settings_manager.set(DEBUG=True, CSS_BUILDER_BUILD_ON_RENDER=False)
+        t = template.Template('{% load css_tags %}{% css_package "p1" %}\
+{% css_package "p2" %}')
+        self.failUnlessEqual(t.render(template.Context({})), '<link \
+rel="stylesheet" type="text/css" href="/site_media/common.css" />\n<link \
+rel="stylesheet" type="text/css" href="/site_media/p1.css" /><link \
+rel="stylesheet" type="text/css" href="/site_media/p2.css" />')
+        # the common package is linked once even with included templates
+        templates = os.path.join(self.rootTestsDir, "templates")
+        os.mkdir(templates)
+        f = open(os.path.join(templates, "p3.html"), "w")
+        f.write('{% load css_tags %}{% css_package "p3" %}')
+        f.close()
+        self.settings_manager.set(TEMPLATE_DIRS=(templates,))
+        t = template.Template('{% load css_tags %}{% include "p3.html" %}\
+{% css_package "p1" %}{% include "p3.html" %}')
+        self.failUnlessEqual(t.render(template.Context({})),
+                '<link rel="stylesheet" type="text/css" \
+href="/site_media/common.css" />\n<link rel="stylesheet" type="text/css" \
+href="/site_media/p3.css" /><link rel="stylesheet" type="text/css" \
+href="/site_media/p1.css" /><link rel="stylesheet" type="text/css" \
+href="/site_media/p3.css" />')
+
+        # packages of the page are built with one graph, which is kept
+        # while no file changes
+        self.settings_manager.set(CSS_BUILDER_BUILD_ON_RENDER=True)
+        misses = get_counters().get("package_graph_misses", 0)
+        t.render(template.Context({}))
+        t.render(template.Context({}))
+        self.failUnlessEqual(get_counters()["package_graph_misses"] - misses,
+                             0)
+        time.sleep(0.01)
+        f = open(os.path.join(source, "c.css"), "w")
+        f.write("// require reset.css\n// require grid.css\ndiv#c {}")
+        f.close()
+        t.render(template.Context({}))
+        self.failUnlessEqual(get_counters()["package_graph_misses"] - misses,
+                             1)
+        f = open(os.path.join(dest, "common.css"), "r")
+        self.failUnless("div#grid {}" in f.read())
+        f.close()
+
+    def test_pack_rectangles(self):
+        rnd = random.Random(0)
+        sizes = [(rnd.randint(1, 40), rnd.randint(1, 40)) for i in range(200)]
+        for padding, max_width in [(0, None), (2, None), (3, 100)]:
+            positions, width, height = pack_rectangles(sizes, padding,
+                                                       max_width)
+            self.failUnlessEqual((positions, width, height),
+                                 pack_rectangles(sizes, padding, max_width))
+            if max_width != None:
+                self.failUnless(width <= max_width)
+            rects = [(x, y, x + w, y + h) for (x, y), (w, h) in
+                     zip(positions, sizes)]
+            for i, (x1, y1, x2, y2) in enumerate(rects):
+                self.failUnless(x1 >= 0 and y1 >= 0 and x2 <= width and
+                                y2 <= height)
+                for (u1, v1, u2, v2) in rects[i + 1:]:
+                    self.failIf(x1 < u2 + padding and u1 < x2 + padding and
+                                y1 < v2 + padding and v1 < y2 + padding)
+        self.failUnless(packing_efficiency(sizes, *pack_rectangles(sizes)[1:])
+                        > 0.9)
+        self.failUnlessEqual(pack_rectangles([(10, 10), (10, 10)], 1, 15),
+                             ([(0, 0), (0, 11)], 10, 21))
+
+        # sprite without orientation is packed
+        self.settings_manager.set(
+            MEDIA_ROOT=os.path.join(self.rootTestsDir, "dest"),
+            CSS_BUILDER_SOURCE=os.path.join(self.rootTestsDir, "source"),
+            CSS_BUILDER_SPRITES={"p1": {"files": [r".*\.png"]}})
+        os.mkdir(os.path.join(self.rootTestsDir, "source"))
+        os.mkdir(os.path.join(self.rootTestsDir, "dest"))
+        for name in ["a.png", "b.png", "c.png", "d.png"]:
+            shutil.copyfile(here(["tests_files", "a.png"]),
+                os.path.join(settings.CSS_BUILDER_SOURCE, name))
+        self.failUnless(build_css_sprite("p1"))
+        self.failUnlessEqual(sorted([image.x, image.y] for image in
+                                    SpriteImage.objects.all()),
+                             [[0, 0], [0, 16], [16, 0], [16, 16]])
+        self.failUnless(css_sprite_is_up_to_date("p1"))
+        self.settings_manager.set(
+            CSS_BUILDER_SPRITES={"p1": {"files": [r".*\.png"], "padding": 2}})
+        self.failIf(css_sprite_is_up_to_date("p1"))
+
+    def test_image_metadata(self):
+        source = os.path.join(self.rootTestsDir, "source")
+        self.settings_manager.set(
+            MEDIA_ROOT=os.path.join(self.rootTestsDir, "dest"),
+            CSS_BUILDER_SOURCE=source,
+            CSS_BUILDER_SPRITES={"p1": {"files": [r".*\.png"]}})
+        os.mkdir(source)
+        os.mkdir(settings.MEDIA_ROOT)
+        self.failUnlessEqual(read_image_header(here(["tests_files", "a.png"])),
+                             ("png", 16, 16))
+        self.failUnlessEqual(read_image_header(here(["tests_files", "b.jpg"])),
+                             ("jpeg", 16, 16))
+        for format in ["gif", "bmp"]:
+            path = os.path.join(source, "c." + format)
+            Image.new("RGB", (7, 3)).save(path)
+            self.failUnlessEqual(read_image_header(path), (format, 7, 3))
+        f = open(os.path.join(source, "d.png"), "w")
+        f.close()
+        self.failUnlessEqual(read_image_header(os.path.join(source, "d.png")),
+                             None)
+        self.failUnlessRaises(IOError, ImageFile, os.path.join(source, "d.png"))
+        os.remove(os.path.join(source, "d.png"))
+
+        for name in ["a.png", "b.png"]:
+            shutil.copyfile(here(["tests_files", "a.png"]),
+                            os.path.join(source, name))
+        misses = get_counters().get("image_metadata_misses", 0)
+        build_css_sprite("p1")
+        # sizes are read once, pixels are decoded once
+        self.failUnlessEqual(get_build_stats("sprite", "p1")[-1]["counters"]
+                             ["files_read"], 2)
+        self.failUnlessEqual(get_counters()["image_metadata_misses"] - misses,
+                             2)
+        build_css_sprite("p1")
+        self.failUnlessEqual(get_counters()["image_metadata_misses"] - misses,
+                             2)
+
+        Image.new("RGBA", (5, 4)).save(os.path.join(source, "a.png"))
+        os.utime(os.path.join(source, "a.png"), (1, 1))
+        self.failUnlessEqual(ImageFile(os.path.join(source, "a.png")).metadata,
+                             ("png", 5, 4))
+
+    def test_sprite_queries(self):
+        source = os.path.join(self.rootTestsDir, "source")
+        os.mkdir(source)
+        os.mkdir(os.path.join(self.rootTestsDir, "dest"))
+        self.settings_manager.set(
+            MEDIA_ROOT=os.path.join(self.rootTestsDir, "dest"),
+            CSS_BUILDER_SOURCE=source, MEDIA_URL="/site_media/",
+            CSS_BUILDER_SPRITES={"p3": {"files": [r"p3/.*\.png"]},
+                                 "p30": {"files": [r"p30/.*\.png"]}})
+        # number of queries doesn't depend on the number of images
+        for count in [3, 30]:
+            sprite_name = "p%d" % count
+            os.mkdir(os.path.join(source, sprite_name))
+            for i in range(count):
+                shutil.copyfile(here(["tests_files", "a.png"]),
+                    os.path.join(source, sprite_name, "%d.png" % i))
+            invalidate_sprite_index()
+            self.assertNumQueries(5, build_css_sprite, sprite_name)
+            content = "".join("div.s%d { background: #808080 \
+url(/site_media/%s/%d.png) no-repeat top left; /* 2sprite */ }\n" % (i,
+                        sprite_name, i) for i in range(count))
+            self.assertNumQueries(1, css_sprites, content)
+            self.assertNumQueries(2, build_css_sprite, sprite_name)
+            self.failUnlessEqual(SpriteImage.objects.filter(
+                                    sprite=sprite_name).count(), count)
+        # inserts are split so no query binds more than 999 parameters
+        layout = dict((os.path.join(source, "many", "%d.png" % i),
+                       (0, i * 16, 16, 16)) for i in range(400))
+        self.assertNumQueries(8, SPRITE_STORES["models"].write, "many",
+                              "default", layout)
+        self.failUnlessEqual(SpriteImage.objects.filter(sprite="many").count(),
+                             400)
+
+        # stale images are removed
+        for i in range(1, 30):
+            os.remove(os.path.join(source, "p30", "%d.png" % i))
+        invalidate_sprite_index()
+        build_css_sprite("p30")
+        self.failUnlessEqual([image.path for image in
+                              SpriteImage.objects.filter(sprite="p30")],
+                             [os.path.join(source, "p30", "0.png")])
+
+    def test_file_sprite_store(self):
+        source = os.path.join(self.rootTestsDir, "source")
+        dest = os.path.join(self.rootTestsDir, "dest")
+        os.mkdir(source)
+        os.mkdir(dest)
+        self.settings_manager.set(MEDIA_ROOT=dest, CSS_BUILDER_SOURCE=source,
+            MEDIA_URL="/site_media/", CSS_BUILDER_SPRITE_STORE="files",
+            CSS_BUILDER_SPRITES={"p1": {"files": [r".*\.png"],
+                                        "orientation": "vertically"}})
+        for name in ["a.png", "b.png"]:
+            shutil.copyfile(here(["tests_files", "a.png"]),
+                            os.path.join(source, name))
+        content = "div.a { background: #808080 url(/site_media/b.png) \
+no-repeat top left; /* 2sprite */ }"
+        self.failUnlessEqual(css_sprites(content), "div.a { background: \
+#808080 url(/site_media/p1.PNG) no-repeat 0px -17px;}")
+        self.failUnlessEqual(Sprite.objects.count(), 0)
+        f = open(os.path.join(dest, "p1.sprite.json"), "r")
+        self.failUnlessEqual(json.load(f), {"version": 2,
+            "orientation": "vertically",
+            "images": {"a.png": [0, 0, 16, 16], "b.png": [0, 17, 16, 16]}})
+        f.close()
+        # layout is kept in memory, the database isn't used at all
+        self.failUnless(css_sprite_is_up_to_date("p1"))
+        self.assertNumQueries(0, css_sprites, content)
+
+        SPRITE_STORES["files"].clear()
+        os.remove(os.path.join(source, "a.png"))
+        invalidate_sprite_index()
+        self.failIf(css_sprite_is_up_to_date("p1"))
+        self.failUnlessEqual(css_sprites(content), "div.a { background: \
+#808080 url(/site_media/p1.PNG) no-repeat 0px 0px;}")
+
+        self.settings_manager.set(CSS_BUILDER_SPRITE_STORE="wrong")
+        self.failIf(css_sprite_is_up_to_date("p1"))
+        self.failUnless(check_last_log("Unrecognized sprite store: wrong"))
+
+    def test_sprite_store_upgrade(self):
+        # older sqlite can't drop columns
+        if connection.vendor != "sqlite":
+            return
+        source = os.path.join(self.rootTestsDir, "source")
+        dest = os.path.join(self.rootTestsDir, "dest")
+        os.mkdir(source)
+        os.mkdir(dest)
+        self.settings_manager.set(MEDIA_ROOT=dest, CSS_BUILDER_SOURCE=source,
+            CSS_BUILDER_SPRITES={"p1": {"files": [r".*\.png"],
+                                        "orientation": "vertically"}})
+        a_path = os.path.join(source, "a.png")
+        shutil.copyfile(here(["tests_files", "a.png"]), a_path)
+        # table created by a version without image sizes
+        cursor = connection.cursor()
+        for column in ["width", "height"]:
+            cursor.execute("ALTER TABLE css_builder_spriteimage DROP COLUMN \
+%s" % column)
+        try:
+            SPRITE_STORES["models"].check_table()
+            self.failUnlessEqual(len(get_upgrade_sql()), 2)
+            self.failUnless(build_css_sprite("p1"))
+            self.failUnless(check_last_log("Columns width, height of \
+css_builder_spriteimage are missing, run manage.py css_builder_upgrade to \
+add them"))
+            self.failUnlessEqual(read_sprite_layout("p1"), ("vertically",
+                                 {a_path: (0, 0, None, None)}))
+            self.failUnless(css_sprite_is_up_to_date("p1"))
+
+            output = StringIO()
+            call_command("css_builder_upgrade", sql=True, stdout=output)
+            self.failUnlessEqual(output.getvalue().splitlines(),
+                                 get_upgrade_sql())
+            call_command("css_builder_upgrade", stdout=output)
+            self.failUnlessEqual(get_upgrade_sql(), [])
+            self.failUnless(build_css_sprite("p1"))
+            self.failUnlessEqual(read_sprite_layout("p1"), ("vertically",
+                                 {a_path: (0, 0, 16, 16)}))
+        finally:
+            for statement in get_upgrade_sql():
+                cursor.execute(statement)
+            SPRITE_STORES["models"].check_table()
+
+    def test_benchmark_command(self):
+        output = StringIO()
+        results_path = os.path.join(self.rootTestsDir, "results.json")
+        call_command("css_builder_benchmark", files=6, depth=2, packages=2,
+                     icons=3, repeat=1, output=results_path, stdout=output)
+        lines = output.getvalue().splitlines()
+        self.failUnlessEqual([line.split()[0] for line in lines[1:]], STAGES)
+        f = open(results_path, "r")
+        results = json.load(f)
+        f.close()
+        self.failUnlessEqual(results["config"]["files"], 6)
+        self.failUnless(results["results"]["build_all_packages"]["warm"] > 0)
+        # generated tree and its sprite records are removed
+        self.failUnlessEqual(Sprite.objects.count(), 0)
+
+        # same results are no regression
+        call_command("css_builder_benchmark", files=6, depth=2, packages=2,
+                     icons=3, repeat=1, compare=results_path, threshold=1000,
+                     stdout=output)
+        self.failIf("REGRESSION" in output.getvalue())
+
+    def test_sprite_repaint(self):
+        source = os.path.join(self.rootTestsDir, "source")
+        dest = os.path.join(self.rootTestsDir, "dest")
+        os.mkdir(source)
+        os.mkdir(dest)
+        self.settings_manager.set(MEDIA_ROOT=dest, CSS_BUILDER_SOURCE=source,
+            MEDIA_URL="/site_media/",
+            CSS_BUILDER_PACKAGES={"p1": ["p1.css"]},
+            CSS_BUILDER_SPRITES={"s1": {"files": [r".*\.png"]}})
+        for name in ["a.png", "b.png", "c.png"]:
+            shutil.copyfile(here(["tests_files", "a.png"]),
+                            os.path.join(source, name))
+            os.utime(os.path.join(source, name),
+                     (time.time() - 100, time.time() - 100))
+        f = open(os.path.join(source, "p1.css"), "w")
+        f.write("div.b { background: #808080 url(/site_media/b.png) \
+no-repeat top left; /* 2sprite */ }")
+        f.close()
+        rebuilder = Rebuilder()
+        rebuilder.build_all()
+        sprite_path = os.path.join(dest, "s1.PNG")
+
+        # image of the same size is painted over the old one
+        b_path = os.path.join(source, "b.png")
+        os.utime(sprite_path, (time.time() - 10, time.time() - 10))
+        Image.new("RGBA", (16, 16), (255, 0, 0, 255)).save(b_path)
+        self.failUnlessEqual(rebuilder.rebuild(set([b_path])), (["s1"], []))
+        self.failUnlessEqual(get_build_stats("sprite", "s1")[-1]["counters"]
+                             ["images_repainted"], 1)
+        f = open(sprite_path, "rb")
+        repainted = f.read()
+        f.close()
+        os.remove(sprite_path)
+        build_css_sprite("s1")
+        f = open(sprite_path, "rb")
+        self.failUnlessEqual(f.read(), repainted)
+        f.close()
+
+        # resized image changes the layout
+        os.utime(sprite_path, (time.time() - 10, time.time() - 10))
+        Image.new("RGBA", (8, 8), (255, 0, 0, 255)).save(b_path)
+        self.failUnlessEqual(rebuilder.rebuild(set([b_path])),
+                             (["s1"], ["p1"]))
+        self.failIf("images_repainted" in get_build_stats("sprite", "s1")[-1]
+                    ["counters"])
@@ -1,19 +1,36 @@
 
-import commands
+import gzip
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import re
+import struct
+import subprocess
+import time
 from contextlib import closing
+from cStringIO import StringIO
 import Image
-import imghdr
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 from django import template
 from django.conf import settings
+from django.db import connection, transaction
 from django.utils import importlib
 
-from css_builder.core_utils import (get_package_files,
-                                    concatenate_package_files,
-                                    find_package_files)
+from css_builder import stats
+from css_builder.core_utils import (get_package_files, sort_package_files,
+                                    find_package_files, discover,
+                                    DependencyCache, PackageGraph,
+                                    file_hash, write_file_atomic,
+                                    atomic_output, FileLock)
+from css_builder.minifier import minify
+from css_builder.packing import pack_rectangles, packing_efficiency
 from css_builder.models import SpriteImage, Sprite
 
 
@@ -26,6 +43,7 @@ except ImportError, e:
                                     (settings.SETTINGS_MODULE, e)
                                     
 LOG_FILENAME = os.path.join(os.path.dirname(mod.__file__), "css_builder.log")
+CACHE_DIR = os.path.join(os.path.dirname(mod.__file__), ".css_builder_cache")
 BASIC_FORMAT = "%(asctime)s - %(name)-20s - %(levelname)s - %(message)s" 
 
 format = getattr(settings, "CSS_BUILDER_FORMAT", BASIC_FORMAT)
@@ -67,8 +85,28 @@ BACKGROUND_SHORT = r"background-image:\s+%s\s*;" % BACKGROUND_IMAGE
 BACKGROUND_SHORT_SPRITE = BACKGROUND_SHORT + r"\s*\/\*\s*2sprite\s*\*\/\s*"
 BACKGROUND_SHORT_B64 = BACKGROUND_SHORT + r"\s*\/\*\s*2b64\s*\*\/\s*"
 
+IMPORT_RULE = r"@import\s+(?:url\(\s*(?P<import_quote>['\"]?)" + \
+    r"(?P<import_url>[^'\")]+)(?P=import_quote)\s*\)|" + \
+    r"(?P<import_string_quote>['\"])(?P<import_string>[^'\"]+)" + \
+    r"(?P=import_string_quote))\s*(?P<import_media>[^;]*);"
+URL = r"url\(\s*(?P<url_quote>['\"]?)(?P<url>[^'\")]+)(?P=url_quote)\s*\)"
+IMPORT_OR_URL = re.compile(IMPORT_RULE + "|" + URL)
+CHARSET_RULE = re.compile(r"@charset\s+['\"][^'\"]*['\"]\s*;\s*")
+
 
 IMAGE_FORMATS = ['PNG', 'JPG', 'JPEG', 'BMP', 'GIF']
+UNCOMPRESSED_IMAGE_FORMATS = ['BMP']
+# lossless formats, sprite in them can be decoded, partially repainted and
+# saved again without changing the other images
+REPAINTABLE_IMAGE_FORMATS = ['PNG', 'BMP']
+# SQLite allows 999 parameters per query and Django 1.4 doesn't split
+# bulk_create, so queries are split here
+DB_MAX_PARAMETERS = 999
+# paths in one IN list
+DB_BATCH_SIZE = 200
+# SpriteImage rows inserted by one query, every row binds all its columns
+SPRITE_IMAGE_BATCH_SIZE = DB_MAX_PARAMETERS / len(
+                                            SpriteImage._meta.local_fields)
 
 def check_settings(properties):
     def decorator(func):
@@ -98,6 +136,172 @@ def get_dest_dir():
         return settings.CSS_BUILDER_DEST
 
 
+def build_on_render():
+    """
+    Check if template tags should build packages and files during
+    rendering. Set CSS_BUILDER_BUILD_ON_RENDER to False when builds are
+    done by css_builder_watch or during deploy.
+
+    Return:
+        <bool>
+    """
+    return getattr(settings, "CSS_BUILDER_BUILD_ON_RENDER", True)
+
+
+def get_cache_dir():
+    """
+    Return CSS_BUILDER_CACHE_DIR or if not set default cache directory placed
+    next to the settings module
+
+    Return:
+        <str>
+    """
+    return getattr(settings, "CSS_BUILDER_CACHE_DIR", CACHE_DIR)
+
+
+_dependency_cache = None
+
+def get_dependency_cache():
+    """
+    Return dependency cache shared by all builds in the process. The cache
+    is stored in the cache directory so new processes start with it warm.
+
+    Return:
+        <DependencyCache> or None if CSS_BUILDER_DEPENDENCY_CACHE is False
+    """
+    global _dependency_cache
+    if not getattr(settings, "CSS_BUILDER_DEPENDENCY_CACHE", True):
+        return None
+    path = os.path.join(get_cache_dir(), "dependencies.pickle")
+    if _dependency_cache == None or _dependency_cache.path != path:
+        _dependency_cache = DependencyCache(path)
+    return _dependency_cache
+
+
+def save_dependency_cache(cache):
+    if cache == None:
+        return
+    try:
+        cache.save()
+    except (IOError, OSError), e:
+        log("save_dependency_cache", "Cannot save dependency cache %s: %s" %
+            (cache.path, e))
+
+
+_package_graph = {"key": None, "graph": None}
+
+def get_package_graph():
+    """
+    Return dependency graph of all packages from CSS_BUILDER_PACKAGES. The
+    graph is kept in memory and reused while the configuration is the same
+    and the graph is current (no source file was added, removed or
+    modified).
+
+    Return:
+        <PackageGraph>
+    """
+    key = json.dumps([settings.CSS_BUILDER_PACKAGES,
+                      settings.CSS_BUILDER_SOURCE], sort_keys=True)
+    graph = _package_graph["graph"]
+    if _package_graph["key"] == key and graph.is_current():
+        stats.count("package_graph_hits")
+        return graph
+    stats.count("package_graph_misses")
+    cache = get_dependency_cache()
+    graph = PackageGraph(settings.CSS_BUILDER_PACKAGES,
+                         settings.CSS_BUILDER_SOURCE, cache)
+    save_dependency_cache(cache)
+    _package_graph.update(key=key, graph=graph)
+    return graph
+
+
+def invalidate_package_graph():
+    _package_graph.update(key=None, graph=None)
+
+
+def get_affected_packages(paths, graph=None):
+    """
+    Return packages which use any of the source files directly or through
+    require declarations
+
+    Parameters:
+        paths <list> - absolute paths to the source files
+        graph <PackageGraph> - built by get_package_graph if not given
+    Return:
+        <list> - sorted package names
+    """
+    if graph == None:
+        graph = get_package_graph()
+    packages = set()
+    for path in paths:
+        packages.update(graph.affected_packages(path))
+    return sorted(packages)
+
+
+def get_common_package():
+    """
+    Return name and minimal number of packages of the common package or
+    None if files shared by packages aren't extracted. Common package is
+    set in CSS_BUILDER_COMMON_PACKAGE, e.g.
+
+        CSS_BUILDER_COMMON_PACKAGE = {"name": "common", "min_packages": 3}
+
+    Return:
+        (<str>, <int>) or None
+    """
+    cfg = getattr(settings, "CSS_BUILDER_COMMON_PACKAGE", None)
+    if not cfg:
+        return None
+    name = cfg.get("name", "common")
+    if name in settings.CSS_BUILDER_PACKAGES:
+        log("get_common_package", "Name of the common package %s is used in \
+CSS_BUILDER_PACKAGES" % name)
+        return None
+    return name, cfg.get("min_packages", 2)
+
+
+def is_package(package_name):
+    """
+    Check if package is in CSS_BUILDER_PACKAGES or is the common package
+    """
+    if package_name in settings.CSS_BUILDER_PACKAGES:
+        return True
+    common = get_common_package()
+    return common != None and common[0] == package_name
+
+
+def get_build_files(package_name, graph=None):
+    """
+    Return files of the package and their dependencies. If the common
+    package is used, files of the common package are left out of other
+    packages.
+
+    Parameters:
+        package_name <str>
+        graph <PackageGraph> - resolved dependencies of all packages
+    Return:
+        (<list>, <dict>) - see get_package_files
+    """
+    common = get_common_package()
+    if common == None and graph == None:
+        cache = get_dependency_cache()
+        result = get_package_files(settings.CSS_BUILDER_PACKAGES[package_name],
+                                   settings.CSS_BUILDER_SOURCE, cache)
+        save_dependency_cache(cache)
+        return result
+    if graph == None:
+        with stats.stage("discovery"):
+            graph = get_package_graph()
+    with stats.stage("dependencies"):
+        if common == None:
+            return graph.get_package_files(package_name)
+        name, min_packages = common
+        if package_name == name:
+            return graph.get_common_package_files(min_packages)
+        return graph.get_package_files(package_name,
+                                       graph.common_files(min_packages))
+
+
 def cut_path(path, start):
     prefix = os.path.commonprefix([path, start])
     return path[len(prefix):]
@@ -140,21 +344,795 @@ def check_basic_config():
     return success
 
 
-def package_needs_rebuilding(files, package_name):
+BUILD_MANIFEST_VERSION = 2
+
+def get_build_manifest_path(package_name):
+    return os.path.join(get_dest_dir(), package_name + ".manifest.json")
+
+
+def get_package_config_hash(package_name):
+    """
+    Return hash of the package definition from CSS_BUILDER_PACKAGES and of
+    the common package definition
+
+    Parameters:
+        package_name <str>
+    Return:
+        <str>
+    """
+    cfg = settings.CSS_BUILDER_PACKAGES.get(package_name)
+    return hashlib.sha1(json.dumps([cfg, get_common_package()],
+                                   sort_keys=True)).hexdigest()
+
+
+def read_build_manifest(package_name):
+    """
+    Return build manifest written during last build of the package
+
+    Parameters:
+        package_name <str>
+    Return:
+        <dict> or None if manifest doesn't exist or is broken
+    """
+    path = get_build_manifest_path(package_name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with closing(open(path, "r")) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if manifest.get("version") != BUILD_MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def get_manifest_entry(content, stat):
+    """
+    Return manifest entry of the file content
+
+    Parameters:
+        content <str> - content used by the build
+        stat - result of os.stat taken before the file was read, so a file
+               modified during the build looks changed next time
+    Return:
+        <dict>
+    """
+    return {"size": len(content), "mtime": stat.st_mtime,
+            "sha1": hashlib.sha1(content).hexdigest()}
+
+
+def get_manifest_entries(files, read=None):
+    """
+    Parameters:
+        files <list>
+        read <dict> - entries of the files read by the build, other files
+                      are read again
+    Return:
+        <dict>
+    """
+    entries = {}
+    for path in files:
+        if read != None and path in read:
+            entries[path] = read[path]
+            continue
+        stat = os.stat(path)
+        entries[path] = {"size": stat.st_size, "mtime": stat.st_mtime,
+                         "sha1": file_hash(path)}
+    return entries
+
+
+def write_build_manifest(package_name, files, imports=(), read=None):
+    """
+    Write build manifest next to the package output. Manifest keeps package
+    definition hash and size, mtime and content hash of every file used
+    in the build.
+
+    Parameters:
+        package_name <str>
+        files <list> - absolute paths to the package files
+        imports <list> - absolute paths to the files inlined by @import
+        read <dict> - path -> entry (see get_manifest_entry) of the files
+                      as they were read by the build
+    """
+    manifest = {"version": BUILD_MANIFEST_VERSION,
+                "config": get_package_config_hash(package_name),
+                "files": get_manifest_entries(files, read),
+                "imports": get_manifest_entries(imports, read)}
+    write_file(get_build_manifest_path(package_name),
+               json.dumps(manifest, sort_keys=True, indent=1))
+
+
+def file_has_changed(path, entry, freshness):
+    """
+    Check file against its build manifest entry
+
+    Parameters:
+        path <str>
+        entry <dict> - size, mtime and sha1
+        freshness <str> - see package_needs_rebuilding
+    Return:
+        <bool>
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return True
+    if stat.st_size != entry["size"]:
+        return True
+    if freshness == "stat":
+        return stat.st_mtime != entry["mtime"]
+    return file_hash(path) != entry["sha1"]
+
+
+def package_needs_rebuilding(files, package_name, freshness="content"):
     """
-    TODO
-        check if some files were added since last building
+    Check package output against build manifest. Package needs rebuilding
+    if output or manifest doesn't exist, package definition has changed,
+    some files were added or removed since last building or some file
+    (or file inlined by @import) was modified.
+
+    Parameters:
+        files <list> - absolute paths to the package files
+        package_name <str>
+        freshness <str> - "content" compares content hashes of the files,
+                          "stat" compares only sizes and mtimes (no reads)
+    Return:
+        <bool>
     """
     package_file = os.path.join(get_dest_dir(), package_name + ".css")
     if not os.path.exists(package_file):
         return True
-    package_m_time = os.path.getmtime(package_file)
-    for f in files:
-        if os.path.getmtime(f) > package_m_time:
+    manifest = read_build_manifest(package_name)
+    if manifest == None:
+        return True
+    if manifest["config"] != get_package_config_hash(package_name):
+        return True
+    entries = manifest["files"]
+    if set(entries) != set(files):
+        return True
+    for path in files:
+        if file_has_changed(path, entries[path], freshness):
+            return True
+    for path, entry in manifest["imports"].iteritems():
+        if file_has_changed(path, entry, freshness):
             return True
     return False
 
 
+class BuildPipeline(object):
+    """
+    Chain of transform stages run on the package content in memory.
+
+    Stage is a callable which takes content <str> and returns transformed
+    content. Time spent in every stage of the last run is kept in timings.
+    """
+    def __init__(self, stages=None):
+        """
+        Parameters:
+            stages <list> - list of (name, callable) tuples
+        """
+        self.stages = list(stages or [])
+        self.timings = []
+
+    def add_stage(self, name, stage):
+        self.stages.append((name, stage))
+
+    def run(self, content):
+        """
+        Parameters:
+            content <str>
+        Return:
+            <str>
+        """
+        self.timings = []
+        for name, stage in self.stages:
+            start = time.time()
+            content = stage(content)
+            self.timings.append((name, time.time() - start))
+            stats.add_time(name, self.timings[-1][1])
+        return content
+
+
+USER_STAGES = []
+
+def register_stage(name, stage):
+    """
+    Register stage run on every package after sprites and embedding
+    images and before compression.
+
+    Parameters:
+        name <str>
+        stage <callable> - takes content <str> and returns content <str>
+    """
+    USER_STAGES.append((name, stage))
+
+
+def get_package_pipeline():
+    """
+    Return pipeline run on the whole package content after its files were
+    transformed by FragmentBuilder and joined
+
+    Return:
+        <BuildPipeline>
+    """
+    return BuildPipeline(USER_STAGES)
+
+
+class FragmentCache(object):
+    """
+    In-memory cache of package fragments - content of single source file
+    after sprites and embedding images stages.
+
+    Entry is valid if the file content and the settings are the same and
+    every sprite, image and imported file used by the fragment has the same
+    version as during the transformation. Fragment with @import rules is
+    valid only if the same imports were already inlined by the previous
+    fragments of the package.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, path, sha1, settings_key, version, imported=frozenset()):
+        """
+        Parameters:
+            path <str> - absolute path to the source file
+            sha1 <str> - hash of the source file content
+            settings_key <str>
+            version <callable> - returns current version of the reference
+            imported <set> - imports inlined by the previous fragments
+        Return:
+            <str> or None
+        """
+        entry = self.entries.get(path)
+        if entry == None or entry["sha1"] != sha1 or \
+            entry["settings"] != settings_key:
+            return None
+        if imported.intersection(entry["inlined"]) or \
+            not imported.issuperset(entry["skipped"]):
+            return None
+        for reference, reference_version in entry["references"]:
+            if version(reference) != reference_version:
+                return None
+        return entry["content"]
+
+    def set(self, path, sha1, settings_key, references, content, inlined=(),
+            skipped=(), remote=(), read=None):
+        """
+        Parameters:
+            inlined <list> - imports inlined by the fragment
+            skipped <list> - imports skipped because they were inlined by
+                             the previous fragments
+            remote <list> - @import rules removed from the fragment to be
+                            put at the top of the package
+            read <dict> - manifest entries of the inlined files
+        """
+        self.entries[path] = {"sha1": sha1, "settings": settings_key,
+                              "references": references, "content": content,
+                              "inlined": list(inlined),
+                              "skipped": list(skipped),
+                              "remote": list(remote),
+                              "read": dict(read or {})}
+
+    def paths_referencing(self, references):
+        """
+        Return paths of the source files which cached fragments use any of
+        the references
+
+        Parameters:
+            references <set> - ("sprite", name) or ("image", path) tuples
+        Return:
+            <set>
+        """
+        paths = set()
+        for path, entry in self.entries.iteritems():
+            for reference, version in entry["references"]:
+                if reference in references:
+                    paths.add(path)
+                    break
+        return paths
+
+    def get_references(self, kind):
+        """
+        Return names or paths of all references of the kind used by the
+        cached fragments
+
+        Parameters:
+            kind <str> - "sprite", "image" or "file"
+        Return:
+            <set>
+        """
+        return set(reference[1] for entry in self.entries.itervalues() for
+                   reference, version in entry["references"] if
+                   reference[0] == kind)
+
+
+FRAGMENT_CACHE = FragmentCache()
+
+
+def get_fragment_settings_key():
+    """
+    Return hash of the settings which transformed fragments depend on
+    """
+    return hashlib.sha1(json.dumps([settings.MEDIA_URL, settings.MEDIA_ROOT,
+                settings.CSS_BUILDER_SOURCE,
+                getattr(settings, "CSS_BUILDER_SPRITES", None)],
+                sort_keys=True)).hexdigest()
+
+
+def get_css_sprite_version(sprite_name):
+    """
+    Rebuild sprite if needed and return hash of its layout
+
+    Parameters:
+        sprite_name <str>
+    Return:
+        <str> or None
+    """
+    layout = get_built_sprite_layout(sprite_name)
+    if layout == None:
+        return None
+    return hashlib.sha1(repr([get_sprite_format(sprite_name),
+                              sorted(layout.items())])).hexdigest()
+
+
+def is_local_url(url):
+    return re.match(r"([a-zA-Z][a-zA-Z0-9+.-]*:|//|#)", url) == None
+
+
+def split_url(url):
+    """
+    Return (path, query and fragment) of the url
+    """
+    match = re.match(r"([^?#]*)(.*)", url)
+    return match.group(1), match.group(2)
+
+
+def resolve_import(url, path):
+    """
+    Return absolute path to the source file imported by @import rule or
+    None if the import isn't local
+
+    Parameters:
+        url <str> - relative to the importing file or starting with
+                    MEDIA_URL
+        path <str> - absolute path to the importing file
+    Return:
+        <str> or None
+    """
+    if not is_local_url(url):
+        return None
+    url = split_url(url)[0]
+    if settings.MEDIA_URL and url.startswith(settings.MEDIA_URL):
+        return os.path.join(settings.CSS_BUILDER_SOURCE,
+                            url[len(settings.MEDIA_URL):])
+    if url.startswith("/"):
+        return None
+    return os.path.normpath(os.path.join(os.path.dirname(path), url))
+
+
+def rebase_url(url, path):
+    """
+    Return url relative to the file in CSS_BUILDER_SOURCE as url relative
+    to the package output in CSS_BUILDER_DEST (or MEDIA_ROOT)
+
+    Parameters:
+        url <str>
+        path <str> - absolute path to the file with the url
+    Return:
+        <str>
+    """
+    if not is_local_url(url) or url.startswith("/"):
+        return url
+    url, suffix = split_url(url)
+    directory = os.path.relpath(os.path.dirname(path),
+                                settings.CSS_BUILDER_SOURCE)
+    target = os.path.normpath(os.path.join(settings.MEDIA_ROOT, directory,
+                                           url))
+    return os.path.relpath(target, get_dest_dir()).replace(os.sep, "/") + \
+        suffix
+
+
+def inline_imports(content, path, imported, references=None, remote=None,
+                   read=None):
+    """
+    Replace local @import rules with content of the imported files.
+    Imports are resolved recursively, url() references in the imported
+    files are rebased to the package output, imports with media queries
+    are wrapped in @media blocks and every file (with the same media) is
+    inlined only once. Remote imports are removed and added to remote,
+    browsers ignore @import after other rules so they have to be put at the
+    top of the package (see hoist_imports). Remote import in a file
+    imported with media can't be moved and is kept.
+
+    Parameters:
+        content <str>
+        path <str> - absolute path to the file with the content
+        imported <set> - (path, media) of already inlined imports, new
+                         imports are added to it
+        references <set> - if given ("file", path) tuples of inlined files
+                           are added to it
+        remote <list> - if given remote @import rules are moved to it
+        read <dict> - if given manifest entries of the inlined files are
+                      added to it
+    Return:
+        (<str>, <list>, <list>) - content, (path, media) of inlined imports
+                                  and of imports skipped as duplicates
+    """
+    inlined = []
+    skipped = []
+
+    def replace(matchobj, path, rebase, in_media=False):
+        data = matchobj.groupdict()
+        url = data["import_url"] or data["import_string"]
+        if url == None:
+            if not rebase:
+                return matchobj.group(0)
+            return "url(%s%s%s)" % (data["url_quote"],
+                        rebase_url(data["url"], path), data["url_quote"])
+        imported_path = resolve_import(url, path)
+        media = " ".join(data["import_media"].split())
+        if imported_path == None:
+            rule = matchobj.group(0)
+            if rebase and is_local_url(url):
+                rule = rule.replace(url, rebase_url(url, path), 1)
+            if remote == None:
+                return rule
+            if in_media:
+                log("inline_imports", "%s in %s is imported with media and \
+cannot be moved to the top of the package, browsers will ignore it" %
+                    (rule, path))
+                return rule
+            if not rule in remote:
+                remote.append(rule)
+            return ""
+        key = (imported_path, media)
+        if key in imported:
+            skipped.append(key)
+            return ""
+        imported.add(key)
+        inlined.append(key)
+        if references != None:
+            references.add(("file", imported_path))
+        try:
+            stat = os.stat(imported_path)
+            with closing(open(imported_path, "r")) as f:
+                imported_content = f.read()
+        except (IOError, OSError):
+            raise Exception("inline_imports", "File %s imported by %s \
+cannot be found" % (imported_path, path))
+        if read != None:
+            read[imported_path] = get_manifest_entry(imported_content, stat)
+        stats.count("files_read")
+        stats.count("bytes_read", len(imported_content))
+        result = IMPORT_OR_URL.sub(lambda m: replace(m, imported_path, True,
+                                                     in_media or bool(media)),
+                                   CHARSET_RULE.sub("", imported_content))
+        if media:
+            return "@media %s {\n%s\n}" % (media, result)
+        return result
+
+    content = IMPORT_OR_URL.sub(lambda m: replace(m, path, False), content)
+    return content, inlined, skipped
+
+
+def hoist_imports(content, imports):
+    """
+    Put @import rules at the top of the content, after @charset rule
+
+    Parameters:
+        content <str>
+        imports <list> - @import rules
+    Return:
+        <str>
+    """
+    if len(imports) == 0:
+        return content
+    charset = CHARSET_RULE.match(content)
+    head = ""
+    if charset != None:
+        head = charset.group(0)
+        content = content[charset.end():]
+    return head + "\n".join(imports) + "\n" + content
+
+
+class FragmentBuilder(object):
+    """
+    Transform package files one by one with sprites and embedding images
+    stages. Results are taken from the fragment cache when possible so only
+    changed files are transformed again.
+    """
+    def __init__(self, cache=FRAGMENT_CACHE):
+        self.cache = cache
+        self.settings_key = get_fragment_settings_key()
+        self.versions = {}
+        self.stage_timings = {"sprites": 0.0, "embedding_images": 0.0}
+        self.hits = 0
+        self.misses = 0
+        self.imports = []
+        self.remote_imports = []
+        # manifest entries of the files as they were read
+        self.read = {}
+
+    @property
+    def timings(self):
+        return sorted(self.stage_timings.items())
+
+    def add_time(self, stage, seconds):
+        self.stage_timings[stage] += seconds
+        stats.add_time(stage, seconds)
+
+    def version(self, reference):
+        """
+        Return current version of ("sprite", name), ("image", path) or
+        ("file", path) reference. Versions are computed once per builder.
+        """
+        if not reference in self.versions:
+            kind, name = reference
+            if kind == "sprite":
+                self.versions[reference] = get_css_sprite_version(name)
+            else:
+                try:
+                    stat = os.stat(name)
+                    self.versions[reference] = [stat.st_mtime, stat.st_size]
+                except OSError:
+                    self.versions[reference] = None
+        return self.versions[reference]
+
+    def add_imports(self, inlined, imported, remote=(), read=None):
+        for path, entry in (read or {}).iteritems():
+            self.read.setdefault(path, entry)
+            # the fragment depends on the version which was read
+            self.versions.setdefault(("file", path),
+                                     [entry["mtime"], entry["size"]])
+        for key in inlined:
+            imported.add(key)
+            if not key[0] in self.imports:
+                self.imports.append(key[0])
+        for rule in remote:
+            if not rule in self.remote_imports:
+                self.remote_imports.append(rule)
+
+    def transform(self, path, imported=None):
+        """
+        Return transformed content of the file
+
+        Parameters:
+            path <str> - absolute path to the file
+            imported <set> - imports already inlined in the package, new
+                             imports are added to it
+        Return:
+            <str>
+        """
+        if imported == None:
+            imported = set()
+        stat = os.stat(path)
+        with closing(open(path, "r")) as f:
+            content = f.read()
+        stats.count("files_read")
+        stats.count("bytes_read", len(content))
+        self.read[path] = get_manifest_entry(content, stat)
+        sha1 = self.read[path]["sha1"]
+        cached = self.cache.get(path, sha1, self.settings_key, self.version,
+                                imported)
+        if cached != None:
+            self.hits += 1
+            stats.count("fragment_cache_hits")
+            entry = self.cache.entries[path]
+            self.add_imports(entry["inlined"], imported, entry["remote"],
+                             entry["read"])
+            return cached
+        self.misses += 1
+        stats.count("fragment_cache_misses")
+
+        references = set()
+        inlined, skipped, remote, read = [], [], [], {}
+        if "@import" in content:
+            with stats.stage("imports"):
+                content, inlined, skipped = inline_imports(content, path,
+                                            imported, references, remote, read)
+            self.add_imports(inlined, imported, remote, read)
+        start = time.time()
+        result = css_sprites(content, references=references)
+        self.add_time("sprites", time.time() - start)
+        start = time.time()
+        result = embedding_images(result, references)
+        self.add_time("embedding_images", time.time() - start)
+        self.cache.set(path, sha1, self.settings_key,
+            [(reference, self.version(reference)) for reference in
+             sorted(references)], result, inlined, skipped, remote, read)
+        return result
+
+    def build(self, files):
+        """
+        Return transformed and joined content of the files
+
+        Parameters:
+            files <list> - absolute paths in the right order
+        Return:
+            <str>
+        """
+        imported = set()
+        self.remote_imports = []
+        fragments = [self.transform(path, imported) for path in files]
+        with stats.stage("concatenation"):
+            return hoist_imports("\n".join(fragments), self.remote_imports)
+
+
+def log_timings(package_name, *pipelines):
+    logger = logging.getLogger("css_builder.build")
+    for pipeline in pipelines:
+        for name, seconds in pipeline.timings:
+            logger.debug("%s: %s took %.3fs" % (package_name, name, seconds))
+
+
+def write_file(path, content):
+    """
+    Write file with atomic rename so readers never see partial content
+    """
+    write_file_atomic(path, content)
+    stats.count("files_written")
+    stats.count("bytes_written", len(content))
+
+
+def gzip_compress(content):
+    """
+    Return content compressed with gzip at maximum level. Timestamp isn't
+    stored so the same content gives the same bytes.
+    """
+    buf = StringIO()
+    gzip_file = gzip.GzipFile(filename="", mode="wb", compresslevel=9,
+                              fileobj=buf, mtime=0)
+    gzip_file.write(content)
+    gzip_file.close()
+    return buf.getvalue()
+
+
+def get_sidecar_compressors():
+    """
+    Return list of (extension, compress function) used for precompressed
+    files. Brotli is used if the module is available.
+    """
+    compressors = [(".gz", gzip_compress)]
+    if brotli != None:
+        compressors.append((".br", brotli.compress))
+    return compressors
+
+
+def write_compressed_sidecars(path, content, changed=True):
+    """
+    Write <path>.gz (and <path>.br) for servers which serve precompressed
+    files (e.g. nginx gzip_static). Set CSS_BUILDER_PRECOMPRESS to False to
+    disable them.
+
+    Parameters:
+        path <str> - absolute path to the output file
+        content <str> - content of the output file
+        changed <bool> - if False only missing sidecars are written
+    """
+    if not getattr(settings, "CSS_BUILDER_PRECOMPRESS", True):
+        return
+    with stats.stage("precompress"):
+        for ext, compress in get_sidecar_compressors():
+            if changed or not os.path.exists(path + ext):
+                write_file(path + ext, compress(content))
+
+
+def write_output(path, content):
+    """
+    Write output file and its compressed sidecars. Nothing is written if the
+    file already has the same content.
+
+    Parameters:
+        path <str>
+        content <str>
+    Return:
+        <bool> - True if file has changed
+    """
+    changed = True
+    if os.path.exists(path) and os.path.getsize(path) == len(content):
+        with closing(open(path, "rb")) as f:
+            changed = f.read() != content
+    if changed:
+        write_file(path, content)
+    write_compressed_sidecars(path, content, changed)
+    return changed
+
+
+def get_lock(name):
+    """
+    Return inter-process lock stored in the cache directory
+
+    Parameters:
+        name <str> - e.g. "package-<package name>"
+    Return:
+        <FileLock>
+    """
+    return FileLock(os.path.join(get_cache_dir(), "locks", name + ".lock"))
+
+
+def get_static_manifest_path():
+    return os.path.join(get_dest_dir(), getattr(settings,
+                        "CSS_BUILDER_MANIFEST", "css_builder_manifest.json"))
+
+
+def read_static_manifest(path):
+    """
+    Return mapping of package names to fingerprinted file names
+
+    Parameters:
+        path <str> - absolute path to the manifest
+    Return:
+        <dict>
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with closing(open(path, "r")) as f:
+            return dict((str(k), str(v)) for k, v in
+                        json.load(f)["packages"].iteritems())
+    except (IOError, ValueError, KeyError), e:
+        log("read_static_manifest", "Cannot read %s: %s" % (path, e))
+        return {}
+
+
+_static_manifest = (None, {})
+
+def get_static_manifest():
+    """
+    Return static manifest. Manifest is read once per process and kept in
+    memory.
+
+    Return:
+        <dict>
+    """
+    global _static_manifest
+    path = get_static_manifest_path()
+    if _static_manifest[0] != path:
+        _static_manifest = (path, read_static_manifest(path))
+    return _static_manifest[1]
+
+
+def reset_static_manifest():
+    global _static_manifest
+    _static_manifest = (None, {})
+
+
+def write_fingerprinted_package(package_name, content):
+    """
+    Write <package_name>.<hash>-min.css and add it to the static manifest
+
+    Parameters:
+        package_name <str>
+        content <str> - compressed package content
+    """
+    name = "%s.%s-min.css" % (package_name,
+                              hashlib.md5(content).hexdigest()[:12])
+    write_output(os.path.join(get_dest_dir(), name), content)
+    with get_lock("manifest"):
+        manifest_path = get_static_manifest_path()
+        manifest = read_static_manifest(manifest_path)
+        if manifest.get(package_name) != name:
+            manifest[package_name] = name
+            write_file(manifest_path, json.dumps({"packages": manifest},
+                                                 sort_keys=True, indent=1))
+    reset_static_manifest()
+
+
+def package_url(package_name):
+    """
+    Return url to the compressed package. Fingerprinted file from the
+    static manifest is used if it exists.
+
+    Parameters:
+        package_name <str>
+    Return:
+        <str>
+    """
+    return settings.MEDIA_URL + get_static_manifest().get(package_name,
+                                                    package_name + "-min.css")
+
+
 def build_package(package_name, check_configuration=True, **options):
     """
     Build package 'package_name'
@@ -162,31 +1140,144 @@ def build_package(package_name, check_configuration=True, **options):
     Parameters:
         package_name <str>
         check_configuration <bool>
+        options:
+            compress <bool> - build compressed package too
+            freshness <str> - "content" (default) or "stat", see
+                              package_needs_rebuilding
+            force <bool> - build even if package is up to date
+            profile <str> - dump cProfile stats of the build to this file
+            graph <PackageGraph> - resolved dependencies of all packages
     """
     if check_configuration:
         if check_basic_config() == False:
             return
-    if not package_name in settings.CSS_BUILDER_PACKAGES:
+    if not is_package(package_name):
         log("build_package", "Unknown package: %s" % package_name)
     else:
-        try:
-            compress = options.get("compress", False)
-            files, dependencies = get_package_files(
-                                settings.CSS_BUILDER_PACKAGES[package_name],
-                                settings.CSS_BUILDER_SOURCE)
-            if package_needs_rebuilding(files, package_name):
-                output = os.path.join(get_dest_dir(), package_name + ".css")
-                concatenate_package_files(output, dependencies)
-                add_css_sprites(output)
-                add_embedding_images(output)
-                if compress:
-                    compress_package(package_name)
-            else:
-                if compress and not os.path.exists(os.path.join(
-                                get_dest_dir(), package_name + "-min.css")):
-                    compress_package(package_name)
-        except Exception, e:
-            log("build_package", *e)
+        with stats.collect("package", package_name):
+            with stats.profile(options.get("profile")):
+                _build_package(package_name, **options)
+
+
+def _build_package(package_name, **options):
+    invalidate_sprite_index()
+    compress = options.get("compress", False)
+    output = os.path.join(get_dest_dir(), package_name + ".css")
+    min_output = os.path.join(get_dest_dir(), package_name + "-min.css")
+    # only one process builds the package at a time, others wait or
+    # serve the previous output if it exists
+    lock = get_lock("package-" + package_name)
+    if not lock.acquire(blocking=not os.path.exists(
+                                    min_output if compress else output)):
+        return
+    try:
+        files, dependencies = get_build_files(package_name,
+                                              options.get("graph"))
+        rebuild = options.get("force", False)
+        if not rebuild:
+            with stats.stage("freshness"):
+                rebuild = package_needs_rebuilding(files, package_name,
+                                        options.get("freshness", "content"))
+        if rebuild:
+            with stats.stage("sorting"):
+                sorted_files = sort_package_files(dependencies)
+            fragments = FragmentBuilder()
+            pipeline = get_package_pipeline()
+            content = pipeline.run(fragments.build(sorted_files))
+            write_output(output, content)
+            write_build_manifest(package_name, files, fragments.imports,
+                                 fragments.read)
+            log_timings(package_name, fragments, pipeline)
+            if compress:
+                pipeline = BuildPipeline([("compress", compress_css)])
+                min_content = pipeline.run(content)
+                write_output(min_output, min_content)
+                write_fingerprinted_package(package_name, min_content)
+                log_timings(package_name, pipeline)
+        elif compress:
+            if not os.path.exists(min_output):
+                compress_package(package_name)
+            elif not package_name in read_static_manifest(
+                                            get_static_manifest_path()):
+                with closing(open(min_output, "r")) as f:
+                    write_fingerprinted_package(package_name, f.read())
+    except Exception, e:
+        log("build_package", *e)
+    finally:
+        lock.release()
+
+
+def get_sprites_files():
+    """
+    Return files of all sprites from CSS_BUILDER_SPRITES found in one walk
+    of CSS_BUILDER_SOURCE
+
+    Return:
+        <dict> - sprite name -> list of absolute paths
+    """
+    sprites = getattr(settings, "CSS_BUILDER_SPRITES", {})
+    return discover(dict((sprite_name, cfg["files"]) for sprite_name, cfg in
+                         sprites.iteritems()), settings.CSS_BUILDER_SOURCE)
+
+
+_sprite_index = {"key": None, "paths": {}}
+
+def get_sprite_index():
+    """
+    Return mapping of absolute image paths to names of sprites which
+    contain them. Index is built once and kept until the sprites
+    configuration changes or invalidate_sprite_index is called (at the
+    start of every package build and by sprite builds which find different
+    files).
+
+    Image claimed by more than one sprite is reported as an error and
+    belongs to the first sprite in the name order.
+
+    Return:
+        <dict>
+    """
+    key = hashlib.sha1(json.dumps([settings.CSS_BUILDER_SOURCE,
+                        getattr(settings, "CSS_BUILDER_SPRITES", None)],
+                        sort_keys=True)).hexdigest()
+    if _sprite_index["key"] != key:
+        files = get_sprites_files()
+        paths = {}
+        conflicts = []
+        for sprite_name in sorted(files):
+            for path in files[sprite_name]:
+                if path in paths:
+                    conflicts.append((path, paths[path], sprite_name))
+                else:
+                    paths[path] = sprite_name
+        _sprite_index.update(key=key, paths=paths)
+        for path, first, second in conflicts:
+            log("get_sprite_index", "Image %s is claimed by sprites %s and \
+%s, %s is used" % (path, first, second, first))
+    return _sprite_index["paths"]
+
+
+def invalidate_sprite_index():
+    _sprite_index["key"] = None
+
+
+def update_sprite_index(sprite_name, paths):
+    """
+    Invalidate the index if files of the sprite differ from the indexed
+    ones, sprite builds keep the index otherwise
+
+    Parameters:
+        sprite_name <str>
+        paths <list> - absolute paths to the sprite files
+    """
+    if _sprite_index["key"] == None:
+        return
+    index = _sprite_index["paths"]
+    indexed = set(path for path, name in index.iteritems() if
+                  name == sprite_name)
+    # files claimed by the previous sprites stay theirs
+    if indexed != set(path for path in paths if
+                      index.get(path, sprite_name) == sprite_name):
+        invalidate_sprite_index()
 
 
 @check_settings(['CSS_BUILDER_SPRITES'])
@@ -199,62 +1290,74 @@ def found_css_sprite(path):
     Return:
         None or <str>
     """
-    for sprite in settings.CSS_BUILDER_SPRITES:
-        files = find_package_files(
-            settings.CSS_BUILDER_SPRITES[sprite]["files"],
-            settings.CSS_BUILDER_SOURCE)
-        if path in files:
-            return sprite
-    log("found_css_sprite", "CSS sprite for %s not found" % path)
-    return None
+    sprite = get_sprite_index().get(path)
+    if sprite == None:
+        log("found_css_sprite", "CSS sprite for %s not found" % path)
+    return sprite
 
 
-def get_css_sprite_data(path):
+def get_css_sprite_data(path, sprites=None):
     """
     Parameters:
         path <str> - relative path
+        sprites <dict> - layouts and formats of the sprites already used,
+                         sprite name -> (layout, format); the sprite is
+                         checked, built and loaded only once for all rules
+                         sharing the dictionary
     """
     abspath = os.path.join(settings.CSS_BUILDER_SOURCE, path)
     sprite_name = found_css_sprite(abspath)
     if sprite_name == None:
         return None
-    if not css_sprite_is_up_to_date(sprite_name):
-        if not build_css_sprite(sprite_name):
+    if sprites == None:
+        sprites = {}
+    if not sprite_name in sprites:
+        layout = get_built_sprite_layout(sprite_name)
+        if layout == None:
             return None
-    image = SpriteImage.objects.get(path = abspath)
-    if not os.path.exists(abspath):
+        sprites[sprite_name] = (layout, get_sprite_format(sprite_name))
+    layout, format = sprites[sprite_name]
+    if not os.path.exists(abspath) or not abspath in layout:
         log('get_css_sprite_data', '%s (%s) does not exists' % (path, abspath))
         return None
+    x, y = layout[abspath][:2]
 
-    format = get_sprite_format(sprite_name)
     image_url = os.path.join(settings.MEDIA_URL, '%s.%s' %\
                              (sprite_name, format))
 
-    return { 'bg_image_url': image_url, 'bg_x': '%dpx' % -image.x,
-            'bg_y': '%dpx' % -image.y}
+    return { 'bg_image_url': image_url, 'bg_x': '%dpx' % -x,
+            'bg_y': '%dpx' % -y, 'sprite_name': sprite_name}
 
 
-def add_css_sprites(path, all=False, output=None):
+def css_sprites(content, all=False, references=None):
     """
     Replace path in background and background-image rules by path to the
     sprite image and add correct background position.
 
     Parameters:
-        path <str>    - absolute path to the input file
+        content <str>
         all <bool>    - indicates if only add css sprite to the rules with
                         comment /* 2sprite */ at the end line or to all
                         background-images styles
+        references <set> - if given ("image", path) and ("sprite", name)
+                            tuples used by the result are added to it
+    Return:
+        <str>
     """
-    if not check_basic_config():
-        return
-
-    with closing(open(path, "r")) as f:
-        content = f.read()
+    sprites = {}
 
     def to_sprite(matchobj):
         data = matchobj.groupdict()
         image_path = cut_path(data["bg_image_url"], settings.MEDIA_URL)
-        sprite_data = get_css_sprite_data(image_path)
+        sprite_data = get_css_sprite_data(image_path, sprites)
+        if references != None:
+            # image in the sprite is covered by the sprite version, which
+            # doesn't change when the image is only repainted
+            if sprite_data != None:
+                references.add(("sprite", sprite_data["sprite_name"]))
+            else:
+                references.add(("image", os.path.join(
+                                settings.CSS_BUILDER_SOURCE, image_path)))
         if sprite_data == None:
             # TODO
             return "background: none;"
@@ -262,113 +1365,411 @@ def add_css_sprites(path, all=False, output=None):
                                 sprite_data["bg_image_url"], data["bg_repeat"],
                                 sprite_data["bg_x"], sprite_data["bg_y"])
 
-    if output == None:
-        output = path
+    if all==True:
+        return re.sub(BACKGROUND, to_sprite, content)
+    else:
+        return re.sub(BACKGROUND_SPRITE, to_sprite, content)
+
+
+def add_css_sprites(path, all=False, output=None):
+    """
+    Replace path in background and background-image rules by path to the
+    sprite image and add correct background position.
+
+    Parameters:
+        path <str>    - absolute path to the input file
+        all <bool>    - indicates if only add css sprite to the rules with
+                        comment /* 2sprite */ at the end line or to all
+                        background-images styles
+    """
+    if not check_basic_config():
+        return
+
+    with closing(open(path, "r")) as f:
+        content = f.read()
+
+    if output == None:
+        output = path
+
+    invalidate_sprite_index()
+    write_file(output, css_sprites(content, all))
+
+
+def text_2_b64(text):
+    """
+    Parameters:
+        text <str>
+    Return
+        <str> - text in base64
+    """
+    return text.encode("base64").replace("\n", "")
+
+
+def url_2_b64(url):
+    """
+    Parameters:
+        url <str>
+    Return:
+        (<str>, <str>) - (image extension, image content in base64)
+    """
+    image_path = cut_path(url, settings.MEDIA_URL)
+    with closing(open(os.path.join(settings.MEDIA_ROOT, image_path), "r"))\
+    as f:
+        content = f.read()
+    stats.count("files_read")
+    stats.count("bytes_read", len(content))
+    with stats.stage("base64"):
+        content_b64 = text_2_b64(content)
+    root, ext = os.path.splitext(url)
+    return (ext[1:], content_b64)
+
+
+def embedding_images(content, references=None):
+    """
+    Create data streams for embedding image from background and
+    background-image styles.
+
+    Parameters:
+        content <str>
+        references <set> - if given ("image", path) tuples of embedded
+                           images are added to it
+    Return:
+        <str>
+    """
+    def add_reference(url):
+        if references != None:
+            references.add(("image", os.path.join(settings.MEDIA_ROOT,
+                                        cut_path(url, settings.MEDIA_URL))))
+
+    def background_image_to_b64(matchobj):
+        data = matchobj.groupdict()
+        add_reference(data['bg_image_url'])
+        (ext, b64) = url_2_b64(data['bg_image_url'])
+        return 'background-image: url("data:image/%s;base64,%s");' %\
+            (ext, b64,)
+
+    def background_to_b64(matchobj):
+        data = matchobj.groupdict()
+        add_reference(data['bg_image_url'])
+        (ext, b64) = url_2_b64(data['bg_image_url'])
+        return 'background: %s url("data:image/%s;base64,%s") %s %s;' %\
+            (data['bg_color'], ext, b64, data['bg_repeat'],
+             data['bg_position'],)
+
+    content = re.sub(BACKGROUND_SHORT_B64, background_image_to_b64, content)
+    return re.sub(BACKGROUND_B64, background_to_b64, content)
+
+
+def add_embedding_images(path, output=None):
+    """
+    Create data streams for embedding image from background and
+    background-image styles.
+
+    Parameters:
+        path <str> - absolute path to the input file
+        output <str>
+    """
+    with closing(open(path, "r")) as f:
+        content = f.read()
+
+    if output == None:
+        output = path
+
+    write_file(output, embedding_images(content))
+
+
+def build_css_sprites():
+    """
+    Build sprites from CSS_BUILDER_SPRITES which aren't up to date
+
+    Return:
+        <list> - names of built sprites
+    """
+    built = []
+    for sprite_name in sorted(getattr(settings, "CSS_BUILDER_SPRITES", {})):
+        if not css_sprite_is_up_to_date(sprite_name):
+            build_css_sprite(sprite_name)
+            built.append(sprite_name)
+    return built
+
+
+# dependency graph of the packages built by build_all_packages, set before
+# the workers are forked so it isn't pickled with every task
+_build_graph = {"graph": None}
+
+
+def timed_build_package(args):
+    """
+    Build package and return time of the build. Used by
+    build_all_packages in worker processes.
 
-    with closing(open(output, "w")) as f:
-        if all==True:
-            f.write(re.sub(BACKGROUND, to_sprite, content))
-        else:
-            f.write(re.sub(BACKGROUND_SPRITE, to_sprite, content))
+    Parameters:
+        args <tuple> - (package_name, options)
+    Return:
+        (<str>, <float>, <list>) - package name, seconds and stats of the
+                                   builds
+    """
+    package_name, options = args
+    last_id = stats.get_last_build_id()
+    start = time.time()
+    build_package(package_name, False, graph=_build_graph["graph"], **options)
+    seconds = time.time() - start
+    return package_name, seconds, [build for build in stats.get_build_stats()
+                                   if build["id"] > last_id]
 
 
-def text_2_b64(text):
+def build_all_packages(jobs=1, **options):
     """
+    Build all packages from CSS_BUILDER_PACKAGEs and the common package
+
+    Sprites are built first, once, so packages built in parallel don't
+    rebuild them. Dependencies of all packages are resolved once in one
+    dependency graph.
+
     Parameters:
-        text <str>
-    Return
-        <str> - text in base64
+        jobs <int> - number of processes building packages
+        options - passed to build_package
+    Return:
+        <list> - (package name, seconds) tuples
     """
-    return text.encode("base64").replace("\n", "")
+    if not check_basic_config():
+        return []
+    build_css_sprites()
+    try:
+        _build_graph["graph"] = get_package_graph()
+    except Exception, e:
+        log("build_all_packages", *e)
+    package_names = sorted(settings.CSS_BUILDER_PACKAGES)
+    common = get_common_package()
+    if common != None:
+        package_names.insert(0, common[0])
+    tasks = [(package_name, options) for package_name in package_names]
+    try:
+        if jobs > 1 and len(tasks) > 1:
+            # forked workers can't share the database connection
+            connection.close()
+            pool = multiprocessing.Pool(min(jobs, len(tasks)))
+            try:
+                results = pool.map(timed_build_package, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            # stats of the builds done by workers
+            for package_name, seconds, builds in results:
+                for build in builds:
+                    stats.record_build_stats(build)
+        else:
+            results = map(timed_build_package, tasks)
+    finally:
+        _build_graph["graph"] = None
+    return [(package_name, seconds) for package_name, seconds, builds in
+            results]
 
+def yui_compress(content):
+    """
+    Compress css with YUI Compressor
 
-def url_2_b64(url):
+    Parameters:
+        content <str>
+    Return:
+        <str>
     """
+    command = ["java", "-jar", here(("yuicompressor-2.4.2",
+                                "yuicompressor-2.4.2.jar",)), "--type", "css"]
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError, e:
+        raise Exception("yui compressor", str(e))
+    output, errors = process.communicate(content)
+    if process.returncode != 0:
+        raise Exception("yui compressor", errors)
+    return output
+
+
+COMPRESSORS = {"python": minify, "yui": yui_compress}
+
+def compress_css(content):
+    """
+    Compress css with compressor set in CSS_BUILDER_COMPRESSOR ("python" or
+    "yui"). Pure python minifier is used by default.
+
     Parameters:
-        url <str>
+        content <str>
     Return:
-        (<str>, <str>) - (image extension, image content in base64)
+        <str>
     """
-    image_path = cut_path(url, settings.MEDIA_URL)
-    with closing(open(os.path.join(settings.MEDIA_ROOT, image_path), "r"))\
-    as f:
-        content_b64 = text_2_b64(f.read())
-    root, ext = os.path.splitext(url)
-    return (ext[1:], content_b64)
+    name = getattr(settings, "CSS_BUILDER_COMPRESSOR", "python")
+    if not name in COMPRESSORS:
+        raise Exception("compress_css", "Unknown compressor %s. Available \
+compressors: %s" % (name, sorted(COMPRESSORS)))
+    return COMPRESSORS[name](content)
 
 
-def add_embedding_images(path, output=None):
+def compress_package(package_name):
     """
-    Create data streams for embedding image from background and
-    background-image styles.
+    Compress package file
 
     Parameters:
-        path <str> - absolute path to the input file
-        output <str>
+        package_name <str>
     """
-    with closing(open(path, "r")) as f:
+    in_file = os.path.join(get_dest_dir(), package_name + ".css")
+    out_file = os.path.join(get_dest_dir(), package_name + "-min.css")
+    with closing(open(in_file, "r")) as f:
         content = f.read()
+    try:
+        content = compress_css(content)
+        write_output(out_file, content)
+        write_fingerprinted_package(package_name, content)
+    except Exception, e:
+        log("compress_package", *e)
 
-    def background_image_to_b64(matchobj):
-        data = matchobj.groupdict()
-        (ext, b64) = url_2_b64(data['bg_image_url'])
-        return 'background-image: url("data:image/%s;base64,%s");' %\
-            (ext, b64,)
 
-    def background_to_b64(matchobj):
-        data = matchobj.groupdict()
-        (ext, b64) = url_2_b64(data['bg_image_url'])
-        return 'background: %s url("data:image/%s;base64,%s") %s %s;' %\
-            (data['bg_color'], ext, b64, data['bg_repeat'],
-             data['bg_position'],)
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+# SOF markers, 0xc4, 0xc8 and 0xcc are other markers in the same range
+JPEG_SOF_MARKERS = set(range(0xc0, 0xd0)) - set([0xc4, 0xc8, 0xcc])
 
-    content = re.sub(BACKGROUND_SHORT_B64, background_image_to_b64, content)
-    content = re.sub(BACKGROUND_B64, background_to_b64, content)
 
-    if output == None:
-        output = path
+def read_jpeg_size(f):
+    """
+    Find size of the JPEG image in its frame header
 
-    with closing(open(output, 'w')) as f:
-        f.write(content)
+    Parameters:
+        f <file> - file positioned after the SOI marker
+    Return:
+        (<int>, <int>) or None
+    """
+    while True:
+        byte = f.read(1)
+        if byte != "\xff":
+            return None
+        while byte == "\xff":
+            byte = f.read(1)
+        if byte == "" or ord(byte) in (0xd9, 0xda):
+            # end of the image or of the headers
+            return None
+        marker = ord(byte)
+        if 0xd0 <= marker <= 0xd7 or marker == 0x01:
+            # markers without data
+            continue
+        data = f.read(2)
+        if len(data) != 2:
+            return None
+        length = struct.unpack(">H", data)[0]
+        if marker in JPEG_SOF_MARKERS:
+            data = f.read(5)
+            if len(data) != 5:
+                return None
+            height, width = struct.unpack(">xHH", data)
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
 
 
-def build_all_packages(**options):
+def read_image_header(path):
     """
-    Build all packages from CSS_BUILDER_PACKAGEs
+    Read format and size of the PNG, GIF, BMP or JPEG image from its header,
+    pixel data isn't read
+
+    Parameters:
+        path <str>
+    Return:
+        (<str>, <int>, <int>) - format as returned by imghdr.what, width and
+                                height or None if the format is unknown
     """
-    if check_basic_config():
-        for sprite_name in settings.CSS_BUILDER_PACKAGES:
-            build_package(sprite_name, False, **options)
+    with closing(open(path, "rb")) as f:
+        head = f.read(26)
+        if head[:8] == PNG_SIGNATURE and head[12:16] == "IHDR":
+            width, height = struct.unpack(">II", head[16:24])
+            return "png", width, height
+        if head[:6] in ("GIF87a", "GIF89a"):
+            width, height = struct.unpack("<HH", head[6:10])
+            return "gif", width, height
+        if head[:2] == "BM" and len(head) == 26:
+            if struct.unpack("<I", head[14:18])[0] == 12:
+                # OS/2 bitmap header
+                width, height = struct.unpack("<HH", head[18:22])
+            else:
+                width, height = struct.unpack("<ii", head[18:26])
+            # negative height means rows stored from the top
+            return "bmp", width, abs(height)
+        if head[:3] == "\xff\xd8\xff":
+            f.seek(2)
+            size = read_jpeg_size(f)
+            if size != None:
+                return ("jpeg",) + size
+    return None
 
-def compress_package(package_name):
+
+def read_image_metadata(path):
     """
-    Compress package file
+    Return format and size of the image. PIL is used (it also reads only the
+    header) for formats read_image_header doesn't know.
 
     Parameters:
-        package_name <str>
+        path <str>
+    Return:
+        (<str>, <int>, <int>) - (None, None, None) if it isn't an image
     """
-    in_file = os.path.join(get_dest_dir(), package_name + ".css")
-    f = open(in_file)
-    f.close()
-    out_file = os.path.join(get_dest_dir(), package_name + "-min.css")
-    command = "java -jar %s %s -o %s" % (here(("yuicompressor-2.4.2",
-                                "yuicompressor-2.4.2.jar",)), in_file, out_file)
-    status, output = commands.getstatusoutput(command)
-    if status != 0:
-        log("yui compressor", output)
+    metadata = read_image_header(path)
+    if metadata != None:
+        return metadata
+    try:
+        image = Image.open(path)
+    except IOError:
+        return None, None, None
+    return (image.format.lower(),) + image.size
+
+
+class ImageMetadataCache(object):
+    """
+    In-memory cache of image formats and sizes. Entry is valid while the
+    file has the same mtime, size and inode.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, path):
+        """
+        Parameters:
+            path <str> - absolute path to the image file
+        Return:
+            (<str>, <int>, <int>) - see read_image_metadata
+        """
+        st = os.stat(path)
+        key = (st.st_mtime, st.st_size, st.st_ino)
+        entry = self.entries.get(path)
+        if entry != None and entry[0] == key:
+            stats.count("image_metadata_hits")
+            return entry[1]
+        stats.count("image_metadata_misses")
+        metadata = read_image_metadata(path)
+        self.entries[path] = (key, metadata)
+        return metadata
+
+    def clear(self):
+        self.entries.clear()
+
+
+IMAGE_METADATA = ImageMetadataCache()
 
 
 class ImageFile(object):
     """
     Class represents image
     """
-    def __init__(self, path):
+    def __init__(self, path, metadata=None):
         """
         Parameters:
             path <str> - absolute path to the image file
-            
+            metadata <tuple> - format, width and height, read from the
+                               image header if not given
         """
-        self.width, self.height = Image.open(path).size
+        if metadata == None:
+            metadata = IMAGE_METADATA.get(path)
+        if metadata[0] == None:
+            raise IOError("cannot identify image file %s" % path)
+        self.metadata = metadata
+        self.format, self.width, self.height = metadata
         self.path = path
 
 
@@ -376,15 +1777,15 @@ class SpriteImageFile(ImageFile):
     """
     Class represents sprite image
     """
-    def __init__(self, path, x, y):
+    def __init__(self, path, x, y, metadata=None):
         """
         Parameters:
             path <str> - absolute path to the image file
-            x <int> - TODO
-            y <int> - TODO
-            
+            x <int> - position in the sprite
+            y <int> - position in the sprite
+            metadata <tuple> - see ImageFile
         """
-        super(SpriteImageFile, self).__init__(path)
+        super(SpriteImageFile, self).__init__(path, metadata)
         self.x = x
         self.y = y
 
@@ -402,7 +1803,8 @@ def build_css_sprite_vertically(images):
     current_y = 0
     width = 0
     for image in images:
-        sprite_image = SpriteImageFile(image.path, 0, current_y)
+        sprite_image = SpriteImageFile(image.path, 0, current_y,
+                                       image.metadata)
         results.append(sprite_image)
         if current_y == 0:
             current_y += 1
@@ -425,7 +1827,8 @@ def build_css_sprite_horizontaly(images):
     current_x = 0
     height = 0
     for image in images:
-        sprite_image = SpriteImageFile(image.path, current_x, 0)
+        sprite_image = SpriteImageFile(image.path, current_x, 0,
+                                       image.metadata)
         results.append(sprite_image)
         if current_x == 0:
             current_x += 1
@@ -435,16 +1838,58 @@ def build_css_sprite_horizontaly(images):
     return results, current_x, height
 
 
-def build_css_sprite_default(images):
+def build_css_sprite_default(images, padding=0, max_width=None):
     """
-    Compute position of each part image in css sprite.
+    Compute position of each part image in css sprite. Images are packed
+    into a sheet as small as possible (see css_builder.packing).
 
     Parameters:
         images [Image]
+        padding <int> - space between images
+        max_width <int> - maximal sprite width
     Return:
-        [SpriteImage]
+        [SpriteImage], <int>, <int>
+    """
+    positions, width, height = pack_rectangles(
+        [(image.width, image.height) for image in images], padding, max_width)
+    results = [SpriteImageFile(image.path, x, y, image.metadata) for
+               image, (x, y) in zip(images, positions)]
+    return results, width, height
+
+
+def get_sprite_packing(cfg):
+    """
+    Return padding and maximal width of the packed sprite
+
+    Parameters:
+        cfg <dict> - sprite definition from CSS_BUILDER_SPRITES
+    Return:
+        (<int>, <int>)
+    """
+    return (cfg.get("padding", getattr(settings, "CSS_BUILDER_SPRITE_PADDING",
+                                       0)),
+            cfg.get("max_width", getattr(settings,
+                                         "CSS_BUILDER_SPRITE_MAX_WIDTH", None)))
+
+
+def get_sprite_orientation(cfg):
+    """
+    Return orientation of the sprite as stored in Sprite.orientation, packing
+    parameters are included so their change rebuilds the sprite
+
+    Parameters:
+        cfg <dict> - sprite definition from CSS_BUILDER_SPRITES
+    Return:
+        <str>
     """
-    pass
+    orientation = cfg.get("orientation", "default")
+    if orientation != "default":
+        return orientation
+    padding, max_width = get_sprite_packing(cfg)
+    if padding == 0 and max_width == None:
+        return orientation
+    return "default padding=%s max_width=%s" % (padding, max_width)
+
 
 def ext_from_path(path):
     return os.path.splitext(path)[1][1:]
@@ -486,24 +1931,126 @@ def get_sprite_format(sprite_name, images=None):
             files = find_package_files(
                         settings.CSS_BUILDER_SPRITES[sprite_name]['files'],
                         settings.CSS_BUILDER_SOURCE)
-            sprite_format = None
-            for f in files:
-                format = imghdr.what(f)
-                if not is_image_format(format):
-                    log('get_sprite_format',
-                        'Unrecognized image format %s. Available formats: %s'
-                        % (format, IMAGE_FORMATS))
+            formats = [IMAGE_METADATA.get(f)[0] for f in files]
+        else:
+            formats = [image.format for image in images]
+        sprite_format = None
+        for format in formats:
+            if not is_image_format(format):
+                log('get_sprite_format',
+                    'Unrecognized image format %s. Available formats: %s'
+                    % (format, IMAGE_FORMATS))
+                return None
+            else:
+                format = format.upper()
+                if sprite_format == None:
+                    sprite_format = format
+                elif format != sprite_format:
+                    # images in different format in sprite
                     return None
-                else:
-                    format = format.upper()
-                    if sprite_format == None:
-                        sprite_format = format
-                    elif format != sprite_format:
-                        # images in different format in sprite
-                        return None
-            return sprite_format
-        else: # TODO
+        return sprite_format
+
+def get_sprite_path(sprite_name, format=None):
+    """
+    Return absolute path to the sprite image
+
+    Parameters:
+        sprite_name <str>
+        format <str> - sprite format, get_sprite_format is used if not given
+    Return:
+        <str>
+    """
+    if format == None:
+        format = get_sprite_format(sprite_name)
+    return os.path.join(settings.MEDIA_ROOT, '%s.%s' % (sprite_name, format))
+
+
+def save_css_sprite_file(sprite_path, output_image, format):
+    """
+    Parameters:
+        sprite_path <str>
+        output_image <Image>
+        format <str>
+    """
+    with stats.stage("image_encoding"):
+        with atomic_output(sprite_path) as tmp_path:
+            output_image.save(tmp_path)
+    stats.count("files_written")
+    stats.count("bytes_written", os.path.getsize(sprite_path))
+    # PNG, JPG and GIF are already compressed
+    if format in UNCOMPRESSED_IMAGE_FORMATS:
+        with closing(open(sprite_path, 'rb')) as f:
+            write_compressed_sidecars(sprite_path, f.read())
+
+
+def get_sprite_repaint(sprite_name, images):
+    """
+    Check if the sprite can be repainted instead of built again. It's
+    possible if the sprite has the same images of the same sizes and
+    orientation, so the layout would be the same, and only some images were
+    modified.
+
+    Parameters:
+        sprite_name <str>
+        images [ImageFile] - current images of the sprite
+    Return:
+        (<str>, [SpriteImageFile]) - sprite format and modified images or
+                                     None if the sprite has to be built
+    """
+    if len(images) == 0:
+        return None
+    format = get_sprite_format(sprite_name, images)
+    if not format in REPAINTABLE_IMAGE_FORMATS:
+        return None
+    sprite_path = get_sprite_path(sprite_name, format)
+    if not os.path.exists(sprite_path):
+        return None
+    sprite_m_time = os.path.getmtime(sprite_path)
+    modified = [image for image in images if
+                os.path.getmtime(image.path) > sprite_m_time]
+    if len(modified) == 0:
+        return None
+    stored = read_sprite_layout(sprite_name)
+    cfg = settings.CSS_BUILDER_SPRITES[sprite_name]
+    if stored == None or stored[0] != get_sprite_orientation(cfg):
+        return None
+    layout = stored[1]
+    if set(layout) != set(image.path for image in images):
+        return None
+    for image in images:
+        # sizes are unknown (None) in layouts saved by older versions
+        if tuple(layout[image.path][2:]) != (image.width, image.height):
             return None
+    return format, [SpriteImageFile(image.path, layout[image.path][0],
+                    layout[image.path][1], image.metadata) for image in
+                    modified]
+
+
+def repaint_css_sprite_file(sprite_name, format, images):
+    """
+    Paint images over their regions of the existing sprite file. Layout
+    isn't changed so css rules using the sprite stay valid.
+
+    Parameters:
+        sprite_name <str>
+        format <str>
+        images [SpriteImageFile]
+    """
+    sprite_path = get_sprite_path(sprite_name, format)
+    with stats.stage("image_decoding"):
+        output_image = Image.open(sprite_path)
+        output_image.load()
+        stats.count("files_read")
+        if output_image.mode != "RGBA":
+            output_image = output_image.convert("RGBA")
+        for image in images:
+            image_file = Image.open(image.path)
+            image_file.load()
+            output_image.paste(image_file, (image.x, image.y))
+            stats.count("files_read")
+    stats.count("images_repainted", len(images))
+    save_css_sprite_file(sprite_path, output_image, format)
+
 
 def create_css_sprite_file(sprite_name, images, width, height):
     """
@@ -521,101 +2068,403 @@ def create_css_sprite_file(sprite_name, images, width, height):
     output_image = Image.new(
                         mode='RGBA', size=(width, height), color=(0,0,0,0))
 
-    for image in images:
-        image_file = Image.open(image.path)
-        output_image.paste(image_file,(image.x, image.y))
+    # pixels of every image are decoded only here, the layout is computed
+    # from the image headers
+    with stats.stage("image_decoding"):
+        for image in images:
+            image_file = Image.open(image.path)
+            image_file.load()
+            output_image.paste(image_file,(image.x, image.y))
+            stats.count("files_read")
 
-    format = get_sprite_format(sprite_name)
-    output_image.save(os.path.join(settings.MEDIA_ROOT,
-                    '%s.%s' % (sprite_name, format)))
+    format = get_sprite_format(sprite_name, images)
+    save_css_sprite_file(get_sprite_path(sprite_name, format), output_image,
+                         format)
 
-    try:
-        sprite = Sprite.objects.get(name=sprite_name)
-    except Sprite.DoesNotExist:
-        sprite = Sprite.objects.create(name=sprite_name)
-
-    sprite_cfg = settings.CSS_BUILDER_SPRITES[sprite_name]
-    sprite.orientation = sprite_cfg.get("orientation", "default")
-    sprite.save()
- 
-    for image in images:
+    with stats.stage("db_writes"):
+        sprite_cfg = settings.CSS_BUILDER_SPRITES[sprite_name]
+        write_sprite_layout(sprite_name, get_sprite_orientation(sprite_cfg),
+                            dict((image.path, (image.x, image.y, image.width,
+                                  image.height)) for image in images))
+
+
+def chunks(items, size=DB_BATCH_SIZE):
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+# SpriteImage columns added after the table was first created, syncdb
+# doesn't add them to existing tables
+SPRITE_IMAGE_UPGRADE_COLUMNS = ["width", "height"]
+
+
+def get_missing_sprite_columns():
+    """
+    Return:
+        <list> - names of SPRITE_IMAGE_UPGRADE_COLUMNS missing in the database
+    """
+    cursor = connection.cursor()
+    existing = [row[0] for row in connection.introspection.
+                get_table_description(cursor, SpriteImage._meta.db_table)]
+    return [column for column in SPRITE_IMAGE_UPGRADE_COLUMNS if
+            not column in existing]
+
+
+def get_upgrade_sql():
+    """
+    Return statements adding the missing columns to the database, they are
+    run by the css_builder_upgrade command
+
+    Return:
+        <list>
+    """
+    qn = connection.ops.quote_name
+    statements = []
+    for column in get_missing_sprite_columns():
+        field = SpriteImage._meta.get_field(column)
+        statements.append("ALTER TABLE %s ADD COLUMN %s %s NULL;" % (
+                          qn(SpriteImage._meta.db_table), qn(field.column),
+                          field.db_type(connection=connection)))
+    return statements
+
+
+class ModelSpriteStore(object):
+    """
+    Sprite layouts stored in Sprite and SpriteImage models. If the database
+    wasn't upgraded, layouts are saved without image sizes, so sprites are
+    always rebuilt instead of repainted.
+    """
+    def __init__(self):
+        # None until the table is checked
+        self.sizes = None
+
+    def check_table(self):
+        """
+        Check if SpriteImage table has the size columns. Sqlite commits the
+        open transaction before the table introspection.
+        """
+        missing = get_missing_sprite_columns()
+        self.sizes = len(missing) == 0
+        if missing:
+            log("sprite_store", "Columns %s of %s are missing, run \
+manage.py css_builder_upgrade to add them" % (", ".join(missing),
+                SpriteImage._meta.db_table))
+
+    def has_sizes(self):
+        """
+        Return:
+            bool - True if SpriteImage table has the size columns
+        """
+        if self.sizes == None:
+            self.check_table()
+        return self.sizes
+
+    def read(self, sprite_name):
+        """
+        Load the sprite and its layout by one query
+
+        Parameters:
+            sprite_name <str>
+        Return:
+            (<str>, <dict>) - orientation and path -> (x, y, width, height)
+                              or None if the sprite doesn't exist
+        """
+        columns = ["orientation", "images__path", "images__x", "images__y"]
+        if self.has_sizes():
+            columns += ["images__width", "images__height"]
+        rows = Sprite.objects.filter(name=sprite_name).values_list(*columns)
+        orientation = None
+        layout = {}
+        for row in rows:
+            orientation, path, x, y = row[:4]
+            # sprite without images is one row with NULL image columns
+            if path != None:
+                layout[path] = (x, y) + (tuple(row[4:]) or (None, None))
+        if orientation == None:
+            return None
+        return orientation, layout
+
+    def write(self, sprite_name, orientation, layout):
+        """
+        Save the sprite and its layout in one transaction. Only changed rows
+        are written, in batches, so the number of queries doesn't grow with
+        the number of images.
+
+        Parameters:
+            sprite_name <str>
+            orientation <str>
+            layout <dict> - path -> (x, y, width, height)
+        """
+        with transaction.commit_on_success():
+            if Sprite.objects.filter(name=sprite_name).update(
+                                            orientation=orientation) == 0:
+                Sprite.objects.create(name=sprite_name,
+                                      orientation=orientation)
+            fields = ["path", "x", "y"]
+            if self.has_sizes():
+                fields += SPRITE_IMAGE_UPGRADE_COLUMNS
+            old = dict((row[0], row[1:]) for row in
+                       SpriteImage.objects.filter(sprite=sprite_name
+                       ).values_list(*fields))
+            stale = sorted(path for path in old if not path in layout)
+            changed = sorted(path for path in layout if old.get(path) !=
+                             tuple(layout[path][:len(fields) - 1]))
+            # path is the primary key, new images may still belong to other
+            # sprites so they are deleted too
+            for paths in chunks(stale + changed):
+                SpriteImage.objects.filter(path__in=paths).delete()
+            for paths in chunks(changed, SPRITE_IMAGE_BATCH_SIZE):
+                if self.has_sizes():
+                    SpriteImage.objects.bulk_create([SpriteImage(
+                        sprite_id=sprite_name, path=path, x=layout[path][0],
+                        y=layout[path][1], width=layout[path][2],
+                        height=layout[path][3]) for path in paths])
+                else:
+                    self.insert_without_sizes(sprite_name, paths, layout)
+
+    def insert_without_sizes(self, sprite_name, paths, layout):
+        """
+        Insert images into the table without the size columns, the model
+        can't be used because it writes all its fields
+        """
+        qn = connection.ops.quote_name
+        columns = [qn(SpriteImage._meta.get_field(name).column) for name in
+                   ("sprite", "path", "x", "y")]
+        connection.cursor().executemany(
+            "INSERT INTO %s (%s) VALUES (%%s, %%s, %%s, %%s)" % (
+            qn(SpriteImage._meta.db_table), ", ".join(columns)),
+            [(sprite_name, path, layout[path][0], layout[path][1]) for path in
+             paths])
+        transaction.set_dirty()
+
+    def clear(self):
+        pass
+
+
+class FileSpriteStore(object):
+    """
+    Sprite layouts stored in JSON manifests next to the sprite images
+    (MEDIA_ROOT/<sprite name>.sprite.json), paths are relative to
+    CSS_BUILDER_SOURCE. Manifest is read once and kept in memory while the
+    file doesn't change, so other processes' builds are seen too.
+    """
+    VERSION = 2
+
+    def __init__(self):
+        self.entries = {}
+
+    def get_path(self, sprite_name):
+        return os.path.join(settings.MEDIA_ROOT, "%s.sprite.json" %
+                            sprite_name)
+
+    def read(self, sprite_name):
+        """
+        Parameters:
+            sprite_name <str>
+        Return:
+            (<str>, <dict>) - see ModelSpriteStore.read
+        """
+        path = self.get_path(sprite_name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.entries.pop(sprite_name, None)
+            return None
+        key = (path, st.st_mtime, st.st_size, st.st_ino)
+        entry = self.entries.get(sprite_name)
+        if entry != None and entry[0] == key:
+            return entry[1]
         try:
-            sprite_image = SpriteImage.objects.get(path=image.path,
-                                                      sprite=sprite)
-        except SpriteImage.DoesNotExist:
-            sprite_image = SpriteImage(path=image.path, sprite=sprite)
-        sprite_image.x = image.x
-        sprite_image.y = image.y
-        sprite_image.save()
+            with closing(open(path, "r")) as f:
+                data = json.load(f)
+        except (IOError, ValueError), e:
+            log("FileSpriteStore", "Cannot read %s: %s" % (path, e))
+            return None
+        if data.get("version") != self.VERSION:
+            return None
+        root = settings.CSS_BUILDER_SOURCE
+        images = {}
+        for image, position in data["images"].items():
+            image = os.path.normpath(os.path.join(root, image.encode("utf-8")))
+            images[image] = tuple(position)
+        layout = (str(data["orientation"]), images)
+        self.entries[sprite_name] = (key, layout)
+        return layout
+
+    def write(self, sprite_name, orientation, layout):
+        """
+        Parameters:
+            sprite_name <str>
+            orientation <str>
+            layout <dict> - path -> (x, y, width, height)
+        """
+        root = settings.CSS_BUILDER_SOURCE
+        images = dict((os.path.relpath(path, root), list(position)) for
+                      path, position in layout.items())
+        path = self.get_path(sprite_name)
+        write_file(path, json.dumps({"version": self.VERSION,
+                                     "orientation": orientation,
+                                     "images": images}, sort_keys=True))
+        st = os.stat(path)
+        self.entries[sprite_name] = ((path, st.st_mtime, st.st_size,
+                                      st.st_ino), (orientation, dict(layout)))
+
+    def clear(self):
+        self.entries.clear()
+
+
+SPRITE_STORES = {"models": ModelSpriteStore(), "files": FileSpriteStore()}
+
+
+def get_sprite_store():
+    """
+    Return store of sprite layouts selected by CSS_BUILDER_SPRITE_STORE,
+    "models" (default) or "files"
+    """
+    name = getattr(settings, "CSS_BUILDER_SPRITE_STORE", "models")
+    if not name in SPRITE_STORES:
+        log("get_sprite_store", "Unrecognized sprite store: %s. Available \
+stores: %s" % (name, sorted(SPRITE_STORES)))
+        name = "models"
+    return SPRITE_STORES[name]
+
+
+def read_sprite_layout(sprite_name):
+    """
+    Load the sprite layout from the sprite store
+
+    Parameters:
+        sprite_name <str>
+    Return:
+        (<str>, <dict>) - orientation and path -> (x, y, width, height) or
+                          None if the sprite doesn't exist
+    """
+    return get_sprite_store().read(sprite_name)
+
+
+def write_sprite_layout(sprite_name, orientation, layout):
+    """
+    Save the sprite layout to the sprite store
+
+    Parameters:
+        sprite_name <str>
+        orientation <str>
+        layout <dict> - path -> (x, y, width, height)
+    """
+    get_sprite_store().write(sprite_name, orientation, layout)
 
 
 def build_css_sprite(sprite_name):
     """
-    Create sprite file.
+    Create sprite file. Only one process builds the sprite at a time.
 
     Parameters:
         sprite_name <str>
     Return:
         bool
     """
+    with stats.collect("sprite", sprite_name):
+        with get_lock("sprite-" + sprite_name):
+            return _build_css_sprite(sprite_name)
+
+
+def _build_css_sprite(sprite_name):
     cfg = settings.CSS_BUILDER_SPRITES[sprite_name]
-    paths = find_package_files(cfg["files"], settings.CSS_BUILDER_SOURCE)
+    with stats.stage("discovery"):
+        paths = find_package_files(cfg["files"], settings.CSS_BUILDER_SOURCE)
+    update_sprite_index(sprite_name, paths)
     images = []
     for path in paths:
         images.append(ImageFile(path))
-    if cfg.has_key("orientation"):
-        if cfg["orientation"] == "vertically":
-            sprite_images, width, height = build_css_sprite_vertically(images)
-        elif cfg["orientation"] == "horizontaly":
-            sprite_images, width, height = build_css_sprite_horizontaly(images)
+    repaint = get_sprite_repaint(sprite_name, images)
+    if repaint != None:
+        repaint_css_sprite_file(sprite_name, *repaint)
+        return True
+    with stats.stage("layout"):
+        orientation = cfg.get("orientation", "default")
+        if orientation == "vertically":
+            sprite_images, width, height = \
+                build_css_sprite_vertically(images)
+        elif orientation == "horizontaly":
+            sprite_images, width, height = \
+                build_css_sprite_horizontaly(images)
+        elif orientation == "default":
+            padding, max_width = get_sprite_packing(cfg)
+            sprite_images, width, height = \
+                build_css_sprite_default(images, padding, max_width)
         else:
             log("build_css_sprite", "Unrecognized orientation: %s" %\
                 cfg["orientation"])
             return False
-    else:
-        sprite_images, width, height = build_css_sprite_default(images)
+    efficiency = packing_efficiency([(image.width, image.height) for image
+                                     in sprite_images], width, height)
+    stats.count("sprite_images_area", sum(image.width * image.height for
+                                          image in sprite_images))
+    stats.count("sprite_sheet_area", width * height)
+    logging.getLogger("css_builder.build").debug(
+        "Sprite %s: %dx%d, %d images, packing efficiency %.1f%%" % (
+            sprite_name, width, height, len(sprite_images), efficiency * 100))
     create_css_sprite_file(sprite_name, sprite_images, width, height)
     return True
 
 
-def css_sprite_is_up_to_date(sprite_name):
+def css_sprite_is_up_to_date(sprite_name, layout=None):
     """
     Checks if sprite file needs rebuild
 
     Parameters:
         sprite_name <str>
+        layout <tuple> - result of read_sprite_layout, loaded if not given
     Retrun:
         bool
     """
     cfg = settings.CSS_BUILDER_SPRITES[sprite_name]
     current_files = find_package_files(cfg["files"],
                                        settings.CSS_BUILDER_SOURCE)
-    sprite_file = os.path.join(get_dest_dir(), sprite_name)
+    sprite_file = get_sprite_path(sprite_name)
 
     if not os.path.exists(sprite_file): # sprite files doesn't exist
         return False
 
-    try:
-        sprite = Sprite.objects.get(name=sprite_name)
-    except Sprite.DoesNotExist:
+    if layout == None:
+        layout = read_sprite_layout(sprite_name)
+    if layout == None:
         return False
+    orientation, images = layout
 
-    # check if orientation property wasn't changed
-    if cfg.get("orientation", "default") != sprite.orientation:
+    # check if orientation or packing properties weren't changed
+    if get_sprite_orientation(cfg) != orientation:
         return False
 
-    sprite_part_files = sprite.images.all()
-
-    for f in sprite_part_files:
-        if not os.path.exists(f.path): # file has been removed
+    sprite_m_time = os.path.getmtime(sprite_file)
+    for path in images:
+        if not os.path.exists(path): # file has been removed
             return False
         # some file from css sprite files has been modified
-        sprite_m_time = os.path.getmtime(sprite_file)
-        if os.path.getmtime(f.path) > sprite_m_time:
+        if os.path.getmtime(path) > sprite_m_time:
             return False
     for f in current_files: # check if new files have been added
-        try:
-            SpriteImage.objects.get(path = f, sprite = sprite)
-        except SpriteImage.DoesNotExist:
+        if not f in images:
             return False
     return True
+
+
+def get_built_sprite_layout(sprite_name):
+    """
+    Rebuild sprite if needed and return its layout
+
+    Parameters:
+        sprite_name <str>
+    Return:
+        <dict> - path -> (x, y, width, height) or None if the sprite can't
+                 be built
+    """
+    layout = read_sprite_layout(sprite_name)
+    if not css_sprite_is_up_to_date(sprite_name, layout):
+        if not build_css_sprite(sprite_name):
+            return None
+        layout = read_sprite_layout(sprite_name)
+        if layout == None:
+            # sprite without images isn't saved
+            return None
+    return layout[1]
@@ -0,0 +1,290 @@
+"""
+Watching CSS_BUILDER_SOURCE and directories of the embedded images and
+rebuilding packages and sprites affected by changed files.
+"""
+
+import os
+import time
+
+from django.conf import settings
+
+from css_builder.utils import (build_package, build_css_sprite, log,
+                               get_package_graph, get_affected_packages,
+                               get_sprites_files, get_common_package,
+                               get_sprite_format, read_sprite_layout,
+                               FRAGMENT_CACHE)
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+class PollingWatcher(object):
+    """
+    Detects changes by comparing mtimes and sizes of all files in the
+    directory tree and in the directories added by watch_directory every
+    interval seconds.
+    """
+    def __init__(self, root, interval=1.0):
+        self.root = root
+        self.interval = interval
+        self.directories = []
+        self.snapshot = self.scan()
+
+    def watch_directory(self, path):
+        """
+        Watch files in the directory too, subdirectories aren't watched
+        """
+        if not path in self.directories:
+            self.directories.append(path)
+            self.add_files(self.snapshot, path, self.list_files(path))
+
+    def list_files(self, path):
+        try:
+            return [name for name in os.listdir(path) if
+                    os.path.isfile(os.path.join(path, name))]
+        except OSError:
+            return []
+
+    def add_files(self, snapshot, dirpath, filenames):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (stat.st_mtime, stat.st_size)
+
+    def scan(self):
+        snapshot = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            self.add_files(snapshot, dirpath, filenames)
+        for path in self.directories:
+            self.add_files(snapshot, path, self.list_files(path))
+        return snapshot
+
+    def changes(self):
+        """
+        Generator of sets of changed, added or removed paths
+        """
+        while True:
+            time.sleep(self.interval)
+            snapshot = self.scan()
+            changed = set()
+            for path, signature in snapshot.iteritems():
+                if self.snapshot.get(path) != signature:
+                    changed.add(path)
+            changed.update(set(self.snapshot) - set(snapshot))
+            self.snapshot = snapshot
+            if changed:
+                yield changed
+
+
+class InotifyWatcher(object):
+    """
+    Detects changes with inotify (requires pyinotify). Events which come
+    within interval seconds are grouped together.
+    """
+    def __init__(self, root, interval=0.2):
+        self.root = root
+        self.interval = interval
+        self.changed = set()
+        self.directories = []
+        self.mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | \
+            pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | \
+            pyinotify.IN_MOVED_TO
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self.process_event,
+                                           timeout=int(interval * 1000))
+        self.manager.add_watch(root, self.mask, rec=True, auto_add=True)
+
+    def watch_directory(self, path):
+        """
+        Watch files in the directory too, subdirectories aren't watched
+        """
+        if not path in self.directories and os.path.isdir(path):
+            self.directories.append(path)
+            self.manager.add_watch(path, self.mask)
+
+    def process_event(self, event):
+        if not event.dir:
+            self.changed.add(event.pathname)
+
+    def changes(self):
+        """
+        Generator of sets of changed, added or removed paths
+        """
+        while True:
+            if self.notifier.check_events():
+                self.notifier.read_events()
+                # collect events which come right after the first one
+                while self.notifier.check_events():
+                    self.notifier.read_events()
+                self.notifier.process_events()
+            if self.changed:
+                changed, self.changed = self.changed, set()
+                yield changed
+
+
+def get_watcher(root, polling=False, interval=None):
+    """
+    Return InotifyWatcher if pyinotify is available, PollingWatcher
+    otherwise.
+
+    Parameters:
+        root <str>
+        polling <bool> - force PollingWatcher
+        interval <float> - seconds
+    """
+    if pyinotify == None or polling:
+        return PollingWatcher(root, interval or 1.0)
+    return InotifyWatcher(root, interval or 0.2)
+
+
+class Rebuilder(object):
+    """
+    Keeps dependency graph of packages and files of every sprite from the
+    last build and rebuilds only packages and sprites affected by changed
+    files.
+    """
+    def __init__(self, **options):
+        """
+        Parameters:
+            options - passed to build_package
+        """
+        self.options = options
+        self.graph = None
+        self.sprite_files = {}
+
+    def resolve_packages(self):
+        """
+        Build dependency graph of all packages and return the previous one
+        """
+        old_graph = self.graph
+        try:
+            self.graph = get_package_graph()
+        except Exception, e:
+            log("css_builder_watch", *e)
+            self.graph = None
+        return old_graph
+
+    def resolve_sprites(self):
+        """
+        Find files of all sprites and return the previous ones
+        """
+        old_files = self.sprite_files
+        self.sprite_files = dict((sprite_name, set(files)) for
+                    sprite_name, files in get_sprites_files().iteritems())
+        return old_files
+
+    def build_all(self):
+        """
+        Build all packages and remember their files
+
+        Return:
+            <list> - names of the packages
+        """
+        self.resolve_sprites()
+        self.resolve_packages()
+        package_names = sorted(settings.CSS_BUILDER_PACKAGES)
+        if get_common_package() != None:
+            package_names.insert(0, get_common_package()[0])
+        # packages are built even if they are up to date, so the fragment
+        # cache knows images used by every package
+        for package_name in package_names:
+            build_package(package_name, False, force=True, graph=self.graph,
+                          **self.options)
+        return package_names
+
+    def image_directories(self):
+        """
+        Return directories outside CSS_BUILDER_SOURCE with images used by
+        the built packages, they have to be watched too
+
+        Return:
+            <list>
+        """
+        source = os.path.join(settings.CSS_BUILDER_SOURCE, "")
+        return sorted(set(os.path.dirname(path) for path in
+                          FRAGMENT_CACHE.get_references("image") if
+                          not path.startswith(source)))
+
+    def used_paths(self, paths):
+        """
+        Return paths from CSS_BUILDER_SOURCE and images used by the packages,
+        e.g. outputs written to the watched directories are left out
+        """
+        source = os.path.join(settings.CSS_BUILDER_SOURCE, "")
+        images = FRAGMENT_CACHE.get_references("image")
+        return set(path for path in paths if path.startswith(source) or
+                   path in images)
+
+    def sprite_state(self, sprite_name):
+        return get_sprite_format(sprite_name), read_sprite_layout(sprite_name)
+
+    def affected_sprites(self, paths):
+        sprites = []
+        old = self.resolve_sprites()
+        for sprite_name, files in self.sprite_files.iteritems():
+            if paths & (old.get(sprite_name, set()) | files):
+                sprites.append(sprite_name)
+        return sorted(sprites)
+
+    def affected_packages(self, paths, sprites=()):
+        """
+        Return packages which files were changed, added or removed and
+        packages using changed images, imported files or sprites.
+
+        Parameters:
+            paths <set> - absolute paths
+            sprites <list> - names of sprites which layout or format has
+                             changed
+        Return:
+            <list>
+        """
+        references = set([("image", path) for path in paths] +
+                         [("file", path) for path in paths] +
+                         [("sprite", name) for name in sprites])
+        paths = paths | FRAGMENT_CACHE.paths_referencing(references)
+        # removed files are found in the old graph, added ones in the new
+        graphs = [graph for graph in [self.resolve_packages(), self.graph]
+                  if graph != None]
+        common = get_common_package()
+        if common != None and len(graphs) == 2:
+            # files which moved to or from the common package affect all
+            # packages using them
+            paths = paths | (graphs[0].common_files(common[1]) ^
+                             graphs[1].common_files(common[1]))
+        packages = set()
+        for graph in graphs:
+            packages.update(get_affected_packages(paths, graph))
+        if common != None and packages:
+            return [common[0]] + sorted(packages)
+        return sorted(packages)
+
+    def rebuild(self, paths):
+        """
+        Rebuild sprites and packages affected by changed paths
+
+        Parameters:
+            paths <set> - absolute paths of changed, added or removed files
+        Return:
+            (<list>, <list>) - names of rebuilt sprites and packages
+        """
+        paths = self.used_paths(paths)
+        if not paths:
+            return [], []
+        sprites = self.affected_sprites(paths)
+        # repainted sprites (same layout) don't affect packages
+        changed = []
+        for sprite_name in sprites:
+            old = self.sprite_state(sprite_name)
+            build_css_sprite(sprite_name)
+            if self.sprite_state(sprite_name) != old:
+                changed.append(sprite_name)
+        packages = self.affected_packages(paths, changed)
+        for package_name in packages:
+            build_package(package_name, False, force=True, graph=self.graph,
+                          **self.options)
+        return sprites, packages